@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+بنچمارک دانلود - مقایسه موتور yt-dlp ماندگار (library) با subprocess
+
+برای هر backend چند آهنگ پشت سر هم دانلود میشه و زمان wall و CPU
+(پروسه اصلی + پروسه‌های فرزند) هر دانلود گزارش میشه.
+
+    python benchmark_download.py [تعداد آهنگ]
+"""
+import asyncio
+import os
+import resource
+import sys
+import time
+import logging
+
+logging.basicConfig(level=logging.WARNING)
+
+TRACKS = [
+    ("Blinding Lights", "The Weeknd"),
+    ("Shape of You", "Ed Sheeran"),
+    ("Levitating", "Dua Lipa"),
+    ("Bad Guy", "Billie Eilish"),
+    ("Believer", "Imagine Dragons"),
+]
+
+
+def _cpu_seconds() -> float:
+    """CPU پروسه اصلی + فرزندهای تمام شده (subprocess ها)"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+async def _bench_backend(name: str, count: int) -> list:
+    from services.downloader import music_downloader
+    from services.ytdlp_engine import ytdlp_engine
+
+    ytdlp_engine.enabled = name == 'library'
+    results = []
+
+    def worker_cpu() -> float:
+        return ytdlp_engine.stats()['backends'].get('library', {}).get('total_cpu', 0.0)
+
+    for track_name, artist_name in TRACKS[:count]:
+        wall_started = time.perf_counter()
+        cpu_started = _cpu_seconds()
+        worker_cpu_started = worker_cpu()
+
+        file_path = await music_downloader.download_from_youtube(track_name, artist_name)
+
+        wall = time.perf_counter() - wall_started
+        # CPU worker ماندگار از خود worker گزارش میشه (فرزند تمام نشده)
+        cpu = _cpu_seconds() - cpu_started + worker_cpu() - worker_cpu_started
+
+        results.append((track_name, bool(file_path), wall, cpu))
+        print(f"   {'✅' if file_path else '❌'} {track_name}: wall={wall:.2f}s")
+
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+    return results
+
+
+async def run_benchmark(count: int):
+    from services.ytdlp_engine import ytdlp_engine
+
+    print("=" * 60)
+    print("⏱ بنچمارک دانلود: library در برابر subprocess")
+    print("=" * 60)
+
+    summary = {}
+    for name in ('subprocess', 'library'):
+        print(f"\n▶️ {name}")
+        summary[name] = await _bench_backend(name, count)
+
+    await ytdlp_engine.close()
+
+    print("\n" + "=" * 60)
+    for name, results in summary.items():
+        ok = [r for r in results if r[1]]
+        if not ok:
+            print(f"{name}: هیچ دانلودی موفق نبود")
+            continue
+        wall = sum(r[2] for r in ok) / len(ok)
+        cpu = sum(r[3] for r in ok) / len(ok)
+        print(f"{name}: {len(ok)}/{len(results)} موفق | wall={wall:.2f}s | cpu={cpu:.2f}s")
+
+    print("\nآمار backend ها:", ytdlp_engine.stats()['backends'])
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    asyncio.run(run_benchmark(min(count, len(TRACKS))))
@@ -4,19 +4,27 @@ Handler برای پردازش ورودی‌های مختلف کاربر
 """
 import logging
 import re
-import os
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, MessageHandler, filters
-from pathlib import Path
 
 from services.music_recognition import recognition_service, recognize_music_from_instagram
 from services.spotify import spotify_service
 from services.music_sender import send_music_to_user
+from services.process_pool import process_pool
+from services.temp_workspace import temp_workspace
+from core.config import config
 from core.database import SessionLocal, DownloadedTrack
 
 logger = logging.getLogger(__name__)
 
 
+def _queue_notice() -> str:
+    """هشدار شلوغی صف پردازش (backpressure)"""
+    if process_pool.is_saturated():
+        return "\n\n🚦 صف پردازش الان شلوغه، ممکنه بیشتر طول بکشه."
+    return ""
+
+
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پردازش ویس برای تشخیص آهنگ"""
     
@@ -38,20 +46,18 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
         voice = update.message.voice
         file = await context.bot.get_file(voice.file_id)
         
-        temp_dir = Path("temp")
-        temp_dir.mkdir(exist_ok=True)
-        voice_path = temp_dir / f"voice_{update.effective_user.id}.ogg"
-        
-        await file.download_to_drive(voice_path)
-        
-        # تشخیص آهنگ
-        result = await recognition_service.recognize_from_file(str(voice_path))
-        
-        # پاک کردن فایل
-        try:
-            os.remove(voice_path)
-        except:
-            pass
+        if voice.file_size and voice.file_size <= config.VOICE_IN_MEMORY_MAX_KB * 1024:
+            # ویس کوچک: مستقیم در حافظه (بدون دیسک)
+            data = await file.download_as_bytearray()
+            result = await recognition_service.recognize_from_bytes(bytes(data))
+        else:
+            # پوشه موقت همین درخواست (در پایان خودکار پاک میشه)
+            async with temp_workspace('voice') as workdir:
+                voice_path = workdir / "voice.ogg"
+                await file.download_to_drive(voice_path)
+                
+                # تشخیص آهنگ
+                result = await recognition_service.recognize_from_file(str(voice_path))
         
         if result and result.get('title'):
             # آهنگ پیدا شد!
@@ -107,7 +113,7 @@ async def handle_video_message(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     msg = await update.message.reply_text(
-        "🎬 در حال پردازش ویدیو...\n⏳ ممکنه یکم طول بکشه..."
+        "🎬 در حال پردازش ویدیو...\n⏳ ممکنه یکم طول بکشه..." + _queue_notice()
     )
     
     try:
@@ -124,28 +130,13 @@ async def handle_video_message(update: Update, context: ContextTypes.DEFAULT_TYP
         
         file = await context.bot.get_file(video.file_id)
         
-        temp_dir = Path("temp")
-        temp_dir.mkdir(exist_ok=True)
-        video_path = temp_dir / f"video_{update.effective_user.id}.mp4"
-        
-        await file.download_to_drive(video_path)
-        
-        # استخراج صدا
-        audio_path = await recognition_service.extract_audio_from_video(str(video_path))
-        
-        if not audio_path:
-            await msg.edit_text("❌ نتونستم صدای ویدیو رو استخراج کنم!")
-            return
-        
-        # تشخیص آهنگ
-        result = await recognition_service.recognize_from_file(audio_path)
-        
-        # پاک‌سازی
-        try:
-            os.remove(video_path)
-            os.remove(audio_path)
-        except:
-            pass
+        # پوشه موقت همین درخواست (در پایان خودکار پاک میشه)
+        async with temp_workspace('video') as workdir:
+            video_path = workdir / "video.mp4"
+            await file.download_to_drive(video_path)
+            
+            # تشخیص آهنگ (نمونه صوتی مستقیم از خود ویدیو برش داده میشه)
+            result = await recognition_service.recognize_from_file(str(video_path))
         
         if result and result.get('title'):
             track_name = result['title']
@@ -224,7 +215,7 @@ async def handle_instagram_link(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     msg = await update.message.reply_text(
-        "📱 در حال دانلود از اینستاگرام...\n⏳ ممکنه یکم طول بکشه..."
+        "📱 در حال دانلود از اینستاگرام...\n⏳ ممکنه یکم طول بکشه..." + _queue_notice()
     )
     
     try:
@@ -285,7 +276,7 @@ async def handle_track_search(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
         
         # جستجو در Spotify
-        results = spotify_service.sp.search(q=query, type='track', limit=5)
+        results = await spotify_service.search(q=query, type='track', limit=5)
         tracks = results.get('tracks', {}).get('items', [])
         
         if not tracks:
@@ -348,7 +339,7 @@ async def handle_lyrics_search(update: Update, context: ContextTypes.DEFAULT_TYP
     
     try:
         # جستجوی ساده در Spotify با متن
-        results = spotify_service.sp.search(
+        results = await spotify_service.search(
             q=lyrics_text,
             type='track',
             limit=5
@@ -405,7 +396,7 @@ async def search_and_send_track(
     try:
         # جستجو در Spotify
         query = f"{track_name} {artist}"
-        results = spotify_service.sp.search(q=query, type='track', limit=1)
+        results = await spotify_service.search(q=query, type='track', limit=1)
         tracks = results.get('tracks', {}).get('items', [])
         
         if tracks:
@@ -53,7 +53,7 @@ async def handle_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE
             return ConversationHandler.END
         
         # جستجو در Spotify
-        results = spotify_service.sp.search(q=query, type='track', limit=10)
+        results = await spotify_service.search(q=query, type='track', limit=10)
         tracks = results.get('tracks', {}).get('items', [])
         
         if not tracks:
@@ -22,9 +22,36 @@ class Config:
     SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
     SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
     
+    # کش پاسخ‌های Spotify (در دیتابیس - بعد از ری‌استارت هم می‌مونه)
+    SPOTIFY_CACHE_TTL_MINUTES = int(os.getenv('SPOTIFY_CACHE_TTL_MINUTES', '360'))
+    SPOTIFY_CACHE_MAX_ENTRIES = int(os.getenv('SPOTIFY_CACHE_MAX_ENTRIES', '5000'))
+    SPOTIFY_MEMORY_CACHE_SIZE = int(os.getenv('SPOTIFY_MEMORY_CACHE_SIZE', '1000'))  # لایه حافظه جلوی دیتابیس
+    
     # Musixmatch API
     MUSIXMATCH_API_KEY = os.getenv('MUSIXMATCH_API_KEY')
     
+    # کش متن آهنگ
+    LYRICS_MEMORY_CACHE_SIZE = int(os.getenv('LYRICS_MEMORY_CACHE_SIZE', '500'))
+    LYRICS_TTL_DAYS = int(os.getenv('LYRICS_TTL_DAYS', '30'))
+    LYRICS_MISS_TTL_HOURS = int(os.getenv('LYRICS_MISS_TTL_HOURS', '24'))  # آهنگ‌های بدون متن
+    LYRICS_DEADLINE_SECONDS = float(os.getenv('LYRICS_DEADLINE_SECONDS', '4'))  # حداکثر تأخیر lyrics در ارسال
+    
+    # کش نتیجه تشخیص آهنگ (اثر انگشت نمونه + shortcode اینستاگرام)
+    RECOGNITION_CACHE_TTL_DAYS = int(os.getenv('RECOGNITION_CACHE_TTL_DAYS', '30'))
+    RECOGNITION_MISS_TTL_HOURS = int(os.getenv('RECOGNITION_MISS_TTL_HOURS', '6'))  # نمونه‌های بدون نتیجه
+    RECOGNITION_FINGERPRINT_TOLERANCE = float(os.getenv('RECOGNITION_FINGERPRINT_TOLERANCE', '0.1'))  # سهم بیت‌های متفاوت مجاز
+    
+    # فایل‌های موقت تشخیص آهنگ (پوشه جدا برای هر درخواست + janitor)
+    TEMP_JANITOR_MINUTES = int(os.getenv('TEMP_JANITOR_MINUTES', '30'))
+    TEMP_MAX_AGE_MINUTES = int(os.getenv('TEMP_MAX_AGE_MINUTES', '120'))
+    VOICE_IN_MEMORY_MAX_KB = int(os.getenv('VOICE_IN_MEMORY_MAX_KB', '1024'))  # ویس‌های کوچک‌تر بدون دیسک
+    
+    # لایه HTTP مشترک (keep-alive + کش DNS)
+    HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+    HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', '10'))
+    HTTP_DNS_CACHE_SECONDS = int(os.getenv('HTTP_DNS_CACHE_SECONDS', '300'))
+    HTTP_KEEPALIVE_SECONDS = float(os.getenv('HTTP_KEEPALIVE_SECONDS', '30'))
+    
     # Database
     DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///music_bot.db')
     
@@ -33,17 +60,45 @@ class Config:
     
     # مسیرها
     DATA_DIR = BASE_DIR / 'data'
-    DOWNLOADS_DIR = BASE_DIR / 'downloads'
+    # روی Render بهتره داخل دیسک پایدار باشه: /app/data/downloads
+    DOWNLOADS_DIR = Path(os.getenv('DOWNLOADS_DIR', str(BASE_DIR / 'downloads')))
     
     # فایل ژانرها
     GENRES_FILE = DATA_DIR / 'genres.json'
     
     # تنظیمات Scheduler
     SCHEDULER_TIMEZONE = DEFAULT_TIMEZONE
+    DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', '10'))  # ارسال همزمان در هر bucket
+    
+    # pool کاندیدهای هر ژانر (pre-warm قبل از ارسال روزانه)
+    GENRE_POOL_SIZE = 100
+    GENRE_POOL_TTL_MINUTES = int(os.getenv('GENRE_POOL_TTL_MINUTES', '180'))
+    PREWARM_LEAD_MINUTES = int(os.getenv('PREWARM_LEAD_MINUTES', '30'))
     
     # تنظیمات دانلود موزیک
     MAX_DOWNLOAD_SIZE_MB = 50  # حداکثر حجم دانلود (مگابایت)
     DOWNLOAD_QUALITY = 'bestaudio'  # کیفیت دانلود
+    # کش دیسک فایل‌های دانلود شده
+    DOWNLOAD_CACHE_MAX_MB = int(os.getenv('DOWNLOAD_CACHE_MAX_MB', '600'))
+    DOWNLOAD_CACHE_POLICY = os.getenv('DOWNLOAD_CACHE_POLICY', 'lru')  # lru یا lfu
+    DOWNLOAD_CACHE_SWEEP_MINUTES = int(os.getenv('DOWNLOAD_CACHE_SWEEP_MINUTES', '15'))
+    # آهنگ‌های کم‌محبوب (Spotify popularity) کش دیسک نمیشن و مستقیم استریم میشن
+    DOWNLOAD_STREAMING = os.getenv('DOWNLOAD_STREAMING', 'true').lower() == 'true'
+    DOWNLOAD_CACHE_MIN_POPULARITY = int(os.getenv('DOWNLOAD_CACHE_MIN_POPULARITY', '30'))
+    # بعد از چند ثانیه SoundCloud موازی با YouTube شروع بشه (منفی = زنجیره ترتیبی)
+    DOWNLOAD_HEDGE_DELAY = float(os.getenv('DOWNLOAD_HEDGE_DELAY', '25'))
+    # حداکثر اختلاف مدت زمان منبع با Spotify برای استفاده دوباره از نگاشت منبع
+    RESOLVE_DURATION_TOLERANCE_SECONDS = int(os.getenv('RESOLVE_DURATION_TOLERANCE_SECONDS', '15'))
+    # رتبه‌بندی کاندیدهای YouTube (فقط metadata) قبل از دانلود
+    DOWNLOAD_CANDIDATE_RANKING = os.getenv('DOWNLOAD_CANDIDATE_RANKING', 'true').lower() == 'true'
+    DOWNLOAD_CANDIDATES = int(os.getenv('DOWNLOAD_CANDIDATES', '8'))
+    CANDIDATE_MAX_DURATION_DELTA = int(os.getenv('CANDIDATE_MAX_DURATION_DELTA', '30'))  # ثانیه
+    CANDIDATE_MIN_SCORE = float(os.getenv('CANDIDATE_MIN_SCORE', '0.45'))
+    # حداکثر پروسه همزمان yt-dlp/ffmpeg و آستانه شلوغی صف
+    PROCESS_WORKERS = int(os.getenv('PROCESS_WORKERS', '3'))
+    PROCESS_QUEUE_SATURATION = int(os.getenv('PROCESS_QUEUE_SATURATION', '6'))
+    # library = worker های ماندگار yt-dlp، subprocess = یک پروسه برای هر تلاش
+    YTDLP_ENGINE = os.getenv('YTDLP_ENGINE', 'library')
     
     @classmethod
     def validate(cls):
@@ -56,7 +111,7 @@ class Config:
         
         # ساخت پوشه‌های لازم
         cls.DATA_DIR.mkdir(exist_ok=True)
-        cls.DOWNLOADS_DIR.mkdir(exist_ok=True)
+        cls.DOWNLOADS_DIR.mkdir(exist_ok=True, parents=True)
         
         print("✅ تنظیمات با موفقیت بارگذاری شد")
         return True
@@ -5,7 +5,7 @@ from datetime import datetime
 from typing import Optional
 from sqlalchemy import (
     create_engine, Column, Integer, String, Boolean, 
-    DateTime, ForeignKey, Text, Float
+    DateTime, ForeignKey, Text, Float, Index
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
@@ -92,6 +92,11 @@ class UserSettings(Base):
     last_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     user = relationship("User", back_populates="settings")
+    
+    __table_args__ = (
+        # bucket های زمان‌بندی روزانه (send_time IN ... AND timezone = ...)
+        Index('ix_user_settings_send_time', 'send_time', 'timezone'),
+    )
 
 
 class UserGenre(Base):
@@ -105,8 +110,9 @@ class UserGenre(Base):
     user = relationship("User", back_populates="genres")
     
     __table_args__ = (
+        Index('ix_user_genres_user_genre', 'user_id', 'genre'),
         {'sqlite_autoincrement': True}
-    ,)
+    )
 
 
 class SentTrack(Base):
@@ -120,6 +126,11 @@ class SentTrack(Base):
     sent_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="sent_tracks")
+    
+    __table_args__ = (
+        # آخرین آهنگ‌های ارسالی هر کاربر (ORDER BY sent_at DESC LIMIT 200)
+        Index('ix_sent_tracks_user_sent', 'user_id', 'sent_at'),
+    )
 
 
 class LikedTrack(Base):
@@ -136,6 +147,10 @@ class LikedTrack(Base):
     liked_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="liked_tracks")
+    
+    __table_args__ = (
+        Index('ix_liked_tracks_user_liked', 'user_id', 'liked_at'),
+    )
 
 
 class DownloadedTrack(Base):
@@ -152,20 +167,192 @@ class DownloadedTrack(Base):
     downloaded_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="downloaded_tracks")
+    
+    __table_args__ = (
+        Index('ix_downloaded_tracks_user_downloaded', 'user_id', 'downloaded_at'),
+    )
+
+
+class TrackFileCache(Base):
+    """file_id تلگرام برای هر آهنگ - هر آهنگ فقط یک بار آپلود میشه"""
+    __tablename__ = 'track_file_cache'
+    
+    track_id = Column(String(100), primary_key=True)  # Spotify track id
+    file_id = Column(String(255), nullable=False)
+    file_unique_id = Column(String(100), nullable=True)
+    file_size = Column(Integer, nullable=True)
+    uploaded_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+    use_count = Column(Integer, default=0)
+
+
+class AudioCacheEntry(Base):
+    """ایندکس فایل‌های دانلود شده در downloads/ (بجای اسکن پوشه)"""
+    __tablename__ = 'audio_cache'
+    
+    cache_key = Column(String(64), primary_key=True)  # sha1 از (Spotify id یا artist:title):کیفیت
+    track_id = Column(String(100), nullable=True, index=True)  # Spotify track id
+    lookup_key = Column(String(300), nullable=False, index=True)  # artist:title نرمال‌شده
+    quality = Column(String(10), nullable=True)  # high, medium, low
+    path = Column(String(500), nullable=False)
+    size_bytes = Column(Integer, nullable=False)
+    duration_ms = Column(Integer, nullable=True)
+    source = Column(String(20))  # youtube, soundcloud
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_access_at = Column(DateTime, default=datetime.utcnow)
+    access_count = Column(Integer, default=0)
+
+
+class ResolvedSource(Base):
+    """نگاشت Spotify track id به ویدیوی YouTube/SoundCloud انتخاب شده (بدون جستجوی دوباره)"""
+    __tablename__ = 'resolved_sources'
+    
+    track_id = Column(String(100), primary_key=True)  # Spotify track id
+    source = Column(String(20), nullable=False)  # youtube, soundcloud
+    video_id = Column(String(100), nullable=False)
+    url = Column(String(500), nullable=False)
+    format_id = Column(String(50), nullable=True)
+    quality = Column(String(10), nullable=True)  # کیفیتی که format_id باهاش انتخاب شد
+    source_duration_ms = Column(Integer, nullable=True)
+    spotify_duration_ms = Column(Integer, nullable=True)
+    duration_delta_ms = Column(Integer, nullable=True)
+    duration_match = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+    use_count = Column(Integer, default=0)
+
+
+class SpotifyCache(Base):
+    """کش پاسخ‌های Spotify Web API (TTL + LRU)"""
+    __tablename__ = 'spotify_cache'
+    
+    cache_key = Column(String(64), primary_key=True)  # sha1 از (path, query, type, market, limit)
+    path = Column(String(200))
+    response = Column(Text, nullable=False)  # JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    last_access_at = Column(DateTime, default=datetime.utcnow, index=True)
+    hit_count = Column(Integer, default=0)
 
 
 class LyricsCache(Base):
+    """کش پایدار متن آهنگ (لایه دوم بعد از LRU حافظه)"""
     __tablename__ = 'lyrics_cache'
     
-    spotify_id = Column(String(100), primary_key=True)
-    lyrics = Column(Text, nullable=False)
+    spotify_id = Column(String(100), primary_key=True)  # یا کلید artist:title اگر id نداریم
+    lookup_key = Column(String(300), index=True)  # artist:title نرمال‌شده (fallback)
+    lyrics = Column(Text, nullable=True)  # None = متن پیدا نشد (miss)
     cached_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True)
+
+
+class RecognitionCacheEntry(Base):
+    """کش نتیجه تشخیص آهنگ (بدون مصرف دوباره سهمیه ACRCloud)"""
+    __tablename__ = 'recognition_cache'
+    
+    cache_key = Column(String(100), primary_key=True)  # fp:<بیت‌ها>:<hex>، sha1:<hex> یا ig:<shortcode>
+    result = Column(Text, nullable=True)  # JSON؛ None = آهنگ تشخیص داده نشد
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    last_hit_at = Column(DateTime, nullable=True)
+    hit_count = Column(Integer, default=0)
+
+
+class SchemaMigration(Base):
+    """migration های اجرا شده روی این دیتابیس"""
+    __tablename__ = 'schema_migrations'
+    
+    version = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+
+def _create_missing_indexes(connection, *models):
+    """
+    ساخت index های تعریف شده روی مدل‌ها برای جداول موجود
+    
+    create_all فقط جدول جدید می‌سازه؛ index های اضافه شده به جدول قدیمی
+    اینجا (با checkfirst) ساخته میشن - روی SQLite و PostgreSQL.
+    """
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _migration_history_indexes(connection):
+    _create_missing_indexes(
+        connection,
+        SentTrack, DownloadedTrack, LikedTrack, UserGenre, UserSettings
+    )
+
+
+def _migration_audio_cache_quality(connection):
+    """
+    ستون quality در audio_cache (کیفیت جزء کلید فایل شده)
+    
+    ورودی‌های قدیمی quality ندارن و دیگه پیدا نمیشن؛ با eviction عادی
+    (LRU/LFU) از کش بیرون میرن.
+    """
+    from sqlalchemy import inspect, text
+    
+    columns = {c['name'] for c in inspect(connection).get_columns('audio_cache')}
+    if 'quality' not in columns:
+        connection.execute(text("ALTER TABLE audio_cache ADD COLUMN quality VARCHAR(10)"))
+
+
+# (نسخه، نام، تابع) - فقط به انتها اضافه کنید؛ هر نسخه یک بار اجرا میشه
+MIGRATIONS = [
+    (1, 'history_indexes', _migration_history_indexes),
+    (2, 'audio_cache_quality', _migration_audio_cache_quality),
+]
+
+
+def run_migrations():
+    """اجرای migration های اجرا نشده به ترتیب نسخه (هر کدام در یک transaction)"""
+    from sqlalchemy import select
+    
+    with engine.begin() as connection:
+        applied = set(connection.execute(select(SchemaMigration.version)).scalars())
+    
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(
+                SchemaMigration.__table__.insert().values(
+                    version=version,
+                    name=name,
+                    applied_at=datetime.utcnow()
+                )
+            )
+        print(f"🔄 migration {version} ({name}) اجرا شد")
+
+
+def _upgrade_lyrics_cache():
+    """
+    جدول lyrics_cache قدیمی (بدون lookup_key) هیچ‌وقت استفاده نشده بود؛
+    چون فقط کشه، دوباره ساخته میشه.
+    """
+    from sqlalchemy import inspect
+    
+    inspector = inspect(engine)
+    if 'lyrics_cache' not in inspector.get_table_names():
+        return
+    
+    columns = {c['name'] for c in inspector.get_columns('lyrics_cache')}
+    if 'lookup_key' not in columns:
+        LyricsCache.__table__.drop(engine)
+        print("🔄 جدول lyrics_cache به‌روزرسانی شد")
 
 
 def init_db():
     """ساخت تمام جداول"""
     try:
+        _upgrade_lyrics_cache()
         Base.metadata.create_all(engine)
+        run_migrations()
         print(f"✅ دیتابیس راه‌اندازی شد: {DATABASE_URL}")
     except Exception as e:
         print(f"❌ خطا در راه‌اندازی دیتابیس: {e}")
@@ -1,10 +1,16 @@
 """
 Scheduler برای ارسال خودکار روزانه موزیک
 """
+import asyncio
 import logging
+import time
+from collections import defaultdict
 from datetime import datetime, time as dt_time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
 import random
 import pytz
+from sqlalchemy import exists, func
 from telegram.ext import JobQueue, ContextTypes
 
 from core.database import SessionLocal, UserGenre, UserSettings
@@ -12,9 +18,25 @@ from core.config import config
 
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=None)
+def _get_timezone(timezone: str):
+    """کش pytz timezone"""
+    return pytz.timezone(timezone)
+
+
+def _normalize_send_time(send_time: str):
+    """'9:05' → (9, 5, '09:05')"""
+    hour, minute = map(int, send_time.split(':'))
+    return hour, minute, f"{hour:02d}:{minute:02d}"
+
 
 class MusicScheduler:
-    """کلاس مدیریت Scheduler با JobQueue"""
+    """
+    کلاس مدیریت Scheduler با JobQueue
+    
+    بجای یک job برای هر کاربر، برای هر دقیقه‌ی (send_time, timezone)
+    متمایز یک job ثبت میشه که همه کاربرانِ آن دقیقه رو با هم ارسال می‌کنه.
+    """
     
     def __init__(self, job_queue: JobQueue):
         self.job_queue = job_queue
@@ -22,7 +44,15 @@ class MusicScheduler:
     
     def start(self):
         logger.info("✅ Scheduler آماده است")
-
+    
+    @staticmethod
+    def _bucket_name(send_time: str, timezone: str) -> str:
+        return f'bucket_{timezone}_{send_time}'
+    
+    @staticmethod
+    def _prewarm_name(send_time: str, timezone: str) -> str:
+        return f'prewarm_{timezone}_{send_time}'
+    
     def add_or_update_user_job(
         self,
         user_id: int,
@@ -30,86 +60,286 @@ class MusicScheduler:
         timezone: str = 'Asia/Tehran'
     ):
         """
-        اضافه یا به‌روزرسانی job روزانه
+        اطمینان از وجود job دقیقه‌ی کاربر
+        
+        خود کاربر در job ثبت نمیشه؛ dispatcher موقع اجرا کاربران
+        آن دقیقه رو از دیتابیس می‌خونه.
         """
+        if self.ensure_bucket_job(send_time, timezone):
+            logger.info(f"✅ کاربر {user_id} در bucket {send_time} ({timezone}) قرار گرفت")
+    
+    def ensure_bucket_job(self, send_time: str, timezone: str) -> bool:
+        """ثبت job یک دقیقه (اگر قبلاً ثبت نشده)"""
         try:
-            hour, minute = map(int, send_time.split(':'))
-            job_id = f'user_{user_id}'
+            hour, minute, send_time = _normalize_send_time(send_time)
+            name = self._bucket_name(send_time, timezone)
             
-            # حذف job قبلی
-            existing_jobs = self.job_queue.get_jobs_by_name(job_id)
-            for job in existing_jobs:
-                job.schedule_removal()
+            if self.job_queue.get_jobs_by_name(name):
+                return True
             
             # ساخت time object با timezone
-            tz = pytz.timezone(timezone)
-            job_time = dt_time(hour=hour, minute=minute, tzinfo=tz)
+            job_time = dt_time(hour=hour, minute=minute, tzinfo=_get_timezone(timezone))
             
-            # اضافه کردن job (بدون tzinfo در parameters)
+            data = {'send_time': send_time, 'timezone': timezone}
             self.job_queue.run_daily(
-                callback=self.send_daily_music,
+                callback=self.dispatch_bucket,
                 time=job_time,
                 days=(0, 1, 2, 3, 4, 5, 6),
-                name=job_id,
-                data=user_id
+                name=name,
+                data=data
             )
             
-            logger.info(f"✅ Job روزانه برای کاربر {user_id} در {send_time} ({timezone}) تنظیم شد")
+            # pre-warm pool ژانرها چند دقیقه قبل از ارسال
+            lead = config.PREWARM_LEAD_MINUTES
+            if lead > 0:
+                prewarm_minutes = (hour * 60 + minute - lead) % (24 * 60)
+                self.job_queue.run_daily(
+                    callback=self.prewarm_bucket,
+                    time=dt_time(
+                        hour=prewarm_minutes // 60,
+                        minute=prewarm_minutes % 60,
+                        tzinfo=_get_timezone(timezone)
+                    ),
+                    days=(0, 1, 2, 3, 4, 5, 6),
+                    name=self._prewarm_name(send_time, timezone),
+                    data=data
+                )
+            
+            logger.info(f"⏰ bucket جدید: {send_time} ({timezone})")
+            return True
             
         except Exception as e:
-            logger.error(f"❌ خطا در تنظیم job برای کاربر {user_id}: {e}")
-
-    async def send_daily_music(self, context: ContextTypes.DEFAULT_TYPE):
-        """ارسال روزانه موزیک"""
-        user_id = context.job.data
-        logger.info(f"📤 ارسال روزانه موزیک برای کاربر {user_id}")
+            logger.error(f"❌ خطا در تنظیم bucket {send_time} ({timezone}): {e}")
+            return False
+    
+    def bootstrap_jobs(self) -> int:
+        """
+        بازسازی همه jobهای روزانه از دیتابیس (در استارتاپ)
+        
+        فقط (send_time, timezone)های متمایزِ کاربرانِ فعال خوانده میشه،
+        پس هزینه با تعداد زمان‌ها رشد می‌کنه نه تعداد کاربران.
+        
+        Returns:
+            تعداد bucketهای ثبت شده
+        """
+        started = time.perf_counter()
+        registered = 0
+        failed = 0
         
         db = SessionLocal()
         try:
-            genres = db.query(UserGenre).filter(UserGenre.user_id == user_id).all()
-            if not genres:
-                logger.warning(f"⚠️ هیچ ژانری برای کاربر {user_id} پیدا نشد")
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="⚠️ هیچ ژانری انتخاب نکردی!\n\nاز /start استفاده کن."
-                )
-                return
+            has_genre = exists().where(UserGenre.user_id == UserSettings.user_id)
+            timezone_col = func.coalesce(UserSettings.timezone, config.DEFAULT_TIMEZONE)
+            rows = db.query(
+                UserSettings.send_time,
+                timezone_col
+            ).filter(
+                UserSettings.auto_send_enabled.is_(True),
+                UserSettings.send_time.isnot(None),
+                has_genre
+            ).distinct().all()
             
-            genre = random.choice([g.genre for g in genres])
-            settings = db.query(UserSettings).filter(UserSettings.user_id == user_id).first()
+            # '9:00' و '09:00' یک bucket هستن (مثل _bucket_filters)
+            buckets = set()
+            for send_time, timezone in rows:
+                try:
+                    buckets.add((_normalize_send_time(send_time)[2], timezone))
+                except ValueError:
+                    logger.error(f"❌ زمان ارسال نامعتبر: {send_time!r} ({timezone})")
+                    failed += 1
             
-            if not settings:
+            for send_time, timezone in sorted(buckets):
+                if self.ensure_bucket_job(send_time, timezone):
+                    registered += 1
+                else:
+                    failed += 1
+                    
+        except Exception as e:
+            logger.error(f"❌ خطا در bootstrap jobها: {e}", exc_info=True)
+        finally:
+            db.close()
+        
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"✅ Bootstrap: {registered} bucket روزانه در {elapsed:.2f} ثانیه ثبت شد"
+            + (f" ({failed} ناموفق)" if failed else "")
+        )
+        return registered
+    
+    @staticmethod
+    def _bucket_filters(send_time: str, timezone: str) -> list:
+        """شرط‌های query برای کاربرانِ فعالِ یک bucket"""
+        hour, minute, send_time = _normalize_send_time(send_time)
+        # زمان‌های قدیمی ممکنه بدون صفر اول ذخیره شده باشن (9:30)
+        variants = {send_time, f"{hour}:{minute:02d}"}
+        return [
+            UserSettings.auto_send_enabled.is_(True),
+            UserSettings.send_time.in_(variants),
+            func.coalesce(UserSettings.timezone, config.DEFAULT_TIMEZONE) == timezone,
+        ]
+    
+    def _load_bucket_genres(self, send_time: str, timezone: str) -> List[str]:
+        """ژانرهای متمایزِ کاربرانِ یک bucket"""
+        db = SessionLocal()
+        try:
+            rows = db.query(UserGenre.genre).join(
+                UserSettings, UserGenre.user_id == UserSettings.user_id
+            ).filter(
+                *self._bucket_filters(send_time, timezone)
+            ).distinct().all()
+            return [genre for (genre,) in rows]
+        finally:
+            db.close()
+    
+    def _load_due_users(self, send_time: str, timezone: str) -> List[Dict[str, Any]]:
+        """همه کاربرانِ یک bucket با ژانرهاشون در یک query"""
+        db = SessionLocal()
+        try:
+            rows = db.query(
+                UserSettings.user_id,
+                UserSettings.send_to,
+                UserSettings.channel_id,
+                UserSettings.download_quality,
+                UserGenre.genre
+            ).join(
+                UserGenre, UserGenre.user_id == UserSettings.user_id
+            ).filter(
+                *self._bucket_filters(send_time, timezone)
+            ).all()
+        finally:
+            db.close()
+        
+        users: Dict[int, Dict[str, Any]] = {}
+        for user_id, send_to, channel_id, quality, genre in rows:
+            entry = users.setdefault(user_id, {
+                'user_id': user_id,
+                'send_to': send_to,
+                'channel_id': channel_id if send_to == 'channel' else None,
+                'quality': quality,
+                'genres': [],
+            })
+            entry['genres'].append(genre)
+        
+        return list(users.values())
+    
+    async def prewarm_bucket(self, context: ContextTypes.DEFAULT_TYPE):
+        """آماده‌سازی pool ژانرهای یک bucket قبل از ارسال"""
+        from services.spotify import spotify_service
+        
+        send_time = context.job.data['send_time']
+        timezone = context.job.data['timezone']
+        started = time.perf_counter()
+        
+        try:
+            genres = self._load_bucket_genres(send_time, timezone)
+            if not genres:
                 return
             
-            send_to = settings.send_to
-            channel_id = settings.channel_id if send_to == 'channel' else None
-            
-            from services.music_sender import send_music_to_user
-            success = await send_music_to_user(
-                bot=context.bot,
-                user_id=user_id,
-                genre=genre,
-                send_to=send_to,
-                channel_id=channel_id,
-                download_file=True
+            # pool باید تا لحظه ارسال (و کمی بعدش) معتبر بمونه
+            ready = await spotify_service.prewarm_genre_pools(
+                genres,
+                valid_for=(config.PREWARM_LEAD_MINUTES + 5) * 60
             )
             
-            if success:
-                logger.info(f"✅ موزیک روزانه ارسال شد")
-            else:
-                logger.warning(f"⚠️ ارسال ناموفق")
-                
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"🔥 pre-warm bucket {send_time} ({timezone}): "
+                f"{ready}/{len(genres)} ژانر در {elapsed:.1f} ثانیه"
+            )
         except Exception as e:
-            logger.error(f"❌ خطا در ارسال روزانه: {e}")
+            logger.error(f"❌ خطا در pre-warm bucket {send_time}: {e}")
+    
+    async def dispatch_bucket(self, context: ContextTypes.DEFAULT_TYPE):
+        """ارسال روزانه برای همه کاربرانِ یک دقیقه"""
+        from services.spotify import spotify_service, get_recent_sent_track_ids
+        
+        send_time = context.job.data['send_time']
+        timezone = context.job.data['timezone']
+        started = time.perf_counter()
+        
+        users = self._load_due_users(send_time, timezone)
+        if not users:
+            logger.info(f"⏰ bucket {send_time} ({timezone}) خالیه - حذف میشه")
+            context.job.schedule_removal()
+            for job in self.job_queue.get_jobs_by_name(self._prewarm_name(send_time, timezone)):
+                job.schedule_removal()
+            return
+        
+        logger.info(f"📤 ارسال روزانه bucket {send_time} ({timezone}): {len(users)} کاربر")
+        
+        # گروه‌بندی بر اساس ژانر انتخابی هر کاربر
+        groups: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for user in users:
+            groups[random.choice(user['genres'])].append(user)
+        
+        # pool هر ژانر (معمولاً از pre-warm آماده است)
+        genres = list(groups)
+        pools = await asyncio.gather(
+            *(spotify_service.get_genre_pool(genre) for genre in genres),
+            return_exceptions=True
+        )
+        
+        sent_ids = get_recent_sent_track_ids([u['user_id'] for u in users])
+        
+        semaphore = asyncio.Semaphore(config.DISPATCH_CONCURRENCY)
+        tasks = []
+        for genre, pool in zip(genres, pools):
+            if isinstance(pool, Exception):
+                logger.error(f"❌ خطا در جستجوی ژانر {genre}: {pool}")
+                pool = []
+            for user in groups[genre]:
+                track = spotify_service.pick_random_track(pool, sent_ids.get(user['user_id']))
+                tasks.append(self._send_to_user(context.bot, semaphore, user, genre, track))
+        
+        results = await asyncio.gather(*tasks)
+        
+        elapsed = time.perf_counter() - started
+        logger.info(
+            f"✅ bucket {send_time} ({timezone}): {sum(results)}/{len(results)} موفق "
+            f"در {elapsed:.1f} ثانیه ({len(genres)} ژانر)"
+        )
+    
+    async def _send_to_user(
+        self,
+        bot,
+        semaphore: asyncio.Semaphore,
+        user: Dict[str, Any],
+        genre: str,
+        track: Optional[Dict[str, Any]]
+    ) -> bool:
+        """ارسال به یک کاربر با محدودیت همزمانی"""
+        from services.music_sender import send_music_to_user
+        from services.process_pool import PRIORITY_SCHEDULED
+        
+        user_id = user['user_id']
+        
+        async with semaphore:
             try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text="❌ متأسفانه نتونستم امروز موزیک بفرستم!\n\nفردا دوباره امتحان می‌کنم 🎵"
+                if not track:
+                    raise LookupError(f"آهنگی برای ژانر {genre} پیدا نشد")
+                
+                return await send_music_to_user(
+                    bot=bot,
+                    user_id=user_id,
+                    genre=genre,
+                    send_to=user['send_to'],
+                    channel_id=user['channel_id'],
+                    download_file=True,
+                    track_info=track,
+                    priority=PRIORITY_SCHEDULED,
+                    quality=user['quality']
                 )
-            except:
-                pass
-        finally:
-            db.close()
+                
+            except Exception as e:
+                logger.error(f"❌ خطا در ارسال روزانه به {user_id}: {e}")
+                try:
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text="❌ متأسفانه نتونستم امروز موزیک بفرستم!\n\nفردا دوباره امتحان می‌کنم 🎵"
+                    )
+                except:
+                    pass
+                return False
 
 
 def setup_scheduler(job_queue: JobQueue) -> MusicScheduler:
@@ -130,8 +360,9 @@ def schedule_user_daily_music_helper(user_id: int, scheduler: MusicScheduler):
         if not settings or not settings.send_time:
             return
         
+        # کاربر غیرفعال یا بدون ژانر خودبه‌خود در dispatch حذف میشه
         genres = db.query(UserGenre).filter(UserGenre.user_id == user_id).all()
-        if not genres:
+        if not genres or not settings.auto_send_enabled:
             return
         
         scheduler.add_or_update_user_job(
@@ -143,4 +374,4 @@ def schedule_user_daily_music_helper(user_id: int, scheduler: MusicScheduler):
     except Exception as e:
         logger.error(f"❌ خطا در schedule کردن: {e}")
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+بررسی query plan کوئری‌های پرتکرار (تاریخچه، ژانرها، زمان‌بندی)
+
+هر کوئری دقیقاً همان شکلی ساخته میشه که در کد اجرا میشه و EXPLAIN اون
+روی دیتابیس فعلی (DATABASE_URL) چاپ میشه. اگر روی جداول پرتکرار full
+scan دیده بشه، خروجی با کد 1 تمام میشه.
+
+    python explain_queries.py
+
+روی PostgreSQL برای این بررسی enable_seqscan خاموش میشه؛ چون روی جدول‌های
+کوچک planner حتی با وجود index هم Seq Scan رو انتخاب می‌کنه.
+"""
+import sys
+
+from sqlalchemy import func, text
+
+from core.config import config
+from core.database import (
+    engine, init_db, SessionLocal,
+    SentTrack, LikedTrack, DownloadedTrack, UserGenre, UserSettings
+)
+
+HOT_TABLES = {
+    'sent_tracks', 'liked_tracks', 'downloaded_tracks', 'user_genres', 'user_settings',
+}
+
+SAMPLE_USER_ID = 1
+SAMPLE_USER_IDS = [1, 2, 3]
+SAMPLE_SEND_TIME = '09:00'
+
+
+def _bucket_filters():
+    # همان MusicScheduler._bucket_filters (بدون import زمان‌بند و تلگرام)
+    return [
+        UserSettings.auto_send_enabled.is_(True),
+        UserSettings.send_time.in_({SAMPLE_SEND_TIME, '9:00'}),
+        func.coalesce(UserSettings.timezone, config.DEFAULT_TIMEZONE) == config.DEFAULT_TIMEZONE,
+    ]
+
+
+def build_queries(db) -> dict:
+    """کوئری‌های پرتکرار (ORM) به تفکیک محل استفاده"""
+    row_number = func.row_number().over(
+        partition_by=SentTrack.user_id,
+        order_by=SentTrack.sent_at.desc()
+    ).label('rn')
+    recent = db.query(
+        SentTrack.user_id, SentTrack.track_id, row_number
+    ).filter(SentTrack.user_id.in_(SAMPLE_USER_IDS)).subquery()
+
+    return {
+        'spotify.get_random_track_for_user': db.query(SentTrack).filter(
+            SentTrack.user_id == SAMPLE_USER_ID
+        ).order_by(SentTrack.sent_at.desc()).limit(200),
+
+        'spotify.get_recent_sent_track_ids': db.query(
+            recent.c.user_id, recent.c.track_id
+        ).filter(recent.c.rn <= 200),
+
+        'main_menu.show_liked_tracks': db.query(LikedTrack).filter(
+            LikedTrack.user_id == SAMPLE_USER_ID
+        ).order_by(LikedTrack.liked_at.desc()).limit(20),
+
+        'main_menu.show_download_history': db.query(DownloadedTrack).filter(
+            DownloadedTrack.user_id == SAMPLE_USER_ID
+        ).order_by(DownloadedTrack.downloaded_at.desc()).limit(15),
+
+        'user_genres (settings/genre/main_menu)': db.query(UserGenre).filter(
+            UserGenre.user_id == SAMPLE_USER_ID
+        ),
+
+        'scheduler._load_bucket_genres': db.query(UserGenre.genre).join(
+            UserSettings, UserGenre.user_id == UserSettings.user_id
+        ).filter(*_bucket_filters()).distinct(),
+
+        'scheduler._load_due_users': db.query(
+            UserSettings.user_id,
+            UserSettings.send_to,
+            UserSettings.channel_id,
+            UserSettings.download_quality,
+            UserGenre.genre
+        ).join(
+            UserGenre, UserGenre.user_id == UserSettings.user_id
+        ).filter(*_bucket_filters()),
+    }
+
+
+def _compile(query) -> str:
+    return str(query.statement.compile(
+        dialect=engine.dialect,
+        compile_kwargs={'literal_binds': True}
+    ))
+
+
+def _full_scans(plan_lines: list) -> list:
+    """خط‌هایی از plan که کل یک جدول پرتکرار رو می‌خونن"""
+    scans = []
+    for line in plan_lines:
+        if engine.dialect.name == 'sqlite':
+            # "SCAN sent_tracks" یا "SCAN sent_tracks USING COVERING INDEX ..." (بدون شرط)
+            words = line.split()
+            if len(words) >= 2 and words[0] == 'SCAN' and words[1] in HOT_TABLES:
+                scans.append(line)
+        elif 'Seq Scan on' in line:
+            table = line.split('Seq Scan on', 1)[1].split()[0]
+            if table in HOT_TABLES:
+                scans.append(line)
+    return scans
+
+
+def explain(connection, sql: str) -> list:
+    if engine.dialect.name == 'sqlite':
+        rows = connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")).fetchall()
+        return [row[-1] for row in rows]
+    rows = connection.execute(text(f"EXPLAIN {sql}")).fetchall()
+    return [row[0] for row in rows]
+
+
+def main() -> int:
+    init_db()
+    print(f"🗄️ {engine.dialect.name}: {engine.url.render_as_string(hide_password=True)}\n")
+
+    db = SessionLocal()
+    problems = 0
+    try:
+        queries = build_queries(db)
+        with engine.connect() as connection:
+            if engine.dialect.name == 'postgresql':
+                connection.execute(text("SET enable_seqscan TO off"))
+
+            for name, query in queries.items():
+                plan = explain(connection, _compile(query))
+                scans = _full_scans(plan)
+                problems += bool(scans)
+
+                print(f"{'❌' if scans else '✅'} {name}")
+                for line in plan:
+                    print(f"     {line}")
+                print()
+    finally:
+        db.close()
+
+    if problems:
+        print(f"⚠️ {problems} کوئری هنوز full scan روی جداول پرتکرار دارن")
+        return 1
+    print("✅ هیچ full scan روی جداول پرتکرار نیست")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
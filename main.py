@@ -40,11 +40,38 @@ async def health_check(request):
     return web.Response(text="Bot is running!", status=200)
 
 
+async def stats_handler(request):
+    """Endpoint برای آمار کش‌ها"""
+    from services.spotify import spotify_service
+    from services.music_sender import delivery_timings
+    from services.downloader import music_downloader
+    from services.process_pool import process_pool
+    from services.ytdlp_engine import ytdlp_engine
+    from services.http_client import http_client
+    from services.music_recognition import recognition_service
+    from services.temp_workspace import temp_workspaces
+    
+    return web.json_response({
+        'spotify_cache': spotify_service.cache.stats(),
+        'delivery': delivery_timings.stats(),
+        'downloads': music_downloader.single_flight.stats(),
+        'audio_formats': music_downloader.format_stats,
+        'source_resolution': music_downloader.resolver.stats(),
+        'candidate_ranking': music_downloader.ranking_stats,
+        'process_pool': process_pool.stats(),
+        'ytdlp_engine': ytdlp_engine.stats(),
+        'http': http_client.stats(),
+        'recognition': recognition_service.cache.stats(),
+        'temp_workspaces': temp_workspaces.stats(),
+    })
+
+
 async def start_health_server():
     """راه‌اندازی HTTP server برای health check"""
     app = web.Application()
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/stats', stats_handler)
     
     port = int(os.getenv('PORT', 8080))
     runner = web.AppRunner(app)
@@ -152,12 +179,6 @@ async def status_command(update: Update, context):
         db.close()
 
 
-async def post_init(application: Application):
-    """بعد از راه‌اندازی"""
-    logger.info("🤖 ربات آماده است!")
-    logger.info(f"👤 Bot Username: @{application.bot.username}")
-
-
 def create_application():
     """ساخت Application با تنظیمات بهتر"""
     return Application.builder() \
@@ -223,17 +244,39 @@ async def main_async():
     logger.info("⏰ راه‌اندازی Scheduler...")
     scheduler = setup_scheduler(app.job_queue)
     app.bot_data['scheduler'] = scheduler
-    logger.info("✅ Scheduler OK")
+    scheduler.bootstrap_jobs()
     
-    app.post_init = post_init
+    from services.downloader import download_cache_maintenance_job
+    app.job_queue.run_repeating(
+        download_cache_maintenance_job,
+        interval=config.DOWNLOAD_CACHE_SWEEP_MINUTES * 60,
+        first=60,
+        name='download_cache_maintenance'
+    )
+    
+    from services.temp_workspace import temp_janitor_job
+    app.job_queue.run_repeating(
+        temp_janitor_job,
+        interval=config.TEMP_JANITOR_MINUTES * 60,
+        first=120,
+        name='temp_janitor'
+    )
+    logger.info("✅ Scheduler OK")
     
     logger.info("="*60)
     logger.info("✅ تمام تنظیمات کامل شد!")
     logger.info("🎵 نسخه 2.0 - با موزیک فارسی و جستجو")
     logger.info("="*60)
     
+    # session مشترک HTTP قبل از اولین update
+    # (post_init فقط از run_polling/run_webhook صدا زده میشه، نه اینجا)
+    from services.http_client import http_client
+    await http_client.start()
+    
     # اجرای bot
     await app.initialize()
+    logger.info("🤖 ربات آماده است!")
+    logger.info(f"👤 Bot Username: @{app.bot.username}")
     await app.start()
     await app.updater.start_polling(
         allowed_updates=Update.ALL_TYPES,
@@ -251,6 +294,11 @@ async def main_async():
         await app.updater.stop()
         await app.stop()
         await app.shutdown()
+        
+        from services.http_client import http_client
+        from services.ytdlp_engine import ytdlp_engine
+        await http_client.close()
+        await ytdlp_engine.close()
 
 
 def main():
@@ -2,26 +2,529 @@
 Music Downloader - نسخه بهبود یافته با حل مشکل دانلود ناقص
 """
 import os
+import re
+import json
 import logging
 import asyncio
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 import hashlib
-import aiohttp
+import uuid
 import aiofiles
 
 from core.config import config
+from services.http_client import http_client
+from services.process_pool import process_pool
+from services.ytdlp_engine import ytdlp_engine, YtdlpEngineError
+from services.source_ranking import CANDIDATE_FIELDS, rank_candidates
 
 logger = logging.getLogger(__name__)
 
 
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'
+
+# پروفایل‌های کیفیت (UserSettings.download_quality)
+# format: انتخاب yt-dlp - m4a (AAC) اولویت داره چون تلگرام بدون تبدیل قبولش می‌کنه
+# transcode: آرگومان‌های ffmpeg فقط وقتی منبع قابل ارسال نیست (مثلاً opus/webm)
+# stream: فرمت مسیر استریم (فقط m4a، چون روی stdout تبدیلی انجام نمیشه)
+QUALITY_PROFILES = {
+    'high': {
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'transcode': ['-q:a', '0'],
+        'stream': 'bestaudio[ext=m4a]',
+    },
+    'medium': {
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'transcode': ['-b:a', '192k'],
+        'stream': 'bestaudio[ext=m4a]',
+    },
+    'low': {
+        'format': 'bestaudio[ext=m4a][abr<=96]/worstaudio[ext=m4a]/worstaudio/bestaudio',
+        'transcode': ['-b:a', '96k'],
+        'stream': 'bestaudio[ext=m4a][abr<=96]/worstaudio[ext=m4a]',
+    },
+}
+DEFAULT_QUALITY = 'high'
+
+# فرمت‌هایی که send_audio تلگرام مستقیم پخش می‌کنه
+SENDABLE_AUDIO_EXTS = {'.mp3', '.m4a'}
+TEMP_DOWNLOAD_EXTS = {'.part', '.ytdl', '.temp'}
+
+# مشخصات منبع انتخاب شده بعد از دانلود (JSON روی stdout)
+RESOLUTION_PRINT = 'after_move:%(.{id,webpage_url,extractor_key,format_id,duration})j'
+
+# هر بار حداکثر این مقدار از stdout خونده میشه (بافر محدود استریم)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class DownloadStreamError(Exception):
+    """استریم ناقص یا ناموفق - آپلود در جریان باید لغو بشه"""
+
+
+def sniff_audio_container(header: bytes) -> Tuple[str, str]:
+    """
+    پسوند و mime type واقعی استریم از روی بایت‌های اول
+    
+    Returns:
+        (پسوند, mime type) - پیش‌فرض m4a چون فرمت استریم m4a انتخاب میشه
+    """
+    if header[4:8] == b'ftyp':
+        return 'm4a', 'audio/mp4'
+    if header.startswith(b'ID3'):
+        return 'mp3', 'audio/mpeg'
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        # frame sync مشترکه؛ layer صفر یعنی ADTS (AAC خام)
+        if header[1] & 0x06 == 0:
+            return 'aac', 'audio/aac'
+        return 'mp3', 'audio/mpeg'
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'webm', 'audio/webm'
+    if header.startswith(b'OggS'):
+        return 'ogg', 'audio/ogg'
+    return 'm4a', 'audio/mp4'
+
+
+class AudioStream:
+    """chunk های یک استریم همراه پسوند و mime type واقعی‌اش"""
+    
+    def __init__(self, chunks: AsyncIterator[bytes], header: bytes):
+        self.chunks = chunks
+        self.ext, self.mime_type = sniff_audio_container(header)
+    
+    def __aiter__(self):
+        return self.chunks.__aiter__()
+
+
+def normalize_quality(quality: Optional[str]) -> str:
+    """اسم پروفایل کیفیت (مقدار نامعتبر/خالی → DEFAULT_QUALITY)"""
+    return quality if quality in QUALITY_PROFILES else DEFAULT_QUALITY
+
+
+def quality_profile(quality: Optional[str]) -> Dict[str, Any]:
+    return QUALITY_PROFILES[normalize_quality(quality)]
+
+
+def ytdlp_audio_options(output_template: str, quality: Optional[str] = None, **extra) -> Dict[str, Any]:
+    """
+    گزینه‌های کتابخانه yt-dlp معادل --extract-audio --audio-format best
+    (صدا بدون re-encode از ویدیو جدا میشه)
+    """
+    options = {
+        'format': quality_profile(quality)['format'],
+        'outtmpl': output_template,
+        'noplaylist': True,
+        'quiet': True,
+        'no_warnings': True,
+        'nocheckcertificate': True,
+        'socket_timeout': 30,
+        'retries': 5,
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'best',
+        }],
+        'postprocessor_args': {'ffmpeg': ['-y']},
+    }
+    options.update(extra)
+    return options
+
+
+def youtube_watch_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+
+def normalize_lookup_key(track_name: str, artist_name: str) -> str:
+    """کلید artist:title نرمال‌شده (مستقل از متن جستجو)"""
+    raw = f"{artist_name}:{track_name}".lower()
+    return re.sub(r'\s+', ' ', raw).strip()[:300]
+
+
+class AudioIndex:
+    """
+    ایندکس فایل‌های صوتی در جدول audio_cache
+    
+    هر آهنگ (با Spotify id یا artist:title) در هر کیفیت یک فایل با اسم
+    ثابت track_<hash>.mp3 داره؛ lookup با کلید اصلی انجام میشه و فقط
+    یک stat روی همان فایل لازمه. پسوند فایل (mp3/m4a) حفظ میشه.
+    """
+    
+    def __init__(self, download_dir: Path):
+        self.download_dir = download_dir
+    
+    @staticmethod
+    def make_cache_key(track_id: Optional[str], lookup_key: str, quality: Optional[str] = None) -> str:
+        raw = f"{track_id or lookup_key}:{normalize_quality(quality)}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    
+    def lookup(self, track_id: Optional[str], lookup_key: str,
+               quality: Optional[str] = None) -> Optional[str]:
+        """مسیر فایل کش شده (با همین کیفیت) یا None"""
+        from core.database import SessionLocal, AudioCacheEntry
+        
+        db = SessionLocal()
+        try:
+            entry = None
+            if track_id:
+                entry = db.get(AudioCacheEntry, self.make_cache_key(track_id, lookup_key, quality))
+            if not entry:
+                entry = db.query(AudioCacheEntry).filter(
+                    AudioCacheEntry.lookup_key == lookup_key,
+                    AudioCacheEntry.quality == normalize_quality(quality)
+                ).first()
+            if not entry:
+                return None
+            
+            if not os.path.exists(entry.path):
+                # فایل از بیرون پاک شده
+                db.delete(entry)
+                db.commit()
+                return None
+            
+            entry.last_access_at = datetime.utcnow()
+            entry.access_count = (entry.access_count or 0) + 1
+            db.commit()
+            return entry.path
+            
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در خواندن ایندکس دانلود: {e}")
+            return None
+        finally:
+            db.close()
+    
+    def contains(self, track_id: Optional[str], lookup_key: str,
+                 quality: Optional[str] = None) -> bool:
+        """فایل آهنگ (با همین کیفیت) روی دیسک هست؟ (بدون ثبت دسترسی در آمار LRU/LFU)"""
+        from core.database import SessionLocal, AudioCacheEntry
+        
+        db = SessionLocal()
+        try:
+            path = None
+            if track_id:
+                path = db.query(AudioCacheEntry.path).filter(
+                    AudioCacheEntry.cache_key == self.make_cache_key(track_id, lookup_key, quality)
+                ).scalar()
+            if not path:
+                path = db.query(AudioCacheEntry.path).filter(
+                    AudioCacheEntry.lookup_key == lookup_key,
+                    AudioCacheEntry.quality == normalize_quality(quality)
+                ).limit(1).scalar()
+            return bool(path) and os.path.exists(path)
+            
+        except Exception as e:
+            logger.debug(f"⚠️ خطا در خواندن ایندکس دانلود: {e}")
+            return False
+        finally:
+            db.close()
+    
+    def record(
+        self,
+        file_path: str,
+        track_id: Optional[str],
+        lookup_key: str,
+        source: str,
+        duration_ms: Optional[int] = None,
+        quality: Optional[str] = None
+    ) -> str:
+        """
+        انتقال فایل به اسم ثابت آهنگ و ثبت در ایندکس
+        
+        Returns:
+            مسیر نهایی فایل
+        """
+        from core.database import SessionLocal, AudioCacheEntry
+        
+        cache_key = self.make_cache_key(track_id, lookup_key, quality)
+        final_path = self.download_dir / f"track_{cache_key[:16]}{Path(file_path).suffix}"
+        
+        try:
+            if Path(file_path) != final_path:
+                os.replace(file_path, final_path)
+        except OSError as e:
+            logger.warning(f"⚠️ خطا در انتقال فایل به کش: {e}")
+            final_path = Path(file_path)
+        
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.merge(AudioCacheEntry(
+                cache_key=cache_key,
+                track_id=track_id,
+                lookup_key=lookup_key,
+                quality=normalize_quality(quality),
+                path=str(final_path),
+                size_bytes=final_path.stat().st_size,
+                duration_ms=duration_ms,
+                source=source,
+                created_at=now,
+                last_access_at=now,
+                access_count=0
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"⚠️ خطا در ثبت ایندکس دانلود: {e}")
+        finally:
+            db.close()
+        
+        return str(final_path)
+    
+    def indexed_paths(self) -> set:
+        """مسیر همه فایل‌های ایندکس شده"""
+        from core.database import SessionLocal, AudioCacheEntry
+        
+        db = SessionLocal()
+        try:
+            return {path for (path,) in db.query(AudioCacheEntry.path)}
+        finally:
+            db.close()
+    
+    def evict_to_budget(self, max_bytes: int, policy: str = 'lru',
+                        limit: int = 50) -> Tuple[int, int]:
+        """
+        حذف حداکثر limit فایل تا وقتی حجم کل کش زیر max_bytes بیاد
+        
+        lru: کم‌استفاده‌ترین از نظر زمان دسترسی اول حذف میشه
+        lfu: کمترین تعداد دسترسی اول (و بین مساوی‌ها قدیمی‌تر)
+        
+        Returns:
+            (تعداد فایل حذف شده, بایت آزاد شده)
+        """
+        from sqlalchemy import func
+        from core.database import SessionLocal, AudioCacheEntry
+        
+        db = SessionLocal()
+        try:
+            total = db.query(func.coalesce(func.sum(AudioCacheEntry.size_bytes), 0)).scalar()
+            if total <= max_bytes:
+                return 0, 0
+            
+            if policy == 'lfu':
+                order = (AudioCacheEntry.access_count.asc(), AudioCacheEntry.last_access_at.asc())
+            else:
+                order = (AudioCacheEntry.last_access_at.asc(),)
+            
+            removed = 0
+            freed = 0
+            for entry in db.query(AudioCacheEntry).order_by(*order).limit(limit).all():
+                if total - freed <= max_bytes:
+                    break
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"⚠️ حذف {entry.path} ناموفق: {e}")
+                    continue
+                freed += entry.size_bytes or 0
+                removed += 1
+                db.delete(entry)
+            
+            db.commit()
+            return removed, freed
+            
+        except Exception as e:
+            db.rollback()
+            logger.error(f"❌ خطا در eviction کش دانلود: {e}")
+            return 0, 0
+        finally:
+            db.close()
+    
+    def forget(self, file_path: str):
+        """حذف ورودی‌های یک فایل از ایندکس"""
+        from core.database import SessionLocal, AudioCacheEntry
+        
+        db = SessionLocal()
+        try:
+            db.query(AudioCacheEntry).filter(
+                AudioCacheEntry.path == file_path
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در حذف از ایندکس دانلود: {e}")
+        finally:
+            db.close()
+
+
+class SourceResolver:
+    """
+    نگاشت پایدار Spotify track id به ویدیوی YouTube/SoundCloud (جدول resolved_sources)
+    
+    بعد از هر دانلود موفق، id/URL منبع، فرمت انتخاب شده و اختلاف مدت زمان
+    با duration_ms اسپاتیفای ثبت میشه؛ دانلودهای بعدی (مثلاً بعد از eviction)
+    مستقیم از همان URL انجام میشن. نگاشت‌هایی که مدت زمانشون نمی‌خونه
+    ثبت میشن ولی استفاده نمیشن.
+    """
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+    
+    def lookup(self, track_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """نگاشت معتبر برای آهنگ یا None"""
+        if not track_id:
+            return None
+        
+        from core.database import SessionLocal, ResolvedSource
+        
+        db = SessionLocal()
+        try:
+            entry = db.get(ResolvedSource, track_id)
+            if not entry or not entry.duration_match:
+                self.misses += 1
+                return None
+            
+            entry.last_used_at = datetime.utcnow()
+            entry.use_count = (entry.use_count or 0) + 1
+            db.commit()
+            self.hits += 1
+            return {
+                'source': entry.source,
+                'video_id': entry.video_id,
+                'url': entry.url,
+                'format_id': entry.format_id,
+                'quality': entry.quality,
+            }
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در خواندن نگاشت منبع: {e}")
+            return None
+        finally:
+            db.close()
+    
+    def record(
+        self,
+        track_id: str,
+        source: str,
+        info: Dict[str, Any],
+        duration_ms: Optional[int],
+        quality: Optional[str]
+    ):
+        """ثبت منبع دانلود شده با مقایسه مدت زمان"""
+        from core.database import SessionLocal, ResolvedSource
+        
+        if not info.get('id') or not info.get('webpage_url'):
+            return
+        
+        source_duration_ms = int(info['duration'] * 1000) if info.get('duration') else None
+        if source_duration_ms and duration_ms:
+            delta = source_duration_ms - duration_ms
+            matched = abs(delta) <= config.RESOLVE_DURATION_TOLERANCE_SECONDS * 1000
+        else:
+            delta = None
+            matched = source_duration_ms is not None
+        
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.merge(ResolvedSource(
+                track_id=track_id,
+                source=source,
+                video_id=str(info['id']),
+                url=info['webpage_url'],
+                format_id=info.get('format_id'),
+                quality=quality or DEFAULT_QUALITY,
+                source_duration_ms=source_duration_ms,
+                spotify_duration_ms=duration_ms,
+                duration_delta_ms=delta,
+                duration_match=matched,
+                created_at=now,
+                last_used_at=now,
+                use_count=0
+            ))
+            db.commit()
+            if not matched:
+                logger.warning(f"⚠️ مدت زمان منبع با Spotify نمی‌خونه ({delta} ms) - {info['webpage_url']}")
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"⚠️ خطا در ثبت نگاشت منبع: {e}")
+        finally:
+            db.close()
+    
+    def forget(self, track_id: str):
+        """حذف نگاشتی که دیگه کار نمی‌کنه (ویدیو حذف شده)"""
+        from core.database import SessionLocal, ResolvedSource
+        
+        db = SessionLocal()
+        try:
+            db.query(ResolvedSource).filter(
+                ResolvedSource.track_id == track_id
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در حذف نگاشت منبع: {e}")
+        finally:
+            db.close()
+    
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class SingleFlight:
+    """
+    جلوگیری از دانلود همزمان یک آهنگ: درخواست‌های همزمان با کلید یکسان
+    منتظر یک task مشترک می‌مونن (لغو شدن یک منتظر، task رو لغو نمی‌کنه)
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.deduplicated = 0
+    
+    def _release(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            self._waiters.pop(key, None)
+    
+    async def run(self, key: str, factory: Callable[[], Awaitable]):
+        """اجرای factory یا پیوستن به اجرای در جریان"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t, k=key: self._release(k, t))
+        else:
+            self.deduplicated += 1
+            logger.info(f"🔗 دانلود در جریانه - منتظر نتیجه مشترک ({key})")
+        
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """تعداد دانلودهای در جریان و منتظرهاشون"""
+        return {
+            'inflight': len(self._inflight),
+            'waiters': sum(self._waiters.values()),
+            'per_track': dict(self._waiters),
+            'deduplicated': self.deduplicated,
+        }
+
+
 class MusicDownloader:
     """دانلودر موزیک از چند منبع - با فیلتر حجم فایل"""
     
+    # تعداد فایل در هر دسته eviction
+    EVICT_BATCH = 50
+    
     def __init__(self):
         self.download_dir = config.DOWNLOADS_DIR
-        self.download_dir.mkdir(exist_ok=True)
+        self.download_dir.mkdir(exist_ok=True, parents=True)
+        self.index = AudioIndex(self.download_dir)
+        self.single_flight = SingleFlight()
+        self.format_stats = {'passthrough': 0, 'transcoded': 0, 'streamed': 0}
+        self.ranking_stats = {'searches': 0, 'no_match': 0, 'downloaded': 0}
+        self.resolver = SourceResolver()
+        # مشخصات منبع هر فایل دانلود شده تا وقتی در ایندکس ثبت بشه
+        self._resolutions: Dict[str, Dict[str, Any]] = {}
         self._check_ytdlp()
         logger.info("✅ Downloader راه‌اندازی شد")
     
@@ -40,13 +543,362 @@ class MusicDownloader:
         except Exception as e:
             logger.error(f"❌ مشکل در yt-dlp: {e}")
     
+    async def _run_process(
+        self,
+        cmd: list,
+        timeout: float,
+        cleanup_prefix: Optional[str] = None
+    ) -> Tuple[int, bytes, bytes]:
+        """
+        اجرای yt-dlp/ffmpeg داخل صف سراسری پروسه‌ها؛ در timeout یا لغو
+        (cancel) پروسه kill میشه و فایل‌های نیمه‌کاره با cleanup_prefix پاک میشن
+        """
+        async with process_pool.slot():
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(),
+                    timeout=timeout
+                )
+                return process.returncode, stdout, stderr
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                try:
+                    process.kill()
+                    await process.wait()
+                except ProcessLookupError:
+                    pass
+                if cleanup_prefix:
+                    self._remove_partial_files(cleanup_prefix)
+                raise
+    
+    async def _run_ytdlp(
+        self,
+        target: str,
+        options: Dict[str, Any],
+        cmd: list,
+        timeout: float,
+        cleanup_prefix: Optional[str] = None,
+        mode: str = 'download'
+    ) -> Tuple[int, Optional[Dict[str, Any]], bytes]:
+        """
+        اجرای yt-dlp روی worker ماندگار (ytdlp_engine)؛ اگر موتور در دسترس
+        نباشه یا خراب بشه، همان دستور با subprocess اجرا میشه
+        
+        Returns:
+            (returncode, مشخصات منبع دانلود شده یا {'entries': [...]}, stderr)
+        """
+        if ytdlp_engine.enabled:
+            try:
+                async with process_pool.slot():
+                    returncode, error, info = await ytdlp_engine.run(target, options, timeout, mode)
+                return returncode, info, error.encode()
+            except YtdlpEngineError as e:
+                logger.warning(f"⚠️ موتور yt-dlp: {e} - اجرای subprocess")
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                if cleanup_prefix:
+                    self._remove_partial_files(cleanup_prefix)
+                raise
+        
+        started = time.perf_counter()
+        returncode, stdout, stderr = await self._run_process(cmd, timeout, cleanup_prefix)
+        ytdlp_engine.timings.record('subprocess', time.perf_counter() - started)
+        if mode == 'search':
+            return returncode, self._parse_search_dump(stdout), stderr
+        return returncode, self._parse_print_info(stdout), stderr
+    
+    @staticmethod
+    def _parse_search_dump(stdout: bytes) -> Optional[Dict[str, Any]]:
+        """خروجی --dump-single-json جستجو، فقط فیلدهای کاندید"""
+        try:
+            data = json.loads(stdout or b'{}')
+        except ValueError:
+            return None
+        return {'entries': [
+            {field: entry.get(field) for field in CANDIDATE_FIELDS}
+            for entry in data.get('entries') or [] if entry
+        ]}
+    
+    @staticmethod
+    def _parse_print_info(stdout: bytes) -> Optional[Dict[str, Any]]:
+        """خروجی --print (آخرین خط JSON)"""
+        for line in reversed((stdout or b'').decode(errors='ignore').splitlines()):
+            line = line.strip()
+            if line.startswith('{'):
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    return None
+        return None
+    
+    def _remove_partial_files(self, prefix: str):
+        """حذف فایل‌های نیمه‌کاره‌ی یک دانلود"""
+        for file in self.download_dir.glob(f"{prefix}*"):
+            try:
+                file.unlink()
+            except OSError:
+                pass
+    
+    def _find_output(self, prefix: str) -> Optional[Path]:
+        """فایل خروجی yt-dlp (پسوند به فرمت منبع بستگی داره)"""
+        for file in self.download_dir.glob(f"{prefix}.*"):
+            if file.suffix not in TEMP_DOWNLOAD_EXTS:
+                return file
+        return None
+    
+    async def _ensure_sendable(self, file: Path, quality: Optional[str]) -> Optional[Path]:
+        """
+        اگر فرمت برای تلگرام قابل ارسال باشه همان فایل برمی‌گرده (بدون
+        re-encode)، وگرنه با کیفیت کاربر به mp3 تبدیل میشه
+        """
+        if file.suffix in SENDABLE_AUDIO_EXTS:
+            self.format_stats['passthrough'] += 1
+            return file
+        
+        output = file.with_suffix('.mp3')
+        cmd = [
+            'ffmpeg', '-i', str(file),
+            '-vn', '-acodec', 'libmp3lame',
+            *quality_profile(quality)['transcode'],
+            str(output), '-y'
+        ]
+        logger.info(f"🔄 تبدیل {file.suffix} به mp3 ({quality or DEFAULT_QUALITY})")
+        
+        try:
+            returncode, _, stderr = await self._run_process(cmd, timeout=120)
+        except asyncio.TimeoutError:
+            logger.warning("⏱️ timeout در تبدیل فرمت")
+            returncode = -1
+        finally:
+            try:
+                file.unlink()
+            except OSError:
+                pass
+        
+        if returncode != 0 or not output.exists():
+            logger.warning("⚠️ تبدیل فرمت ناموفق")
+            try:
+                output.unlink()
+            except OSError:
+                pass
+            return None
+        
+        self.format_stats['transcoded'] += 1
+        return output
+    
+    async def _download_target(
+        self,
+        target: str,
+        prefix: str,
+        label: str,
+        quality: Optional[str] = None,
+        youtube: bool = False,
+        format_selector: Optional[str] = None
+    ) -> Optional[str]:
+        """
+        دانلود یک هدف yt-dlp (جستجو یا URL مستقیم) و تبدیل به فایل قابل ارسال
+        
+        مشخصات منبع انتخاب شده تا ثبت در ایندکس در _resolutions می‌مونه.
+        TimeoutError به فراخواننده می‌رسه.
+        """
+        format_selector = format_selector or quality_profile(quality)['format']
+        output_template = str(self.download_dir / f"{prefix}.%(ext)s")
+        
+        cmd = [
+            'yt-dlp',
+            target,
+            '--format', format_selector,
+            '--extract-audio',
+            '--audio-format', 'best',  # بدون re-encode
+            '--output', output_template,
+            '--no-playlist',
+            '--quiet',
+            '--no-warnings',
+            '--no-check-certificates',
+            '--socket-timeout', '30',
+            '--retries', '5',
+            '--postprocessor-args', 'ffmpeg:-y',
+            '--print', RESOLUTION_PRINT,
+        ]
+        options = ytdlp_audio_options(output_template, quality, format=format_selector)
+        
+        if youtube:
+            cmd += [
+                '--user-agent', USER_AGENT,
+                '--fragment-retries', '10',
+                '--concurrent-fragments', '4',
+                # فقط ویدیوهای بیشتر از 1 دقیقه
+                '--match-filter', 'duration > 60',
+            ]
+            options.update(
+                http_headers={'User-Agent': USER_AGENT},
+                fragment_retries=10,
+                concurrent_fragment_downloads=4,
+                match_filter='duration > 60',
+            )
+        
+        logger.info(f"📥 دانلود از {label}...")
+        returncode, info, stderr = await self._run_ytdlp(
+            target,
+            options,
+            cmd,
+            timeout=90,  # 90 ثانیه
+            cleanup_prefix=prefix
+        )
+        
+        if returncode != 0:
+            error = stderr.decode()[:200] if stderr else "Unknown"
+            logger.debug(f"⚠️ {label} ناموفق: {error}")
+            return None
+        
+        file = self._find_output(prefix)
+        if file:
+            file = await self._ensure_sendable(file, quality)
+        file_size = file.stat().st_size if file else 0
+        
+        # فیلتر حجم - حداقل 500KB (حدود 30 ثانیه آهنگ با کیفیت متوسط)
+        if file_size <= 500000:
+            logger.warning(f"⚠️ فایل خیلی کوچیکه ({file_size} bytes), احتمالاً ناقصه")
+            self._remove_partial_files(prefix)
+            return None
+        
+        logger.info(f"✅ {label} موفق: {file.name} ({file_size/1024/1024:.1f}MB)")
+        if info:
+            if len(self._resolutions) > 100:
+                self._resolutions.clear()
+            self._resolutions[str(file)] = info
+        return str(file)
+    
+    def pop_resolution(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """مشخصات منبعی که این فایل ازش دانلود شد"""
+        return self._resolutions.pop(file_path, None)
+    
+    async def search_youtube_candidates(self, query: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        جستجوی YouTube فقط با metadata (بدون دانلود)
+        
+        Returns:
+            لیست کاندیدها یا None اگر خود جستجو شکست خورد
+        """
+        target = f'ytsearch{config.DOWNLOAD_CANDIDATES}:{query}'
+        cmd = [
+            'yt-dlp',
+            target,
+            '--flat-playlist',
+            '--dump-single-json',
+            '--quiet',
+            '--no-warnings',
+            '--no-check-certificates',
+            '--user-agent', USER_AGENT,
+            '--socket-timeout', '15',
+        ]
+        options = {
+            'extract_flat': 'in_playlist',
+            'quiet': True,
+            'no_warnings': True,
+            'nocheckcertificate': True,
+            'http_headers': {'User-Agent': USER_AGENT},
+            'socket_timeout': 15,
+        }
+        
+        try:
+            returncode, info, _ = await self._run_ytdlp(target, options, cmd, timeout=30, mode='search')
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ timeout جستجوی کاندیدها برای '{query}'")
+            return None
+        
+        if returncode != 0 or info is None:
+            return None
+        return info['entries']
+    
+    async def rank_youtube_candidates(
+        self,
+        track_name: str,
+        artist_name: str,
+        duration_ms: Optional[int]
+    ) -> Optional[List[Tuple[float, Dict[str, Any]]]]:
+        """
+        جستجوی metadata و رتبه‌بندی کاندیدها (مشترک بین دانلود و استریم)
+        
+        Returns:
+            کاندیدهای قابل قبول از بهترین به بدترین، یا None اگر خود جستجو شکست خورد
+        """
+        candidates = await self.search_youtube_candidates(f"{artist_name} {track_name}")
+        if candidates is None:
+            return None
+        
+        ranked = rank_candidates(candidates, track_name, artist_name, duration_ms)
+        self.ranking_stats['searches'] += 1
+        if not ranked:
+            self.ranking_stats['no_match'] += 1
+            logger.warning(f"⚠️ هیچ کاندید مناسبی از {len(candidates)} نتیجه YouTube نبود")
+        
+        for score, candidate in ranked[:2]:
+            logger.info(
+                f"🏆 کاندید YouTube: '{candidate.get('title')}' "
+                f"({candidate.get('channel') or candidate.get('uploader')}) امتیاز {score:.2f}"
+            )
+        return ranked
+    
+    async def _download_best_candidate(
+        self,
+        track_name: str,
+        artist_name: str,
+        quality: Optional[str],
+        duration_ms: Optional[int]
+    ) -> Optional[str]:
+        """
+        رتبه‌بندی نتایج جستجو و دانلود فقط بهترین کاندید (و در صورت
+        شکست دانلود، نفر دوم)
+        
+        Returns:
+            مسیر فایل یا None (جستجو شکست خورد، کاندید قابل قبولی نبود یا دانلود نشد)
+        """
+        ranked = await self.rank_youtube_candidates(track_name, artist_name, duration_ms)
+        
+        for score, candidate in (ranked or [])[:2]:
+            url = youtube_watch_url(candidate['id'])
+            url_hash = hashlib.md5(url.encode()).hexdigest()[:8]
+            try:
+                file_path = await self._download_target(
+                    url, f"yt_{url_hash}", 'YouTube', quality=quality, youtube=True
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"⏱️ YouTube timeout برای {url}")
+                file_path = None
+            if file_path:
+                self.ranking_stats['downloaded'] += 1
+                return file_path
+        
+        return None
+    
     async def download_from_youtube(
         self,
         track_name: str,
         artist_name: str,
-        retries: int = 3
+        retries: int = 3,
+        quality: Optional[str] = None,
+        duration_ms: Optional[int] = None
     ) -> Optional[str]:
-        """دانلود از YouTube با چک حجم فایل"""
+        """
+        دانلود از YouTube با چک حجم فایل
+        
+        با DOWNLOAD_CANDIDATE_RANKING اول کاندیدها بدون دانلود رتبه‌بندی
+        میشن؛ اگر کاندید قابل قبولی دانلود نشد (مثلاً عنوان فارسی در برابر
+        آپلودهای لاتین هیچ توکن مشترکی نداره) جستجوهای ytsearch1 قدیمی
+        امتحان میشن.
+        """
+        if config.DOWNLOAD_CANDIDATE_RANKING:
+            file_path = await self._download_best_candidate(
+                track_name, artist_name, quality, duration_ms
+            )
+            if file_path:
+                return file_path
+            logger.info("↩️ YouTube: کاندید رتبه‌بندی شده‌ای دانلود نشد - جستجوی ساده")
         
         # جستجوهای مختلف
         search_queries = [
@@ -59,89 +911,17 @@ class MusicDownloader:
             logger.info(f"🔍 YouTube (تلاش {attempt}/{len(search_queries)}): '{query}'")
             
             query_hash = hashlib.md5(query.encode()).hexdigest()[:8]
-            output_template = str(self.download_dir / f"yt_{query_hash}.%(ext)s")
-            
-            # بررسی کش
-            for file in self.download_dir.iterdir():
-                if file.stem.startswith(f"yt_{query_hash}") and file.suffix == '.mp3':
-                    file_size = file.stat().st_size
-                    # چک حجم - فایل باید حداقل 500KB باشه
-                    if file_size > 500000:
-                        logger.info(f"✅ از کش: {file.name} ({file_size/1024/1024:.1f}MB)")
-                        return str(file)
-                    else:
-                        logger.warning(f"⚠️ فایل کش خیلی کوچیکه، حذف میشه: {file_size} bytes")
-                        try:
-                            file.unlink()
-                        except:
-                            pass
-            
-            cmd = [
-                'yt-dlp',
-                f'ytsearch1:{query}',
-                '--extract-audio',
-                '--audio-format', 'mp3',
-                '--audio-quality', '0',  # بهترین کیفیت
-                '--output', output_template,
-                '--no-playlist',
-                '--quiet',
-                '--no-warnings',
-                '--no-check-certificates',
-                '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
-                '--socket-timeout', '30',
-                '--retries', '5',
-                '--fragment-retries', '10',
-                '--concurrent-fragments', '4',
-                '--prefer-free-formats',
-                '--postprocessor-args', 'ffmpeg:-y',
-                # اضافه کردن فیلتر مدت زمان - فقط ویدیوهای بیشتر از 1 دقیقه
-                '--match-filter', 'duration > 60',
-            ]
-            
             try:
-                logger.info("📥 دانلود از YouTube...")
-                
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                
-                stdout, stderr = await asyncio.wait_for(
-                    process.communicate(),
-                    timeout=90  # 90 ثانیه
+                file_path = await self._download_target(
+                    f'ytsearch1:{query}', f"yt_{query_hash}", 'YouTube',
+                    quality=quality, youtube=True
                 )
-                
-                if process.returncode == 0:
-                    # پیدا کردن فایل
-                    for file in self.download_dir.iterdir():
-                        if file.stem.startswith(f"yt_{query_hash}") and file.suffix == '.mp3':
-                            file_size = file.stat().st_size
-                            
-                            # فیلتر حجم - حداقل 500KB (حدود 30 ثانیه آهنگ با کیفیت متوسط)
-                            if file_size > 500000:
-                                logger.info(f"✅ YouTube موفق: {file.name} ({file_size/1024/1024:.1f}MB)")
-                                return str(file)
-                            else:
-                                logger.warning(f"⚠️ فایل خیلی کوچیکه ({file_size} bytes), احتمالاً ناقصه")
-                                try:
-                                    file.unlink()
-                                except:
-                                    pass
-                else:
-                    error = stderr.decode()[:200] if stderr else "Unknown"
-                    logger.debug(f"⚠️ YouTube ناموفق: {error}")
-                    
+                if file_path:
+                    return file_path
             except asyncio.TimeoutError:
                 logger.warning(f"⏱️ YouTube timeout برای '{query}'")
-                try:
-                    process.kill()
-                except:
-                    pass
-                continue
             except Exception as e:
                 logger.error(f"❌ YouTube error: {e}")
-                continue
         
         logger.warning("❌ YouTube: همه تلاش‌ها ناموفق")
         return None
@@ -149,7 +929,9 @@ class MusicDownloader:
     async def download_from_soundcloud(
         self, 
         track_name: str, 
-        artist_name: str
+        artist_name: str,
+        quality: Optional[str] = None,
+        duration_ms: Optional[int] = None
     ) -> Optional[str]:
         """دانلود از SoundCloud با چک حجم"""
         search_queries = [
@@ -161,104 +943,205 @@ class MusicDownloader:
             logger.info(f"🔍 SoundCloud: '{query}'")
             
             query_hash = hashlib.md5(query.encode()).hexdigest()[:8]
-            output_template = str(self.download_dir / f"sc_{query_hash}.%(ext)s")
-            
-            # بررسی کش
-            for file in self.download_dir.iterdir():
-                if file.stem.startswith(f"sc_{query_hash}") and file.suffix == '.mp3':
-                    file_size = file.stat().st_size
-                    if file_size > 500000:
-                        logger.info(f"✅ از کش: {file.name}")
-                        return str(file)
-                    else:
-                        try:
-                            file.unlink()
-                        except:
-                            pass
-            
-            cmd = [
-                'yt-dlp',
-                f'scsearch1:{query}',
-                '--extract-audio',
-                '--audio-format', 'mp3',
-                '--audio-quality', '0',
-                '--output', output_template,
-                '--no-playlist',
-                '--quiet',
-                '--no-warnings',
-                '--no-check-certificates',
-                '--socket-timeout', '30',
-                '--retries', '5',
-                '--postprocessor-args', 'ffmpeg:-y',
-            ]
-            
             try:
-                logger.info("📥 دانلود از SoundCloud...")
-                
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
+                file_path = await self._download_target(
+                    f'scsearch1:{query}', f"sc_{query_hash}", 'SoundCloud',
+                    quality=quality
                 )
-                
-                stdout, stderr = await asyncio.wait_for(
-                    process.communicate(),
-                    timeout=90
-                )
-                
-                if process.returncode == 0:
-                    for file in self.download_dir.iterdir():
-                        if file.stem.startswith(f"sc_{query_hash}") and file.suffix == '.mp3':
-                            file_size = file.stat().st_size
-                            if file_size > 500000:
-                                logger.info(f"✅ SoundCloud موفق: {file.name} ({file_size/1024/1024:.1f}MB)")
-                                return str(file)
-                else:
-                    logger.debug(f"⚠️ SoundCloud ناموفق")
-                    
+                if file_path:
+                    return file_path
             except asyncio.TimeoutError:
                 logger.warning(f"⏱️ SoundCloud timeout")
-                try:
-                    process.kill()
-                except:
-                    pass
-                continue
             except Exception as e:
                 logger.error(f"❌ SoundCloud error: {e}")
-                continue
         
         return None
     
+    async def download_resolved(
+        self,
+        resolved: Dict[str, Any],
+        quality: Optional[str] = None
+    ) -> Optional[str]:
+        """دانلود مستقیم از منبع شناخته شده (بدون جستجو)"""
+        format_selector = None
+        if resolved.get('format_id') and resolved.get('quality') == (quality or DEFAULT_QUALITY):
+            format_selector = f"{resolved['format_id']}/{quality_profile(quality)['format']}"
+        
+        url_hash = hashlib.md5(resolved['url'].encode()).hexdigest()[:8]
+        label = 'YouTube' if resolved['source'] == 'youtube' else 'SoundCloud'
+        logger.info(f"🎯 منبع شناخته شده: {resolved['url']}")
+        
+        try:
+            return await self._download_target(
+                resolved['url'], f"rs_{url_hash}", label,
+                quality=quality,
+                youtube=resolved['source'] == 'youtube',
+                format_selector=format_selector
+            )
+        except asyncio.TimeoutError:
+            logger.warning("⏱️ timeout دانلود از منبع شناخته شده")
+        except Exception as e:
+            logger.error(f"❌ خطا در دانلود از منبع شناخته شده: {e}")
+        return None
+    
+    def should_stream(self, track_id: Optional[str], track_name: str,
+                      artist_name: str, popularity: Optional[int],
+                      quality: Optional[str] = None) -> bool:
+        """
+        آهنگ‌هایی که قرار نیست توی کش دیسک بمونن (کش خاموش یا محبوبیت
+        کمتر از DOWNLOAD_CACHE_MIN_POPULARITY) و الان هم روی دیسک نیستن
+        """
+        if not config.DOWNLOAD_STREAMING:
+            return False
+        if config.DOWNLOAD_CACHE_MAX_MB > 0 and (popularity or 0) >= config.DOWNLOAD_CACHE_MIN_POPULARITY:
+            return False
+        lookup_key = normalize_lookup_key(track_name, artist_name)
+        return not self.index.contains(track_id, lookup_key, quality)
+    
+    @asynccontextmanager
+    async def open_stream(
+        self,
+        track_name: str,
+        artist_name: str,
+        quality: Optional[str] = None,
+        url: Optional[str] = None,
+        duration_ms: Optional[int] = None,
+        track_id: Optional[str] = None
+    ):
+        """
+        استریم m4a از stdout yt-dlp بدون نوشتن روی دیسک
+        
+        یک AudioStream (async iterator از chunk ها با پسوند/mime واقعی)
+        برمی‌گردونه یا None اگر چیزی پیدا نشد. خوندن فقط وقتی انجام میشه که مصرف‌کننده (آپلود) chunk بعدی
+        رو بخواد، پس بافر به pipe و STREAM_CHUNK_SIZE محدوده و yt-dlp
+        پشت آپلود کند منتظر می‌مونه. اگر url (منبع شناخته شده) داده نشه،
+        منبع با همان رتبه‌بندی کاندیدهای مسیر دانلود انتخاب میشه و بعد از
+        استریم کامل، مثل مسیر دانلود در نگاشت منبع track_id ثبت میشه.
+        """
+        resolution = None
+        if not url:
+            ranked = await self.rank_youtube_candidates(track_name, artist_name, duration_ms)
+            if not ranked:
+                yield None
+                return
+            candidate = ranked[0][1]
+            url = youtube_watch_url(candidate['id'])
+            if track_id:
+                resolution = {
+                    'track_id': track_id,
+                    'info': {
+                        'id': candidate['id'],
+                        'webpage_url': url,
+                        'duration': candidate.get('duration'),
+                    },
+                    'duration_ms': duration_ms,
+                    'quality': quality,
+                }
+        
+        cmd = [
+            'yt-dlp',
+            url,
+            '--format', quality_profile(quality)['stream'],
+            '--output', '-',
+            '--no-playlist',
+            '--quiet',
+            '--no-warnings',
+            '--no-check-certificates',
+            '--user-agent', USER_AGENT,
+            '--socket-timeout', '30',
+            '--retries', '5',
+        ]
+        
+        async with process_pool.slot():
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+                limit=STREAM_CHUNK_SIZE
+            )
+            try:
+                try:
+                    first = await asyncio.wait_for(process.stdout.read(STREAM_CHUNK_SIZE), timeout=60)
+                except asyncio.TimeoutError:
+                    logger.warning("⏱️ استریم YouTube شروع نشد")
+                    first = b''
+                
+                if first:
+                    yield AudioStream(self._stream_chunks(process, first, resolution), first)
+                else:
+                    yield None
+            finally:
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                        await process.wait()
+                    except ProcessLookupError:
+                        pass
+    
+    async def _stream_chunks(
+        self,
+        process,
+        first: bytes,
+        resolution: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[bytes]:
+        """chunk های stdout؛ اگر دانلود ناقص تموم بشه خطا میده تا آپلود لغو بشه"""
+        total = len(first)
+        yield first
+        
+        while True:
+            chunk = await asyncio.wait_for(process.stdout.read(STREAM_CHUNK_SIZE), timeout=60)
+            if not chunk:
+                break
+            total += len(chunk)
+            yield chunk
+        
+        returncode = await process.wait()
+        if returncode != 0 or total <= 500000:
+            raise DownloadStreamError(f"استریم ناقص (code={returncode}, {total} bytes)")
+        
+        self.format_stats['streamed'] += 1
+        logger.info(f"✅ استریم کامل شد ({total/1024/1024:.1f}MB)")
+        
+        # استریم بعدی همین آهنگ بدون جستجوی دوباره
+        if resolution:
+            self.resolver.record(
+                resolution['track_id'], 'youtube', resolution['info'],
+                resolution['duration_ms'], resolution['quality']
+            )
+    
     async def download_preview_from_spotify(self, preview_url: str) -> Optional[str]:
-        """دانلود preview 30 ثانیه"""
+        """
+        دانلود preview 30 ثانیه
+        
+        هر درخواست فایل خودش رو می‌گیره، چون preview بعد از ارسال پاک میشه
+        و دو ارسال همزمان نباید فایل همدیگه رو پاک کنن.
+        """
         try:
             file_hash = hashlib.md5(preview_url.encode()).hexdigest()[:8]
-            file_name = f"preview_{file_hash}.mp3"
+            file_name = f"preview_{file_hash}_{uuid.uuid4().hex[:8]}.mp3"
             file_path = self.download_dir / file_name
             
-            if file_path.exists():
-                logger.info("✅ Preview از کش")
-                return str(file_path)
-            
             logger.info("📥 دانلود Spotify Preview...")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(preview_url, timeout=30) as response:
-                    if response.status == 200:
-                        content = await response.read()
-                        if len(content) > 0:
-                            async with aiofiles.open(file_path, 'wb') as f:
-                                await f.write(content)
-                            logger.info(f"✅ Preview دانلود شد ({len(content)/1024:.0f}KB)")
-                            return str(file_path)
-                        
+            async with http_client.request('preview', 'GET', preview_url) as response:
+                if response.status == 200:
+                    content = await response.read()
+                    if len(content) > 0:
+                        async with aiofiles.open(file_path, 'wb') as f:
+                            await f.write(content)
+                        logger.info(f"✅ Preview دانلود شد ({len(content)/1024:.0f}KB)")
+                        return str(file_path)
+                    
         except Exception as e:
             logger.error(f"❌ خطا در دانلود preview: {e}")
         
         return None
     
     def cleanup_old_files(self, max_age_hours: int = 3):
-        """پاک‌سازی فایل‌های قدیمی"""
+        """
+        پاک‌سازی فایل‌های قدیمیِ خارج از ایندکس
+        (preview، فایل‌های نیمه‌کاره، باقی‌مانده‌های قبل از ری‌استارت)
+        """
         now = datetime.now()
         deleted = 0
         
@@ -266,71 +1149,191 @@ class MusicDownloader:
             if not self.download_dir.exists():
                 return
             
+            indexed = self.index.indexed_paths()
+            
             for file in self.download_dir.iterdir():
-                if file.is_file() and file.suffix == '.mp3':
-                    age = now - datetime.fromtimestamp(file.stat().st_mtime)
-                    if age > timedelta(hours=max_age_hours):
-                        try:
-                            file.unlink()
-                            deleted += 1
-                        except:
-                            pass
+                if not file.is_file() or str(file) in indexed:
+                    continue
+                age = now - datetime.fromtimestamp(file.stat().st_mtime)
+                if age > timedelta(hours=max_age_hours):
+                    try:
+                        file.unlink()
+                        deleted += 1
+                    except:
+                        pass
             
             if deleted > 0:
                 logger.info(f"🗑️ {deleted} فایل قدیمی پاک شد")
                 
         except Exception as e:
             logger.error(f"❌ خطا در cleanup: {e}")
+    
+    async def maintain_cache(self):
+        """
+        نگهداری کش دیسک: فایل‌های یتیم + eviction تا بودجه
+        
+        eviction دسته‌ای (EVICT_BATCH فایل در هر commit) روی همون event loop
+        انجام میشه و بین دسته‌ها نوبت به handler ها می‌رسه.
+        """
+        self.cleanup_old_files(max_age_hours=2)
+        
+        removed, freed = 0, 0
+        while True:
+            batch_removed, batch_freed = self.index.evict_to_budget(
+                config.DOWNLOAD_CACHE_MAX_MB * 1024 * 1024,
+                policy=config.DOWNLOAD_CACHE_POLICY,
+                limit=self.EVICT_BATCH
+            )
+            removed += batch_removed
+            freed += batch_freed
+            if batch_removed < self.EVICT_BATCH:
+                break
+            await asyncio.sleep(0)
+        
+        if removed:
+            logger.info(f"🗑️ eviction کش دانلود: {removed} فایل ({freed/1024/1024:.1f}MB)")
 
 
 # Singleton
 music_downloader = MusicDownloader()
 
 
+def _is_valid_download(file_path: Optional[str]) -> bool:
+    """فایل وجود داره و حداقل 500KB هست"""
+    return bool(file_path) and os.path.exists(file_path) and os.path.getsize(file_path) > 500000
+
+
+async def _serial_download(
+    track_name: str,
+    artist_name: str,
+    quality: Optional[str] = None,
+    duration_ms: Optional[int] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """زنجیره ترتیبی قدیمی: اول YouTube، بعد SoundCloud"""
+    logger.info("🎯 استراتژی 1/3: YouTube")
+    file_path = await music_downloader.download_from_youtube(
+        track_name, artist_name, quality=quality, duration_ms=duration_ms
+    )
+    if _is_valid_download(file_path):
+        logger.info(f"✅ YouTube موفق: {os.path.basename(file_path)}")
+        return file_path, 'youtube'
+    
+    logger.info("🎯 استراتژی 2/3: SoundCloud")
+    file_path = await music_downloader.download_from_soundcloud(
+        track_name, artist_name, quality=quality, duration_ms=duration_ms
+    )
+    if _is_valid_download(file_path):
+        logger.info(f"✅ SoundCloud موفق: {os.path.basename(file_path)}")
+        return file_path, 'soundcloud'
+    
+    return None, None
+
+
+async def _hedged_download(
+    track_name: str,
+    artist_name: str,
+    quality: Optional[str] = None,
+    duration_ms: Optional[int] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    دانلود hedged: YouTube فوراً شروع میشه و اگر تا DOWNLOAD_HEDGE_DELAY
+    ثانیه تموم نشد، SoundCloud هم موازی شروع میشه. اولین فایل معتبر
+    برنده است و دانلودِ بازنده (و پروسه yt-dlp اش) لغو میشه.
+    """
+    sources = {
+        'YouTube': music_downloader.download_from_youtube,
+        'SoundCloud': music_downloader.download_from_soundcloud,
+    }
+    waiting = list(sources)
+    running = {}
+    
+    def launch(name: str):
+        logger.info(f"🎯 شروع دانلود از {name}")
+        task = asyncio.create_task(
+            sources[name](track_name, artist_name, quality=quality, duration_ms=duration_ms)
+        )
+        running[task] = name
+        waiting.remove(name)
+    
+    launch('YouTube')
+    
+    try:
+        while running:
+            timeout = config.DOWNLOAD_HEDGE_DELAY if waiting else None
+            done, _ = await asyncio.wait(
+                running,
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            
+            if not done:
+                # YouTube کند است - hedge با منبع بعدی
+                logger.info(f"⏳ بعد از {config.DOWNLOAD_HEDGE_DELAY} ثانیه hedge")
+                launch(waiting[0])
+                continue
+            
+            for task in done:
+                name = running.pop(task)
+                try:
+                    file_path = task.result()
+                except Exception as e:
+                    logger.error(f"❌ {name} error: {e}")
+                    file_path = None
+                
+                if _is_valid_download(file_path):
+                    logger.info(f"✅ {name} برنده شد: {os.path.basename(file_path)}")
+                    return file_path, name.lower()
+                
+                logger.warning(f"⚠️ {name} ناموفق")
+            
+            # منبعی که شکست خورد، منتظر delay نمی‌مونیم
+            if not running and waiting:
+                launch(waiting[0])
+        
+        return None, None
+        
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+
+async def download_cache_maintenance_job(context):
+    """job دوره‌ای نگهداری کش (خارج از مسیر درخواست)"""
+    await music_downloader.maintain_cache()
+
+
 async def download_track_safe_async(
     track_name: str,
     artist_name: str,
     spotify_url: Optional[str] = None,
-    preview_url: Optional[str] = None
+    preview_url: Optional[str] = None,
+    track_id: Optional[str] = None,
+    duration_ms: Optional[int] = None,
+    quality: Optional[str] = None
 ) -> Optional[str]:
     """
     دانلود با استراتژی چندگانه و فیلتر حجم
-    """
-    
-    # پاکسازی
-    music_downloader.cleanup_old_files(max_age_hours=2)
     
-    logger.info(f"🎵 شروع دانلود: {track_name} - {artist_name}")
-    
-    # استراتژی 1: YouTube
-    logger.info("🎯 استراتژی 1/3: YouTube")
-    file_path = await music_downloader.download_from_youtube(
-        track_name, artist_name
-    )
-    if file_path and os.path.exists(file_path):
-        file_size = os.path.getsize(file_path)
-        if file_size > 500000:  # بیشتر از 500KB
-            logger.info(f"✅ YouTube موفق: {os.path.basename(file_path)}")
-            return file_path
-        else:
-            logger.warning(f"⚠️ فایل خیلی کوچیکه ({file_size} bytes)")
-            try:
-                os.remove(file_path)
-            except:
-                pass
+    اول ایندکس دانلودها (با Spotify id یا artist:title) چک میشه و
+    درخواست‌های همزمان برای یک آهنگ فقط یک دانلود انجام میدن.
+    quality (high/medium/low) جزء کلید single-flight و ایندکسه؛ هر
+    کیفیت فایل خودش رو داره و کاربرها bitrate همدیگه رو نمی‌گیرن.
+    """
+    lookup_key = normalize_lookup_key(track_name, artist_name)
     
-    # استراتژی 2: SoundCloud
-    logger.info("🎯 استراتژی 2/3: SoundCloud")
-    file_path = await music_downloader.download_from_soundcloud(
-        track_name, artist_name
+    file_path = await music_downloader.single_flight.run(
+        f"{track_id or lookup_key}:{normalize_quality(quality)}",
+        lambda: _download_full_track(
+            track_name, artist_name, track_id, duration_ms, lookup_key, quality
+        )
     )
-    if file_path and os.path.exists(file_path):
-        file_size = os.path.getsize(file_path)
-        if file_size > 500000:
-            logger.info(f"✅ SoundCloud موفق: {os.path.basename(file_path)}")
-            return file_path
+    if file_path:
+        return file_path
     
     # استراتژی 3: Preview (فقط اگه هیچ راهی نبود)
+    # بیرون از single-flight، چون فایل preview بعد از ارسال پاک میشه
     if preview_url:
         logger.info("🎯 استراتژی 3/3: Spotify Preview (30 ثانیه)")
         file_path = await music_downloader.download_preview_from_spotify(preview_url)
@@ -339,4 +1342,54 @@ async def download_track_safe_async(
             return file_path
     
     logger.error("❌ همه روش‌ها شکست خوردند")
-    return None
\ No newline at end of file
+    return None
+
+
+async def _download_full_track(
+    track_name: str,
+    artist_name: str,
+    track_id: Optional[str],
+    duration_ms: Optional[int],
+    lookup_key: str,
+    quality: Optional[str] = None
+) -> Optional[str]:
+    """ایندکس، منبع شناخته شده، بعد جستجوی YouTube/SoundCloud (داخل single-flight)"""
+    
+    # کش (ایندکس)
+    cached_path = music_downloader.index.lookup(track_id, lookup_key, quality)
+    if cached_path:
+        logger.info(f"✅ از کش: {os.path.basename(cached_path)}")
+        return cached_path
+    
+    logger.info(f"🎵 شروع دانلود: {track_name} - {artist_name}")
+    
+    file_path, source = None, None
+    
+    # منبعی که قبلاً برای این آهنگ پیدا شده (بدون جستجو)
+    resolved = music_downloader.resolver.lookup(track_id)
+    if resolved:
+        file_path = await music_downloader.download_resolved(resolved, quality)
+        if _is_valid_download(file_path):
+            source = resolved['source']
+        else:
+            # نگاشت کهنه - بعد از جستجوی دوباره نگاشت جدید ثبت میشه
+            music_downloader.resolver.forget(track_id)
+            file_path, resolved = None, None
+    
+    # استراتژی 1 و 2: YouTube و SoundCloud
+    if not file_path:
+        if config.DOWNLOAD_HEDGE_DELAY >= 0:
+            file_path, source = await _hedged_download(track_name, artist_name, quality, duration_ms)
+        else:
+            file_path, source = await _serial_download(track_name, artist_name, quality, duration_ms)
+    
+    if not file_path:
+        return None
+    
+    info = music_downloader.pop_resolution(file_path)
+    if track_id and info and not resolved:
+        music_downloader.resolver.record(track_id, source, info, duration_ms, quality)
+    
+    return music_downloader.index.record(
+        file_path, track_id, lookup_key, source, duration_ms, quality
+    )
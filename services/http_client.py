@@ -0,0 +1,154 @@
+"""
+لایه HTTP مشترک - یک aiohttp session برای همه سرویس‌ها
+
+connection ها (keep-alive) و DNS بین درخواست‌ها و سرویس‌ها دوباره
+استفاده میشن؛ هر سرویس timeout و header های پیش‌فرض خودش رو داره و
+آمار استفاده دوباره از connection ها به تفکیک سرویس ثبت میشه.
+"""
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+import aiohttp
+
+from core.config import config
+
+logger = logging.getLogger(__name__)
+
+# timeout کل هر درخواست به تفکیک سرویس (ثانیه)
+SERVICE_TIMEOUTS = {
+    'spotify': 15,
+    'lyrics': config.LYRICS_DEADLINE_SECONDS,
+    'preview': 30,
+    'recognition': 30,
+    'telegram': 300,  # آپلود استریمی
+}
+DEFAULT_TIMEOUT = 30
+
+
+class ServiceClient:
+    """نمای یک سرویس روی session مشترک (timeout و header پیش‌فرض خودش)"""
+
+    def __init__(self, http: 'HttpClient', service: str, headers: Optional[Dict[str, str]] = None):
+        self._http = http
+        self.service = service
+        self.headers = headers or {}
+
+    def request(self, method: str, url: str, **kwargs):
+        return self._http.request(self.service, method, url, default_headers=self.headers, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class HttpClient:
+    """session و connector مشترک با آمار reuse"""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {'requests': 0, 'new_connections': 0, 'reused_connections': 0}
+        )
+        self._dns = {'hits': 0, 'misses': 0}
+        self._timeouts = {
+            service: aiohttp.ClientTimeout(total=seconds)
+            for service, seconds in SERVICE_TIMEOUTS.items()
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        def service_of(ctx) -> str:
+            request_ctx = ctx.trace_request_ctx or {}
+            return request_ctx.get('service', 'other')
+
+        async def on_request_start(session, ctx, params):
+            self._stats[service_of(ctx)]['requests'] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            self._stats[service_of(ctx)]['new_connections'] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._stats[service_of(ctx)]['reused_connections'] += 1
+
+        async def on_dns_cache_hit(session, ctx, params):
+            self._dns['hits'] += 1
+
+        async def on_dns_cache_miss(session, ctx, params):
+            self._dns['misses'] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """session مشترک (اگر start صدا زده نشده باشه، lazy ساخته میشه)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.HTTP_MAX_CONNECTIONS,
+                limit_per_host=config.HTTP_MAX_PER_HOST,
+                ttl_dns_cache=config.HTTP_DNS_CACHE_SECONDS,
+                use_dns_cache=True,
+                keepalive_timeout=config.HTTP_KEEPALIVE_SECONDS
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+                trace_configs=[self._trace_config()]
+            )
+        return self._session
+
+    async def start(self):
+        """ساخت session در شروع برنامه"""
+        _ = self.session
+        logger.info(
+            f"✅ HTTP client آماده شد (حداکثر {config.HTTP_MAX_CONNECTIONS} connection، "
+            f"{config.HTTP_MAX_PER_HOST} برای هر host)"
+        )
+
+    async def close(self):
+        """بستن session و همه connection ها"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def for_service(self, service: str, headers: Optional[Dict[str, str]] = None) -> ServiceClient:
+        return ServiceClient(self, service, headers)
+
+    def request(
+        self,
+        service: str,
+        method: str,
+        url: str,
+        default_headers: Optional[Dict[str, str]] = None,
+        **kwargs
+    ):
+        """درخواست روی session مشترک با timeout سرویس (async context manager)"""
+        if service in self._timeouts:
+            kwargs.setdefault('timeout', self._timeouts[service])
+        if default_headers:
+            kwargs['headers'] = {**default_headers, **(kwargs.get('headers') or {})}
+        kwargs['trace_request_ctx'] = {'service': service}
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """تعداد درخواست‌ها و connection های جدید/دوباره استفاده شده"""
+        services = {}
+        for service, entry in self._stats.items():
+            connections = entry['new_connections'] + entry['reused_connections']
+            services[service] = {
+                **entry,
+                'reuse_ratio': round(entry['reused_connections'] / connections, 3) if connections else None,
+            }
+        return {'services': services, 'dns_cache': dict(self._dns)}
+
+
+# Singleton
+http_client = HttpClient()
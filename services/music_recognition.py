@@ -2,33 +2,231 @@
 سرویس تشخیص آهنگ از ویس/ویدیو با ACRCloud
 """
 import os
+import re
+import sys
+import json
 import logging
 import asyncio
 import hashlib
 import hmac
 import base64
 import time
-from typing import Optional, Dict, Any
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, Tuple
 from pathlib import Path
 import aiohttp
 import aiofiles
 
 from core.config import config
+from services.http_client import http_client
+from services.process_pool import process_pool
+from services.temp_workspace import temp_workspace
+from services.ytdlp_engine import ytdlp_engine, YtdlpEngineError
 
 logger = logging.getLogger(__name__)
 
+# نشانگر "در کش نیست" (None یعنی "تشخیص داده نشد" کش شده)
+_NOT_CACHED = object()
+
+# کد ACRCloud برای "آهنگی پیدا نشد" (نتیجه قطعی، قابل کش)
+ACR_NO_RESULT = 1001
+
+_INSTAGRAM_SHORTCODE = re.compile(
+    r'instagram\.com/(?:[\w.]+/)?(?:p|reel|reels|tv)/([A-Za-z0-9_-]+)'
+)
+
+
+def instagram_shortcode(url: str) -> Optional[str]:
+    """shortcode پست/ریل (مستقل از query string و دامنه فرعی)"""
+    match = _INSTAGRAM_SHORTCODE.search(url or '')
+    return match.group(1) if match else None
+
+
+class RecognitionCache:
+    """
+    کش پایدار نتیجه تشخیص (جدول recognition_cache)
+    
+    کلیدها: اثر انگشت محلی نمونه صوتی (fp:...) یا sha1 خود نمونه وقتی
+    اثر انگشت ساخته نشد، و shortcode اینستاگرام (ig:...). اثر انگشت‌های
+    اخیر در حافظه نگه داشته میشن تا نمونه‌هایی که بعد از encode دوباره
+    چند بیت فرق دارن هم پیدا بشن.
+    """
+    
+    MAX_RECENT_FINGERPRINTS = 2000
+    
+    def __init__(self, ttl: timedelta, miss_ttl: timedelta, tolerance: float):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.tolerance = tolerance
+        self._recent: "OrderedDict[str, Tuple[int, int]]" = OrderedDict()
+        self._stats = {
+            'fingerprint': {'hits': 0, 'near_hits': 0, 'misses': 0},
+            'instagram': {'hits': 0, 'misses': 0},
+            'stored': 0,
+            'acrcloud_requests': 0,
+        }
+    
+    @staticmethod
+    def _parse_fingerprint(key: str) -> Optional[Tuple[int, int]]:
+        """fp:<تعداد بیت>:<hex> → (تعداد بیت، مقدار)"""
+        if not key.startswith('fp:'):
+            return None
+        _, bits, value = key.split(':', 2)
+        return int(bits), int(value, 16)
+    
+    def _remember(self, key: str):
+        parsed = self._parse_fingerprint(key)
+        if not parsed:
+            return
+        self._recent[key] = parsed
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.MAX_RECENT_FINGERPRINTS:
+            self._recent.popitem(last=False)
+    
+    def _nearest(self, key: str) -> Optional[str]:
+        """نزدیک‌ترین اثر انگشت اخیر با فاصله Hamming مجاز"""
+        parsed = self._parse_fingerprint(key)
+        if not parsed:
+            return None
+        
+        bits, value = parsed
+        allowed = int(bits * self.tolerance)
+        best_key, best_distance = None, allowed + 1
+        for other_key, (other_bits, other_value) in self._recent.items():
+            if other_bits != bits or other_key == key:
+                continue
+            distance = bin(value ^ other_value).count('1')
+            if distance < best_distance:
+                best_key, best_distance = other_key, distance
+        return best_key
+    
+    def _load(self, key: str):
+        """نتیجه از دیتابیس (dict، None یا _NOT_CACHED)"""
+        from core.database import SessionLocal, RecognitionCacheEntry
+        
+        db = SessionLocal()
+        try:
+            entry = db.query(RecognitionCacheEntry).filter(
+                RecognitionCacheEntry.cache_key == key
+            ).first()
+            
+            now = datetime.utcnow()
+            if not entry or entry.expires_at <= now:
+                return _NOT_CACHED
+            
+            entry.hit_count = (entry.hit_count or 0) + 1
+            entry.last_hit_at = now
+            db.commit()
+            return json.loads(entry.result) if entry.result else None
+            
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در خواندن کش تشخیص: {e}")
+            return _NOT_CACHED
+        finally:
+            db.close()
+    
+    def get(self, key: str):
+        """
+        Returns:
+            اطلاعات آهنگ، None ("تشخیص داده نشد" کش شده) یا _NOT_CACHED
+        """
+        kind = 'instagram' if key.startswith('ig:') else 'fingerprint'
+        
+        result = self._load(key)
+        if result is not _NOT_CACHED:
+            self._stats[kind]['hits'] += 1
+            self._remember(key)
+            return result
+        
+        nearest = self._nearest(key)
+        if nearest:
+            result = self._load(nearest)
+            if result is not _NOT_CACHED:
+                self._stats[kind]['near_hits'] += 1
+                self._remember(nearest)
+                return result
+        
+        self._stats[kind]['misses'] += 1
+        return _NOT_CACHED
+    
+    def set(self, keys, result: Optional[Dict[str, Any]]):
+        """ذخیره نتیجه (یا "تشخیص داده نشد" با TTL کوتاه‌تر) برای همه کلیدها"""
+        from core.database import SessionLocal, RecognitionCacheEntry
+        
+        now = datetime.utcnow()
+        expires_at = now + (self.ttl if result else self.miss_ttl)
+        payload = json.dumps(result, ensure_ascii=False) if result else None
+        
+        db = SessionLocal()
+        try:
+            for key in keys:
+                if not key:
+                    continue
+                db.merge(RecognitionCacheEntry(
+                    cache_key=key,
+                    result=payload,
+                    created_at=now,
+                    expires_at=expires_at,
+                    hit_count=0
+                ))
+                self._remember(key)
+                self._stats['stored'] += 1
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در ذخیره کش تشخیص: {e}")
+        finally:
+            db.close()
+    
+    def record_request(self):
+        self._stats['acrcloud_requests'] += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        for kind in ('fingerprint', 'instagram'):
+            entry = dict(self._stats[kind])
+            hits = entry['hits'] + entry.get('near_hits', 0)
+            total = hits + entry['misses']
+            entry['hit_ratio'] = round(hits / total, 3) if total else None
+            stats[kind] = entry
+        stats['recent_fingerprints'] = len(self._recent)
+        return stats
+
 
 class MusicRecognitionService:
     """سرویس تشخیص آهنگ"""
     
+    # نمونه ارسالی: mono، 8kHz، کم‌حجم (ACRCloud فینگرپرینت رو روی 8kHz می‌سازه)
+    SAMPLE_RATE = 8000
+    SAMPLE_BITRATE = '32k'
+    MIN_SAMPLE_SECONDS = 5
+    MAX_SAMPLE_SECONDS = 15
+    MAX_SAMPLE_BYTES = 256 * 1024
+    # وقتی ffmpeg در دسترس نیست، فقط همین مقدار از ابتدای فایل خونده میشه
+    FALLBACK_SAMPLE_BYTES = 1024 * 1024
+    READ_CHUNK_SIZE = 16 * 1024
+    # اثر انگشت محلی: پوش انرژی نمونه در فریم‌های 0.1 ثانیه‌ای
+    FINGERPRINT_RATE = 4000
+    FINGERPRINT_FRAME_SECONDS = 0.1
+    MIN_FINGERPRINT_BITS = 32
+    # اینستاگرام: کوچک‌ترین استریم صوتی (یا کوچک‌ترین ویدیو) و فقط ثانیه‌های اول
+    INSTAGRAM_FORMAT = 'worstaudio/worst'
+    INSTAGRAM_FETCH_SECONDS = 20
+    
     def __init__(self):
         self.access_key = os.getenv('ACRCLOUD_ACCESS_KEY')
         self.access_secret = os.getenv('ACRCLOUD_ACCESS_SECRET')
         self.host = os.getenv('ACRCLOUD_HOST', 'identify-eu-west-1.acrcloud.com')
         self.endpoint = '/v1/identify'
         
-        self.temp_dir = Path("temp")
-        self.temp_dir.mkdir(exist_ok=True)
+        self.cache = RecognitionCache(
+            ttl=timedelta(days=config.RECOGNITION_CACHE_TTL_DAYS),
+            miss_ttl=timedelta(hours=config.RECOGNITION_MISS_TTL_HOURS),
+            tolerance=config.RECOGNITION_FINGERPRINT_TOLERANCE
+        )
         
         if not self.access_key or not self.access_secret:
             logger.warning("⚠️ ACRCloud credentials موجود نیست - تشخیص آهنگ غیرفعال است")
@@ -51,17 +249,251 @@ class MusicRecognitionService:
             ).digest()
         ).decode('utf-8')
     
+    @staticmethod
+    async def _feed_stdin(process: asyncio.subprocess.Process, data: bytes):
+        """نوشتن محتوای در حافظه روی stdin ffmpeg"""
+        try:
+            process.stdin.write(data)
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg زودتر (مثلاً بعد از رسیدن به سقف نمونه) بسته شد
+            pass
+    
+    async def _extract_sample(
+        self,
+        file_path: Optional[str],
+        duration: int,
+        data: Optional[bytes] = None
+    ) -> Optional[bytes]:
+        """
+        برش یک پنجره کوتاه mono و کم‌حجم با ffmpeg (مستقیم از stdout)
+        
+        ورودی فایل روی دیسک یا data در حافظه (از طریق stdin) است.
+        خروجی با حافظه محدود خونده میشه: بیشتر از MAX_SAMPLE_BYTES نگه
+        داشته نمیشه و بعدش ffmpeg متوقف میشه.
+        """
+        duration = max(self.MIN_SAMPLE_SECONDS, min(duration, self.MAX_SAMPLE_SECONDS))
+        cmd = [
+            'ffmpeg',
+            '-hide_banner', '-loglevel', 'error',
+            '-t', str(duration),
+            '-i', 'pipe:0' if data is not None else file_path,
+            '-vn',
+            '-ac', '1',
+            '-ar', str(self.SAMPLE_RATE),
+            '-acodec', 'libmp3lame',
+            '-b:a', self.SAMPLE_BITRATE,
+            '-f', 'mp3',
+            'pipe:1'
+        ]
+        
+        async with process_pool.slot():
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            feeder = asyncio.create_task(self._feed_stdin(process, data)) if data is not None else None
+            try:
+                chunks = []
+                size = 0
+                while size < self.MAX_SAMPLE_BYTES:
+                    chunk = await asyncio.wait_for(
+                        process.stdout.read(self.READ_CHUNK_SIZE),
+                        timeout=20
+                    )
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                    size += len(chunk)
+                
+                if size >= self.MAX_SAMPLE_BYTES:
+                    logger.debug("⚠️ نمونه به سقف حجم رسید - ffmpeg متوقف شد")
+                    process.kill()
+                
+                returncode = await process.wait()
+                if size == 0 or (returncode != 0 and size < self.MAX_SAMPLE_BYTES):
+                    return None
+                
+                sample = b''.join(chunks)[:self.MAX_SAMPLE_BYTES]
+                logger.info(f"🎚 نمونه {duration} ثانیه‌ای آماده شد ({len(sample)/1024:.0f}KB)")
+                return sample
+                
+            finally:
+                if feeder:
+                    feeder.cancel()
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                        await process.wait()
+                    except ProcessLookupError:
+                        pass
+    
+    async def _read_fallback_sample(self, file_path: str) -> bytes:
+        """بدون ffmpeg: فقط ابتدای فایل خونده میشه (نه کل فایل)"""
+        async with aiofiles.open(file_path, 'rb') as f:
+            return await f.read(self.FALLBACK_SAMPLE_BYTES)
+    
+    async def _fingerprint(self, sample: bytes) -> Optional[str]:
+        """
+        اثر انگشت محلی نمونه: انرژی هر فریم 0.1 ثانیه‌ای با فریم قبلی مقایسه
+        و به یک بیت (بالا/پایین رفتن) تبدیل میشه. این الگو با encode دوباره
+        همان صدا (ویدیو/ویس فوروارد شده) تقریباً ثابت می‌مونه.
+        """
+        cmd = [
+            'ffmpeg',
+            '-hide_banner', '-loglevel', 'error',
+            '-i', 'pipe:0',
+            '-ac', '1',
+            '-ar', str(self.FINGERPRINT_RATE),
+            '-f', 's16le',
+            'pipe:1'
+        ]
+        
+        async with process_pool.slot():
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            try:
+                pcm, _ = await asyncio.wait_for(process.communicate(sample), timeout=10)
+            finally:
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                        await process.wait()
+                    except ProcessLookupError:
+                        pass
+        
+        if process.returncode != 0 or not pcm:
+            return None
+        
+        samples = array('h')
+        samples.frombytes(pcm[:len(pcm) // 2 * 2])
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        
+        frame = int(self.FINGERPRINT_RATE * self.FINGERPRINT_FRAME_SECONDS)
+        energies = [
+            sum(abs(value) for value in samples[i:i + frame])
+            for i in range(0, len(samples) - frame + 1, frame)
+        ]
+        if len(energies) <= self.MIN_FINGERPRINT_BITS or not any(energies):
+            return None
+        
+        value = 0
+        for previous, current in zip(energies, energies[1:]):
+            value = (value << 1) | (current > previous)
+        return f"fp:{len(energies) - 1}:{value:x}"
+    
+    async def _sample_key(self, sample: bytes) -> str:
+        """کلید کش نمونه: اثر انگشت، یا sha1 خود نمونه اگر ffmpeg در دسترس نبود"""
+        try:
+            fingerprint = await self._fingerprint(sample)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug(f"⚠️ ساخت اثر انگشت ناموفق: {e}")
+            fingerprint = None
+        return fingerprint or f"sha1:{hashlib.sha1(sample).hexdigest()}"
+    
+    async def _identify(self, audio_data: bytes) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """
+        ارسال نمونه به ACRCloud
+        
+        Returns:
+            (اطلاعات آهنگ یا None، نتیجه قطعی است و قابل کش؟)
+        """
+        self.cache.record_request()
+        
+        # ساخت request
+        timestamp = str(int(time.time()))
+        string_to_sign = f"POST\n{self.endpoint}\n{self.access_key}\naudio\n1\n{timestamp}"
+        signature = self._generate_signature(string_to_sign)
+        
+        data = aiohttp.FormData()
+        data.add_field('sample', audio_data, filename='sample.mp3')
+        data.add_field('access_key', self.access_key)
+        data.add_field('data_type', 'audio')
+        data.add_field('signature_version', '1')
+        data.add_field('signature', signature)
+        data.add_field('sample_bytes', str(len(audio_data)))
+        data.add_field('timestamp', timestamp)
+        
+        url = f"https://{self.host}{self.endpoint}"
+        
+        logger.info("🔍 در حال تشخیص آهنگ...")
+        
+        async with http_client.request('recognition', 'POST', url, data=data) as response:
+            if response.status != 200:
+                logger.error(f"❌ ACRCloud error: {response.status}")
+                return None, False
+            
+            result = await response.json()
+        
+        # پردازش نتیجه
+        status = result.get('status', {})
+        if status.get('code') == 0:
+            music = result.get('metadata', {}).get('music', [])
+            
+            if music:
+                track = music[0]
+                
+                # استخراج اطلاعات
+                track_info = {
+                    'title': track.get('title'),
+                    'artists': [a.get('name') for a in track.get('artists', [])],
+                    'album': track.get('album', {}).get('name'),
+                    'release_date': track.get('release_date'),
+                    'duration_ms': track.get('duration_ms'),
+                    'external_ids': track.get('external_ids', {}),
+                    'score': track.get('score', 0)
+                }
+                
+                logger.info(f"✅ آهنگ تشخیص داده شد: {track_info['title']} - {', '.join(track_info['artists'])}")
+                return track_info, True
+            return None, True
+        
+        logger.warning(f"⚠️ آهنگ تشخیص داده نشد: {status.get('msg')}")
+        # فقط "پیدا نشد" قطعیه؛ خطاهای سهمیه/امضا کش نمیشن
+        return None, status.get('code') == ACR_NO_RESULT
+    
     async def recognize_from_file(
         self, 
         file_path: str,
-        duration: int = 12
+        duration: int = 12,
+        cache_alias: Optional[str] = None
     ) -> Optional[Dict[str, Any]]:
         """
         تشخیص آهنگ از فایل صوتی/تصویری
         
         Args:
             file_path: مسیر فایل
-            duration: مدت زمان برای تشخیص (ثانیه)
+            duration: طول نمونه ارسالی برای تشخیص (ثانیه)
+            cache_alias: کلید کش اضافه برای همین نتیجه (مثلاً ig:<shortcode>)
+        
+        Returns:
+            اطلاعات آهنگ یا None
+        """
+        if not self.is_available():
+            logger.error("❌ ACRCloud در دسترس نیست")
+            return None
+        
+        return await self._recognize(file_path, None, duration, cache_alias)
+    
+    async def recognize_from_bytes(
+        self,
+        data: bytes,
+        duration: int = 12
+    ) -> Optional[Dict[str, Any]]:
+        """
+        تشخیص آهنگ از محتوای در حافظه (ویس‌های کوچک، بدون نوشتن روی دیسک)
+        
+        Args:
+            data: محتوای فایل صوتی (مثلاً ogg ویس)
+            duration: طول نمونه ارسالی برای تشخیص (ثانیه)
         
         Returns:
             اطلاعات آهنگ یا None
@@ -70,66 +502,44 @@ class MusicRecognitionService:
             logger.error("❌ ACRCloud در دسترس نیست")
             return None
         
+        return await self._recognize(None, data, duration)
+    
+    async def _recognize(
+        self,
+        file_path: Optional[str],
+        data: Optional[bytes],
+        duration: int,
+        cache_alias: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """نمونه‌گیری، کش و ACRCloud برای فایل یا محتوای در حافظه"""
         try:
-            # خواندن فایل
-            async with aiofiles.open(file_path, 'rb') as f:
-                audio_data = await f.read()
-            
-            # محدود کردن حجم (فقط 1MB اول)
-            if len(audio_data) > 1024 * 1024:
-                audio_data = audio_data[:1024 * 1024]
-            
-            # ساخت request
-            timestamp = str(int(time.time()))
-            string_to_sign = f"POST\n{self.endpoint}\n{self.access_key}\naudio\n1\n{timestamp}"
-            signature = self._generate_signature(string_to_sign)
-            
-            data = aiohttp.FormData()
-            data.add_field('sample', audio_data, filename='sample.mp3')
-            data.add_field('access_key', self.access_key)
-            data.add_field('data_type', 'audio')
-            data.add_field('signature_version', '1')
-            data.add_field('signature', signature)
-            data.add_field('sample_bytes', str(len(audio_data)))
-            data.add_field('timestamp', timestamp)
+            # نمونه کوتاه mono به جای کل فایل
+            try:
+                audio_data = await self._extract_sample(file_path, duration, data)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"⚠️ استخراج نمونه ناموفق: {e}")
+                audio_data = None
             
-            url = f"https://{self.host}{self.endpoint}"
+            if not audio_data:
+                if data is not None:
+                    audio_data = data[:self.FALLBACK_SAMPLE_BYTES]
+                else:
+                    audio_data = await self._read_fallback_sample(file_path)
             
-            logger.info(f"🔍 در حال تشخیص آهنگ...")
+            # کش: همین صدا قبلاً تشخیص داده شده؟
+            cache_key = await self._sample_key(audio_data)
+            cached = self.cache.get(cache_key)
+            if cached is not _NOT_CACHED:
+                logger.info(f"⚡ نتیجه تشخیص از کش ({cache_key[:24]})")
+                if cache_alias:
+                    self.cache.set([cache_alias], cached)
+                return cached
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=data, timeout=30) as response:
-                    if response.status != 200:
-                        logger.error(f"❌ ACRCloud error: {response.status}")
-                        return None
-                    
-                    result = await response.json()
+            result, definitive = await self._identify(audio_data)
+            if definitive:
+                self.cache.set([cache_key, cache_alias], result)
+            return result
                     
-                    # پردازش نتیجه
-                    if result.get('status', {}).get('code') == 0:
-                        metadata = result.get('metadata', {})
-                        music = metadata.get('music', [])
-                        
-                        if music:
-                            track = music[0]
-                            
-                            # استخراج اطلاعات
-                            track_info = {
-                                'title': track.get('title'),
-                                'artists': [a.get('name') for a in track.get('artists', [])],
-                                'album': track.get('album', {}).get('name'),
-                                'release_date': track.get('release_date'),
-                                'duration_ms': track.get('duration_ms'),
-                                'external_ids': track.get('external_ids', {}),
-                                'score': track.get('score', 0)
-                            }
-                            
-                            logger.info(f"✅ آهنگ تشخیص داده شد: {track_info['title']} - {', '.join(track_info['artists'])}")
-                            return track_info
-                    else:
-                        logger.warning(f"⚠️ آهنگ تشخیص داده نشد: {result.get('status', {}).get('msg')}")
-                        return None
-                        
         except asyncio.TimeoutError:
             logger.error("⏱️ Timeout در تشخیص آهنگ")
             return None
@@ -137,120 +547,114 @@ class MusicRecognitionService:
             logger.error(f"❌ خطا در تشخیص آهنگ: {e}", exc_info=True)
             return None
     
-    async def download_instagram_video(
+    async def download_instagram_audio(
         self,
-        instagram_url: str
+        instagram_url: str,
+        workdir: Path
     ) -> Optional[str]:
         """
-        دانلود ویدیو از اینستاگرام با yt-dlp
+        دانلود فقط صدای ابتدای پست/ریل اینستاگرام با yt-dlp
+        
+        کوچک‌ترین استریم صوتی انتخاب میشه (اگر نبود، کوچک‌ترین ویدیو) و
+        فقط INSTAGRAM_FETCH_SECONDS ثانیه اول دانلود میشه؛ خروجی مستقیم
+        به تشخیص داده میشه (بدون تبدیل جداگانه با ffmpeg).
         
         Args:
             instagram_url: لینک اینستاگرام
+            workdir: پوشه موقت همین درخواست
         
         Returns:
             مسیر فایل دانلود شده یا None
         """
         try:
-            # ساخت نام فایل
-            url_hash = hashlib.md5(instagram_url.encode()).hexdigest()[:8]
-            output_path = self.temp_dir / f"ig_{url_hash}.mp4"
-            
-            # چک کش
-            if output_path.exists():
-                logger.info("✅ ویدیو از کش")
-                return str(output_path)
-            
-            logger.info(f"📥 دانلود ویدیو اینستاگرام...")
+            prefix = "ig"
+            output_template = str(workdir / f"{prefix}.%(ext)s")
             
-            cmd = [
-                'yt-dlp',
-                instagram_url,
-                '--format', 'best',
-                '--output', str(output_path),
-                '--no-playlist',
-                '--quiet',
-                '--no-warnings',
-            ]
-            
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            logger.info("📥 دانلود صدای اینستاگرام...")
             
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(),
-                timeout=60
-            )
+            # اول با محدوده زمانی؛ اگر نشد (مثلاً ffmpeg برای برش نبود) کل استریم کوچک
+            for time_ranged in (True, False):
+                returncode, error = await self._fetch_instagram(instagram_url, output_template, time_ranged)
+                path = self._find_instagram_file(workdir, prefix)
+                if returncode == 0 and path:
+                    size_kb = os.path.getsize(path) / 1024
+                    logger.info(f"✅ صدای اینستاگرام دانلود شد: {Path(path).name} ({size_kb:.0f}KB)")
+                    return path
+                logger.warning(f"⚠️ دانلود اینستاگرام (time_ranged={time_ranged}) ناموفق: {error[:200] or 'Unknown'}")
+                for leftover in workdir.glob(f"{prefix}.*"):
+                    leftover.unlink(missing_ok=True)
             
-            if process.returncode == 0 and output_path.exists():
-                logger.info(f"✅ ویدیو دانلود شد: {output_path.name}")
-                return str(output_path)
-            else:
-                error = stderr.decode()[:200] if stderr else "Unknown"
-                logger.error(f"❌ دانلود ناموفق: {error}")
-                return None
+            return None
                 
         except asyncio.TimeoutError:
-            logger.error("⏱️ Timeout در دانلود ویدیو")
+            logger.error("⏱️ Timeout در دانلود صدای اینستاگرام")
             return None
         except Exception as e:
-            logger.error(f"❌ خطا در دانلود ویدیو: {e}")
+            logger.error(f"❌ خطا در دانلود صدای اینستاگرام: {e}")
             return None
     
-    async def extract_audio_from_video(
+    @staticmethod
+    def _find_instagram_file(workdir: Path, prefix: str) -> Optional[str]:
+        """فایل کامل دانلود شده (نه .part / .ytdl)"""
+        for file in workdir.glob(f"{prefix}.*"):
+            if file.suffix not in ('.part', '.ytdl', '.temp') and file.stat().st_size > 0:
+                return str(file)
+        return None
+    
+    async def _fetch_instagram(
         self,
-        video_path: str
-    ) -> Optional[str]:
-        """
-        استخراج صدا از ویدیو با FFmpeg
+        instagram_url: str,
+        output_template: str,
+        time_ranged: bool
+    ) -> Tuple[int, str]:
+        """یک تلاش yt-dlp (موتور ماندگار، در غیر این صورت subprocess)"""
+        seconds = self.INSTAGRAM_FETCH_SECONDS
         
-        Args:
-            video_path: مسیر فایل ویدیو
+        cmd = [
+            'yt-dlp',
+            instagram_url,
+            '--format', self.INSTAGRAM_FORMAT,
+            '--output', output_template,
+            '--no-playlist',
+            '--quiet',
+            '--no-warnings',
+        ]
+        if time_ranged:
+            cmd += ['--download-sections', f"*0-{seconds}"]
         
-        Returns:
-            مسیر فایل صوتی یا None
-        """
-        try:
-            audio_path = Path(video_path).with_suffix('.mp3')
-            
-            if audio_path.exists():
-                return str(audio_path)
-            
-            logger.info("🎵 استخراج صدا از ویدیو...")
-            
-            cmd = [
-                'ffmpeg',
-                '-i', video_path,
-                '-vn',  # بدون ویدیو
-                '-acodec', 'libmp3lame',
-                '-q:a', '2',
-                '-t', '30',  # فقط 30 ثانیه اول
-                str(audio_path),
-                '-y'  # overwrite
-            ]
-            
+        if ytdlp_engine.enabled:
+            options = {
+                'format': self.INSTAGRAM_FORMAT,
+                'outtmpl': output_template,
+                'noplaylist': True,
+                'quiet': True,
+                'no_warnings': True,
+            }
+            if time_ranged:
+                options['download_sections'] = [[0, seconds]]
+            try:
+                async with process_pool.slot():
+                    returncode, error, _ = await ytdlp_engine.run(instagram_url, options, timeout=60)
+                return returncode, error
+            except YtdlpEngineError as e:
+                logger.warning(f"⚠️ موتور yt-dlp: {e} - اجرای subprocess")
+        
+        async with process_pool.slot():
             process = await asyncio.create_subprocess_exec(
                 *cmd,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
-            
-            await asyncio.wait_for(
-                process.communicate(),
-                timeout=30
-            )
-            
-            if process.returncode == 0 and audio_path.exists():
-                logger.info("✅ صدا استخراج شد")
-                return str(audio_path)
-            else:
-                logger.error("❌ استخراج صدا ناموفق")
-                return None
-                
-        except Exception as e:
-            logger.error(f"❌ خطا در استخراج صدا: {e}")
-            return None
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout=60)
+            finally:
+                if process.returncode is None:
+                    try:
+                        process.kill()
+                        await process.wait()
+                    except ProcessLookupError:
+                        pass
+        return process.returncode, stderr.decode(errors='ignore') if stderr else ''
     
     async def recognize_from_instagram_link(
         self,
@@ -266,58 +670,28 @@ class MusicRecognitionService:
             اطلاعات آهنگ یا None
         """
         try:
-            # 1. دانلود ویدیو
-            video_path = await self.download_instagram_video(instagram_url)
-            if not video_path:
-                return None
-            
-            # 2. استخراج صدا
-            audio_path = await self.extract_audio_from_video(video_path)
-            if not audio_path:
-                return None
-            
-            # 3. تشخیص آهنگ
-            result = await self.recognize_from_file(audio_path)
-            
-            # 4. پاک‌سازی
-            try:
-                os.remove(video_path)
-                os.remove(audio_path)
-            except:
-                pass
+            # 0. کش: این پست/ریل قبلاً تشخیص داده شده؟
+            shortcode = instagram_shortcode(instagram_url)
+            cache_alias = f"ig:{shortcode}" if shortcode else None
+            if cache_alias:
+                cached = self.cache.get(cache_alias)
+                if cached is not _NOT_CACHED:
+                    logger.info(f"⚡ نتیجه تشخیص اینستاگرام از کش ({shortcode})")
+                    return cached
             
-            return result
+            # پوشه موقت همین درخواست (در پایان خودکار پاک میشه)
+            async with temp_workspace('instagram') as workdir:
+                # 1. دانلود فقط صدای ابتدای ویدیو
+                audio_path = await self.download_instagram_audio(instagram_url, workdir)
+                if not audio_path:
+                    return None
+                
+                # 2. تشخیص آهنگ (نمونه مستقیم از همین فایل برش داده میشه)
+                return await self.recognize_from_file(audio_path, cache_alias=cache_alias)
             
         except Exception as e:
             logger.error(f"❌ خطا در تشخیص از اینستاگرام: {e}")
             return None
-    
-    def cleanup_temp_files(self, max_age_hours: int = 2):
-        """پاک‌سازی فایل‌های موقت قدیمی"""
-        from datetime import datetime, timedelta
-        
-        try:
-            if not self.temp_dir.exists():
-                return
-            
-            now = datetime.now()
-            deleted = 0
-            
-            for file in self.temp_dir.iterdir():
-                if file.is_file():
-                    age = now - datetime.fromtimestamp(file.stat().st_mtime)
-                    if age > timedelta(hours=max_age_hours):
-                        try:
-                            file.unlink()
-                            deleted += 1
-                        except:
-                            pass
-            
-            if deleted > 0:
-                logger.info(f"🗑️ {deleted} فایل موقت پاک شد")
-                
-        except Exception as e:
-            logger.error(f"❌ خطا در cleanup: {e}")
 
 
 # Singleton
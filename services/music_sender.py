@@ -1,17 +1,23 @@
 """
 Music Sender - ارسال موزیک (Fixed with async downloader)
 """
+import asyncio
 import logging
 import os
-from typing import Optional
-from telegram import Bot
-from telegram.error import TelegramError
+import time
+from datetime import datetime
+from typing import Dict, Optional
+import aiohttp
+from telegram import Bot, Message
+from telegram.error import TelegramError, BadRequest
 from telegram.constants import ParseMode
 
-from core.database import SessionLocal, SentTrack
+from core.database import SessionLocal, SentTrack, TrackFileCache, UserSettings
 from services.spotify import get_random_track_for_user
 from services.musixmatch import get_track_lyrics
-from services.downloader import download_track_safe_async  # ✅ تغییر به async
+from services.downloader import download_track_safe_async, music_downloader  # ✅ تغییر به async
+from services.http_client import http_client
+from services.process_pool import process_pool, process_priority, PRIORITY_INTERACTIVE
 
 logger = logging.getLogger(__name__)
 
@@ -46,20 +52,328 @@ def format_track_message(
     return message.strip()
 
 
+# ==================== Telegram file_id Cache ====================
+
+def _get_cached_file_id(track_id: str) -> Optional[str]:
+    """file_id ذخیره شده برای آهنگ"""
+    db = SessionLocal()
+    try:
+        entry = db.query(TrackFileCache).filter(
+            TrackFileCache.track_id == track_id
+        ).first()
+        return entry.file_id if entry else None
+    finally:
+        db.close()
+
+
+def _save_cached_file_id(track_id: str, audio) -> None:
+    """ذخیره file_id برگشتی از اولین send_audio"""
+    db = SessionLocal()
+    try:
+        entry = db.query(TrackFileCache).filter(
+            TrackFileCache.track_id == track_id
+        ).first()
+        if not entry:
+            entry = TrackFileCache(track_id=track_id, use_count=0)
+            db.add(entry)
+        entry.file_id = audio.file_id
+        entry.file_unique_id = audio.file_unique_id
+        entry.file_size = audio.file_size
+        entry.uploaded_at = datetime.utcnow()
+        entry.last_used_at = datetime.utcnow()
+        db.commit()
+        logger.info(f"💾 file_id برای {track_id} ذخیره شد")
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"⚠️ خطا در ذخیره file_id: {e}")
+    finally:
+        db.close()
+
+
+def _touch_cached_file_id(track_id: str) -> None:
+    """به‌روزرسانی آمار استفاده"""
+    db = SessionLocal()
+    try:
+        entry = db.query(TrackFileCache).filter(
+            TrackFileCache.track_id == track_id
+        ).first()
+        if entry:
+            entry.last_used_at = datetime.utcnow()
+            entry.use_count = (entry.use_count or 0) + 1
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.debug(f"⚠️ خطا در به‌روزرسانی file_id: {e}")
+    finally:
+        db.close()
+
+
+def invalidate_cached_file_id(track_id: str) -> None:
+    """حذف file_id نامعتبر (تلگرام ردش کرده)"""
+    db = SessionLocal()
+    try:
+        db.query(TrackFileCache).filter(
+            TrackFileCache.track_id == track_id
+        ).delete()
+        db.commit()
+        logger.warning(f"🗑️ file_id نامعتبر برای {track_id} حذف شد")
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"⚠️ خطا در حذف file_id: {e}")
+    finally:
+        db.close()
+
+
+async def _send_cached_audio(
+    bot: Bot,
+    chat_id,
+    track_id: str,
+    file_id: str,
+    audio_kwargs: dict
+) -> bool:
+    """
+    ارسال با file_id کش شده
+    
+    Returns:
+        True اگر ارسال شد، False اگر تلگرام ردش کرد
+    """
+    try:
+        await bot.send_audio(chat_id=chat_id, audio=file_id, **audio_kwargs)
+        logger.info(f"⚡ ارسال از کش file_id: {track_id}")
+        _touch_cached_file_id(track_id)
+        return True
+    except BadRequest as e:
+        # file_id منقضی یا نامعتبر - دوباره دانلود و آپلود میشه
+        logger.warning(f"⚠️ تلگرام file_id رو رد کرد: {e}")
+        invalidate_cached_file_id(track_id)
+        return False
+
+
+async def _upload_audio_stream(bot: Bot, chat_id, stream, audio_kwargs: dict) -> Message:
+    """
+    sendAudio با بدنه multipart استریمی (chunked) - فایل کامل هیچ‌وقت
+    روی دیسک یا حافظه نیست. اگر استریم وسط کار خطا بده، درخواست لغو میشه
+    و تلگرام پیامی نمی‌سازه. اسم فایل و mime type از فرمت واقعی استریم.
+    """
+    form = aiohttp.FormData()
+    form.add_field('chat_id', str(chat_id))
+    for key, value in audio_kwargs.items():
+        if value is not None:
+            form.add_field(key, str(value))
+    form.add_field(
+        'audio', stream,
+        filename=f"{audio_kwargs.get('title') or 'audio'}.{stream.ext}",
+        content_type=stream.mime_type
+    )
+    
+    async with http_client.request('telegram', 'POST', f"{bot.base_url}/sendAudio", data=form) as response:
+        data = await response.json()
+    
+    if not data.get('ok'):
+        raise TelegramError(data.get('description', 'sendAudio failed'))
+    return Message.de_json(data['result'], bot)
+
+
+async def _send_streamed_audio(
+    bot: Bot,
+    chat_id,
+    track_info: dict,
+    audio_kwargs: dict,
+    quality: Optional[str] = None
+) -> Optional[Message]:
+    """
+    ارسال بدون فایل موقت: stdout yt-dlp مستقیم به آپلود تلگرام
+    
+    audio_kwargs اینجا بدون caption هست تا آپلود منتظر متن آهنگ نمونه؛
+    caption بعداً با _attach_caption اضافه میشه.
+    
+    Returns:
+        پیام ارسال شده، یا None اگر باید از مسیر دانلود معمولی رفت
+    """
+    resolved = music_downloader.resolver.lookup(track_info['id'])
+    url = resolved['url'] if resolved and resolved['source'] == 'youtube' else None
+    
+    try:
+        async with music_downloader.open_stream(
+            track_info['name'], track_info['artist_str'], quality,
+            url=url, duration_ms=track_info.get('duration_ms'),
+            track_id=track_info.get('id')
+        ) as chunks:
+            if chunks is None:
+                return None
+            logger.info("📡 استریم مستقیم به تلگرام...")
+            message = await _upload_audio_stream(bot, chat_id, chunks, audio_kwargs)
+    except Exception as e:
+        logger.warning(f"⚠️ استریم ناموفق: {e}")
+        return None
+    
+    if message.audio:
+        _save_cached_file_id(track_info['id'], message.audio)
+    logger.info("✅ فایل استریم و ارسال شد")
+    return message
+
+
+async def _attach_caption(bot: Bot, message: Message, caption: str):
+    """اضافه کردن caption (اطلاعات و متن آهنگ) به فایل استریم شده"""
+    try:
+        await bot.edit_message_caption(
+            chat_id=message.chat_id,
+            message_id=message.message_id,
+            caption=caption,
+            parse_mode=ParseMode.HTML
+        )
+    except TelegramError as e:
+        # فایل رسیده؛ اطلاعات به صورت پیام جدا (reply) فرستاده میشه
+        logger.warning(f"⚠️ افزودن caption ناموفق: {e}")
+        try:
+            await bot.send_message(
+                chat_id=message.chat_id,
+                text=caption,
+                parse_mode=ParseMode.HTML,
+                reply_to_message_id=message.message_id
+            )
+        except TelegramError as e:
+            logger.warning(f"⚠️ ارسال اطلاعات آهنگ ناموفق: {e}")
+
+
+# ==================== Delivery Timings ====================
+
+class DeliveryTimings:
+    """آمار زمان هر مرحله از ارسال (برای دیدن latency کل)"""
+    
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, float]] = {}
+    
+    def record(self, timings: Dict[str, float]):
+        for stage, seconds in timings.items():
+            entry = self._stages.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {
+                'count': int(entry['count']),
+                'avg': round(entry['total'] / entry['count'], 3),
+                'max': round(entry['max'], 3),
+            }
+            for stage, entry in self._stages.items()
+        }
+
+
+delivery_timings = DeliveryTimings()
+
+
+async def _timed(timings: Dict[str, float], stage: str, coro):
+    """اجرای یک مرحله و ثبت زمانش"""
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[stage] = time.perf_counter() - started
+
+
+async def _notify_queue_busy(bot: Bot, user_id: int):
+    """پیام backpressure وقتی صف دانلود شلوغه"""
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text="⏳ الان صف دانلود شلوغه!\n\n"
+                 "آهنگت توی نوبته و به محض آزاد شدن ارسال میشه."
+        )
+    except TelegramError as e:
+        logger.debug(f"⚠️ ارسال پیام شلوغی صف ناموفق: {e}")
+
+
+async def _fetch_lyrics_safe(track_info: dict) -> Optional[str]:
+    """دریافت متن بدون اینکه خطاش کل ارسال رو خراب کنه"""
+    try:
+        lyrics = await get_track_lyrics(
+            track_info['name'], 
+            track_info['artist_str'],
+            spotify_id=track_info.get('id')
+        )
+        if lyrics:
+            logger.info("✅ متن آهنگ دریافت شد")
+        return lyrics
+    except Exception as e:
+        logger.warning(f"⚠️ خطا در دریافت متن: {e}")
+        return None
+
+
+def _get_download_quality(user_id: int) -> Optional[str]:
+    """کیفیت دانلود کاربر (high/medium/low)"""
+    db = SessionLocal()
+    try:
+        row = db.query(UserSettings.download_quality).filter(
+            UserSettings.user_id == user_id
+        ).first()
+        return row[0] if row else None
+    except Exception as e:
+        logger.debug(f"⚠️ خطا در خواندن کیفیت دانلود: {e}")
+        return None
+    finally:
+        db.close()
+
+
+async def _download_safe(
+    track_info: dict,
+    priority: int = PRIORITY_INTERACTIVE,
+    quality: Optional[str] = None
+) -> Optional[str]:
+    """دانلود فایل بدون اینکه خطاش کل ارسال رو خراب کنه"""
+    try:
+        logger.info("📥 شروع دانلود فایل...")
+        with process_priority(priority):
+            file_path = await download_track_safe_async(
+                track_name=track_info['name'],
+                artist_name=track_info['artist_str'],
+                spotify_url=track_info['links'].get('spotify'),
+                preview_url=track_info['links'].get('preview'),
+                track_id=track_info.get('id'),
+                duration_ms=track_info.get('duration_ms'),
+                quality=quality
+            )
+        if file_path:
+            logger.info(f"✅ فایل دانلود شد: {file_path}")
+        return file_path
+    except Exception as e:
+        logger.error(f"❌ خطا در دانلود: {e}")
+        return None
+
+
 async def send_music_to_user(
     bot: Bot,
     user_id: int,
     genre: str,
     send_to: str = 'private',
     channel_id: Optional[str] = None,
-    download_file: bool = True
+    download_file: bool = True,
+    track_info: Optional[dict] = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    quality: Optional[str] = None
 ) -> bool:
-    """ارسال موزیک به کاربر"""
+    """
+    ارسال موزیک به کاربر (اگر track_info داده بشه، جستجو انجام نمیشه)
+    
+    متن آهنگ و دانلود فایل همزمان اجرا میشن و زمان هر مرحله ثبت میشه.
+    priority اولویت دانلود در صف پروسه‌هاست (تعاملی یا زمان‌بندی شده).
+    quality اگر داده نشه از UserSettings.download_quality خونده میشه.
+    """
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+    download_task = None
+    stream_task = None
     
     try:
-        # دریافت آهنگ
-        logger.info(f"🎵 دریافت آهنگ برای کاربر {user_id}, ژانر: {genre}")
-        track_info = get_random_track_for_user(user_id, genre)
+        # مرحله 1: انتخاب آهنگ
+        if not track_info:
+            logger.info(f"🎵 دریافت آهنگ برای کاربر {user_id}, ژانر: {genre}")
+            track_info = await _timed(
+                timings, 'select',
+                get_random_track_for_user(user_id, genre)
+            )
         
         if not track_info:
             logger.warning("❌ آهنگ پیدا نشد")
@@ -72,64 +386,110 @@ async def send_music_to_user(
         
         logger.info(f"✅ آهنگ پیدا شد: {track_info['name']} - {track_info['artist_str']}")
         
-        # دریافت متن
-        lyrics = None
-        try:
-            lyrics = get_track_lyrics(
-                track_info['name'], 
-                track_info['artist_str']
-            )
-            if lyrics:
-                logger.info("✅ متن آهنگ دریافت شد")
-        except Exception as e:
-            logger.warning(f"⚠️ خطا در دریافت متن: {e}")
+        # مرحله 2: متن آهنگ و دانلود به صورت همزمان
+        cached_file_id = _get_cached_file_id(track_info['id']) if download_file else None
+        if download_file and quality is None:
+            quality = _get_download_quality(user_id)
         
-        # فرمت پیام
-        message_text = format_track_message(track_info, lyrics)
+        # آهنگ‌هایی که کش دیسک نمیشن همزمان با گرفتن متن استریم میشن
+        # (بدون caption؛ caption بعد از آپلود اضافه میشه)
+        stream = download_file and not cached_file_id and music_downloader.should_stream(
+            track_info['id'], track_info['name'], track_info['artist_str'],
+            track_info.get('popularity'), quality
+        )
         
         # تعیین مقصد
         target_chat = channel_id if send_to == 'channel' else user_id
         
-        # دانلود فایل
-        file_path = None
-        if download_file:
-            try:
-                logger.info("📥 شروع دانلود فایل...")
-                # ✅ تغییر به await
-                file_path = await download_track_safe_async(
-                    track_name=track_info['name'],
-                    artist_name=track_info['artist_str'],
-                    spotify_url=track_info['links'].get('spotify'),
-                    preview_url=track_info['links'].get('preview')
+        track_kwargs = dict(
+            title=track_info['name'],
+            performer=track_info['artist_str'],
+            duration=int(track_info.get('duration_ms', 0) / 1000) if 'duration_ms' in track_info else None
+        )
+        
+        if download_file and not cached_file_id:
+            if stream:
+                with process_priority(priority):
+                    stream_task = asyncio.create_task(_timed(
+                        timings, 'stream',
+                        _send_streamed_audio(bot, target_chat, track_info, track_kwargs, quality)
+                    ))
+            else:
+                download_task = asyncio.create_task(
+                    _timed(timings, 'download', _download_safe(track_info, priority, quality))
                 )
-                
-                if file_path:
-                    logger.info(f"✅ فایل دانلود شد: {file_path}")
-            except Exception as e:
-                logger.error(f"❌ خطا در دانلود: {e}")
+            if priority == PRIORITY_INTERACTIVE and process_pool.is_saturated():
+                await _notify_queue_busy(bot, user_id)
+        
+        lyrics = await _timed(timings, 'lyrics', _fetch_lyrics_safe(track_info))
         
-        # ارسال
-        if file_path and os.path.exists(file_path):
+        # مرحله 3: فرمت پیام (دانلود/استریم هنوز در جریانه)
+        format_started = time.perf_counter()
+        message_text = format_track_message(track_info, lyrics)
+        audio_kwargs = dict(
+            caption=message_text,
+            parse_mode=ParseMode.HTML,
+            **track_kwargs
+        )
+        timings['format'] = time.perf_counter() - format_started
+        
+        # مرحله 4: ارسال
+        upload_started = time.perf_counter()
+        sent = False
+        if cached_file_id:
+            # ارسال با file_id کش شده (بدون دانلود و آپلود)
+            sent = await _send_cached_audio(
+                bot, target_chat, track_info['id'], cached_file_id, audio_kwargs
+            )
+            if not sent:
+                download_task = asyncio.create_task(
+                    _timed(timings, 'download', _download_safe(track_info, priority, quality))
+                )
+        elif stream_task:
+            streamed = await stream_task
+            stream_task = None
+            if streamed:
+                await _attach_caption(bot, streamed, message_text)
+                sent = True
+            else:
+                download_task = asyncio.create_task(
+                    _timed(timings, 'download', _download_safe(track_info, priority, quality))
+                )
+        
+        file_path = None
+        if download_task:
+            wait_started = time.perf_counter()
+            file_path = await download_task
+            download_task = None
+            timings['download_wait'] = time.perf_counter() - wait_started
+            upload_started = time.perf_counter()
+        
+        if sent:
+            # قبلاً ارسال شد (file_id کش شده یا استریم)
+            pass
+        elif file_path and os.path.exists(file_path):
             logger.info("📤 ارسال فایل صوتی...")
             try:
                 with open(file_path, 'rb') as audio_file:
-                    await bot.send_audio(
+                    message = await bot.send_audio(
                         chat_id=target_chat,
                         audio=audio_file,
-                        caption=message_text,
-                        parse_mode=ParseMode.HTML,
-                        title=track_info['name'],
-                        performer=track_info['artist_str'],
-                        duration=int(track_info.get('duration_ms', 0) / 1000) if 'duration_ms' in track_info else None
+                        **audio_kwargs
                     )
                 logger.info("✅ فایل ارسال شد")
                 
-                # پاک کردن فایل
-                try:
-                    os.remove(file_path)
-                    logger.info("🗑️ فایل پاک شد")
-                except:
-                    pass
+                # فقط فایل کامل کش میشه، نه preview 30 ثانیه‌ای
+                is_preview = os.path.basename(file_path).startswith('preview_')
+                if message.audio and not is_preview:
+                    _save_cached_file_id(track_info['id'], message.audio)
+                
+                # فایل کامل در کش دیسک می‌مونه (eviction در پس‌زمینه)؛ preview پاک میشه
+                if is_preview:
+                    try:
+                        os.remove(file_path)
+                        logger.info("🗑️ فایل پاک شد")
+                    except:
+                        pass
                     
             except Exception as e:
                 logger.error(f"❌ خطا در ارسال فایل: {e}")
@@ -147,6 +507,7 @@ async def send_music_to_user(
                 text=message_text + "\n\n💡 از لینک Spotify گوش کن!",
                 parse_mode=ParseMode.HTML
             )
+        timings['upload'] = time.perf_counter() - upload_started
         
         # ذخیره در تاریخچه
         db = SessionLocal()
@@ -162,6 +523,12 @@ async def send_music_to_user(
         finally:
             db.close()
         
+        timings['total'] = time.perf_counter() - started
+        delivery_timings.record(timings)
+        logger.info(
+            "⏱ زمان ارسال: " + ", ".join(f"{k}={v:.2f}s" for k, v in timings.items())
+        )
+        
         return True
         
     except Exception as e:
@@ -175,6 +542,10 @@ async def send_music_to_user(
         except:
             pass
         return False
+    finally:
+        for task in (download_task, stream_task):
+            if task and not task.done():
+                task.cancel()
 
 
 async def send_random_music_now(bot: Bot, user_id: int):
@@ -1,109 +1,300 @@
 """
-Lyrics Service - چند API با fallback بهبود یافته
+Lyrics Service - چند API به صورت همزمان با مهلت کلی
 """
+import asyncio
 import logging
-import requests
-from typing import Optional
+import re
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
 from urllib.parse import quote
-import time
+
+from core.config import config
+from services.http_client import http_client, ServiceClient
 
 logger = logging.getLogger(__name__)
 
+# نشانگر "در کش نیست" (None یعنی miss کش شده)
+_NOT_CACHED = object()
 
-class LyricsService:
-    """سرویس دریافت متن آهنگ با چند منبع"""
+
+class LyricsCacheStore:
+    """
+    کش دو لایه متن آهنگ: LRU محدود در حافظه + جدول lyrics_cache
     
-    def __init__(self):
-        self.cache = {}  # کش ساده برای جلوگیری از درخواست‌های تکراری
-        logger.info("✅ Lyrics Service راه‌اندازی شد")
+    کلید اصلی Spotify id است و artist:title نرمال‌شده به عنوان fallback.
+    نبودِ متن هم (با TTL کوتاه‌تر) ذخیره میشه تا درخواست‌های بی‌نتیجه تکرار نشن.
+    """
     
-    def search_lyrics(
-        self, 
-        track_name: str, 
-        artist_name: str
-    ) -> Optional[str]:
-        """جستجو در چند API"""
+    def __init__(self, max_memory_entries: int, ttl: timedelta, miss_ttl: timedelta):
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._memory: "OrderedDict[str, Tuple[Optional[str], datetime]]" = OrderedDict()
+    
+    @staticmethod
+    def make_lookup_key(track_name: str, artist_name: str) -> str:
+        """کلید fallback نرمال‌شده"""
+        raw = f"{artist_name}:{track_name}".lower()
+        return re.sub(r'\s+', ' ', raw).strip()[:300]
+    
+    def _memory_get(self, key: str):
+        entry = self._memory.get(key)
+        if entry is None:
+            return _NOT_CACHED
         
-        # چک کش
-        cache_key = f"{artist_name}:{track_name}".lower()
-        if cache_key in self.cache:
-            logger.info("✅ Lyrics از کش")
-            return self.cache[cache_key]
-        
-        # روش 1: lyrics.ovh
-        lyrics = self._try_lyrics_ovh(track_name, artist_name)
-        if lyrics:
-            self.cache[cache_key] = lyrics
-            return lyrics
-        
-        # روش 2: API دیگر (اگر داری)
-        lyrics = self._try_alternative_api(track_name, artist_name)
-        if lyrics:
-            self.cache[cache_key] = lyrics
-            return lyrics
-        
-        logger.warning(f"❌ متن پیدا نشد: {track_name} - {artist_name}")
-        return None
-    
-    def _try_lyrics_ovh(self, track_name: str, artist_name: str) -> Optional[str]:
-        """تلاش با lyrics.ovh"""
+        lyrics, expires_at = entry
+        if expires_at <= datetime.utcnow():
+            del self._memory[key]
+            return _NOT_CACHED
+        
+        self._memory.move_to_end(key)
+        return lyrics
+    
+    def _memory_set(self, key: str, lyrics: Optional[str], expires_at: datetime):
+        self._memory[key] = (lyrics, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+    
+    def get(self, spotify_id: Optional[str], lookup_key: str):
+        """
+        Returns:
+            متن، None (miss کش شده) یا _NOT_CACHED
+        """
+        keys = [k for k in (spotify_id, lookup_key) if k]
+        
+        # لایه 1: حافظه
+        for key in keys:
+            lyrics = self._memory_get(key)
+            if lyrics is not _NOT_CACHED:
+                return lyrics
+        
+        # لایه 2: دیتابیس
+        from core.database import SessionLocal, LyricsCache
+        
+        db = SessionLocal()
         try:
-            url = f"https://api.lyrics.ovh/v1/{quote(artist_name)}/{quote(track_name)}"
+            entry = None
+            if spotify_id:
+                entry = db.query(LyricsCache).filter(
+                    LyricsCache.spotify_id == spotify_id
+                ).first()
+            if not entry:
+                entry = db.query(LyricsCache).filter(
+                    LyricsCache.lookup_key == lookup_key
+                ).first()
             
-            response = requests.get(
-                url,
-                timeout=10,
-                headers={'User-Agent': 'Mozilla/5.0'}
-            )
+            if not entry or (entry.expires_at and entry.expires_at <= datetime.utcnow()):
+                return _NOT_CACHED
+            
+            expires_at = entry.expires_at or datetime.utcnow() + self.ttl
+            for key in keys:
+                self._memory_set(key, entry.lyrics, expires_at)
+            return entry.lyrics
             
-            if response.status_code == 200:
-                data = response.json()
-                lyrics = data.get('lyrics')
-                
-                if lyrics and lyrics.strip():
-                    logger.info("✅ Lyrics از lyrics.ovh")
-                    return lyrics.strip()
-            elif response.status_code == 404:
-                logger.debug("⚠️ lyrics.ovh: آهنگ پیدا نشد")
-            else:
-                logger.debug(f"⚠️ lyrics.ovh: status {response.status_code}")
-                
-        except requests.exceptions.Timeout:
-            logger.warning("⏱️ lyrics.ovh: تایم‌اوت")
         except Exception as e:
-            logger.warning(f"⚠️ lyrics.ovh خطا: {e}")
-        
-        return None
+            logger.debug(f"⚠️ خطا در خواندن کش lyrics: {e}")
+            return _NOT_CACHED
+        finally:
+            db.close()
     
-    def _try_alternative_api(self, track_name: str, artist_name: str) -> Optional[str]:
-        """تلاش با API جایگزین"""
+    def set(self, spotify_id: Optional[str], lookup_key: str, lyrics: Optional[str]):
+        """ذخیره متن یا miss"""
+        from core.database import SessionLocal, LyricsCache
+        
+        now = datetime.utcnow()
+        expires_at = now + (self.ttl if lyrics else self.miss_ttl)
+        
+        for key in (spotify_id, lookup_key):
+            if key:
+                self._memory_set(key, lyrics, expires_at)
+        
+        db = SessionLocal()
         try:
-            # API دیگری که ممکنه کار کنه: api.textyl.co
-            url = "https://api.textyl.co/api/lyrics"
+            db.merge(LyricsCache(
+                spotify_id=spotify_id or lookup_key,
+                lookup_key=lookup_key,
+                lyrics=lyrics,
+                cached_at=now,
+                expires_at=expires_at
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در ذخیره کش lyrics: {e}")
+        finally:
+            db.close()
+
+
+class LyricsProviderError(Exception):
+    """خطای موقت منبع (نباید به عنوان miss کش بشه)"""
+
+
+class LyricsProvider(ABC):
+    """
+    رابط منبع متن آهنگ
+    
+    fetch باید متن رو برگردونه، None اگر منبع مطمئنه متنی نداره،
+    و در خطا/تایم‌اوت exception بده (تا به عنوان miss کش نشه).
+    """
+    
+    name = 'base'
+    
+    @abstractmethod
+    async def fetch(
+        self,
+        session: ServiceClient,
+        track_name: str,
+        artist_name: str
+    ) -> Optional[str]:
+        ...
+
+
+class LyricsOvhProvider(LyricsProvider):
+    """lyrics.ovh"""
+    
+    name = 'lyrics.ovh'
+    
+    async def fetch(self, session, track_name, artist_name):
+        url = f"https://api.lyrics.ovh/v1/{quote(artist_name)}/{quote(track_name)}"
+        
+        async with session.get(url) as response:
+            if response.status == 404:
+                logger.debug("⚠️ lyrics.ovh: آهنگ پیدا نشد")
+                return None
+            if response.status != 200:
+                raise LyricsProviderError(f"lyrics.ovh: status {response.status}")
+            
+            data = await response.json(content_type=None)
+            lyrics = (data or {}).get('lyrics')
+            return lyrics.strip() if lyrics and lyrics.strip() else None
+
+
+class TextylProvider(LyricsProvider):
+    """api.textyl.co"""
+    
+    name = 'textyl'
+    
+    async def fetch(self, session, track_name, artist_name):
+        url = "https://api.textyl.co/api/lyrics"
+        params = {'q': f"{artist_name} {track_name}"}
+        
+        async with session.get(url, params=params) as response:
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise LyricsProviderError(f"textyl: status {response.status}")
             
-            params = {
-                'q': f"{artist_name} {track_name}"
-            }
+            data = await response.json(content_type=None)
             
-            response = requests.get(
-                url,
-                params=params,
-                timeout=10,
-                headers={'User-Agent': 'Mozilla/5.0'}
-            )
+            # textyl گاهی لیست خطوط زمان‌دار برمی‌گردونه
+            if isinstance(data, list):
+                lyrics = '\n'.join(
+                    line.get('lyrics', '') for line in data if isinstance(line, dict)
+                )
+            else:
+                lyrics = (data or {}).get('lyrics')
             
-            if response.status_code == 200:
-                data = response.json()
-                lyrics = data.get('lyrics')
+            return lyrics.strip() if lyrics and lyrics.strip() else None
+
+
+class LyricsService:
+    """سرویس دریافت متن آهنگ با چند منبع (همزمان - اولین نتیجه برنده است)"""
+    
+    def __init__(self):
+        # کش دو لایه برای جلوگیری از درخواست‌های تکراری
+        self.cache = LyricsCacheStore(
+            max_memory_entries=config.LYRICS_MEMORY_CACHE_SIZE,
+            ttl=timedelta(days=config.LYRICS_TTL_DAYS),
+            miss_ttl=timedelta(hours=config.LYRICS_MISS_TTL_HOURS)
+        )
+        self.providers = [LyricsOvhProvider(), TextylProvider()]
+        self._http = http_client.for_service('lyrics', headers={'User-Agent': 'Mozilla/5.0'})
+        logger.info("✅ Lyrics Service راه‌اندازی شد")
+    
+    async def _race_providers(
+        self,
+        track_name: str,
+        artist_name: str,
+        deadline: float
+    ) -> Tuple[Optional[str], bool]:
+        """
+        اجرای همزمان همه منابع؛ اولین متن غیرخالی برنده است و بقیه لغو میشن
+        
+        Returns:
+            (متن, قطعی) - قطعی یعنی همه منابع جواب «نداریم» دادن
+        """
+        tasks = {
+            asyncio.create_task(provider.fetch(self._http, track_name, artist_name)): provider
+            for provider in self.providers
+        }
+        pending = set(tasks)
+        definitive = True
+        loop = asyncio.get_running_loop()
+        end_at = loop.time() + deadline
+        
+        try:
+            while pending:
+                remaining = end_at - loop.time()
+                if remaining <= 0:
+                    logger.warning(f"⏱️ Lyrics: مهلت {deadline} ثانیه تمام شد")
+                    return None, False
                 
-                if lyrics and lyrics.strip():
-                    logger.info("✅ Lyrics از API جایگزین")
-                    return lyrics.strip()
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=remaining,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                
+                for task in done:
+                    provider = tasks[task]
+                    try:
+                        lyrics = task.result()
+                    except Exception as e:
+                        definitive = False
+                        logger.debug(f"⚠️ {provider.name} خطا: {e!r}")
+                        continue
                     
-        except Exception as e:
-            logger.debug(f"⚠️ API جایگزین: {e}")
+                    if lyrics:
+                        logger.info(f"✅ Lyrics از {provider.name}")
+                        return lyrics, True
+            
+            return None, definitive
+            
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def search_lyrics(
+        self, 
+        track_name: str, 
+        artist_name: str,
+        spotify_id: Optional[str] = None
+    ) -> Optional[str]:
+        """جستجو در چند API"""
+        
+        # چک کش
+        lookup_key = self.cache.make_lookup_key(track_name, artist_name)
+        cached = self.cache.get(spotify_id, lookup_key)
+        if cached is not _NOT_CACHED:
+            logger.info("✅ Lyrics از کش" if cached else "💤 Lyrics: قبلاً پیدا نشده بود (کش)")
+            return cached
+        
+        lyrics, definitive = await self._race_providers(
+            track_name,
+            artist_name,
+            deadline=config.LYRICS_DEADLINE_SECONDS
+        )
         
-        return None
+        if not lyrics:
+            logger.warning(f"❌ متن پیدا نشد: {track_name} - {artist_name}")
+        
+        # خطا/تایم‌اوت کش نمیشه تا دفعه بعد دوباره امتحان بشه
+        if lyrics or definitive:
+            self.cache.set(spotify_id, lookup_key, lyrics)
+        return lyrics
     
     def format_lyrics_for_telegram(
         self, 
@@ -134,30 +325,36 @@ class LyricsService:
 lyrics_service = LyricsService()
 
 
-def get_track_lyrics(
+async def get_track_lyrics(
     track_name: str,
-    artist_name: str
+    artist_name: str,
+    spotify_id: Optional[str] = None
 ) -> Optional[str]:
     """دریافت lyrics"""
-    return lyrics_service.search_lyrics(track_name, artist_name)
+    return await lyrics_service.search_lyrics(track_name, artist_name, spotify_id)
 
 
 # تست
 if __name__ == "__main__":
-    print("🧪 تست Lyrics Service...")
-    
-    test_cases = [
-        ("Blinding Lights", "The Weeknd"),
-        ("Shape of You", "Ed Sheeran"),
-    ]
-    
-    for track, artist in test_cases:
-        print(f"\n🎵 {track} - {artist}")
-        lyrics = get_track_lyrics(track, artist)
-        
-        if lyrics:
-            formatted = lyrics_service.format_lyrics_for_telegram(lyrics)
-            print(f"✅ پیدا شد ({len(lyrics)} حرف)")
-            print(f"Preview:\n{formatted[:200]}...")
-        else:
-            print("❌ پیدا نشد")
\ No newline at end of file
+    async def _main():
+        print("🧪 تست Lyrics Service...")
+        
+        test_cases = [
+            ("Blinding Lights", "The Weeknd"),
+            ("Shape of You", "Ed Sheeran"),
+        ]
+        
+        for track, artist in test_cases:
+            print(f"\n🎵 {track} - {artist}")
+            lyrics = await get_track_lyrics(track, artist)
+            
+            if lyrics:
+                formatted = lyrics_service.format_lyrics_for_telegram(lyrics)
+                print(f"✅ پیدا شد ({len(lyrics)} حرف)")
+                print(f"Preview:\n{formatted[:200]}...")
+            else:
+                print("❌ پیدا نشد")
+        
+        await http_client.close()
+    
+    asyncio.run(_main())
\ No newline at end of file
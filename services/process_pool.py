@@ -0,0 +1,128 @@
+"""
+صف سراسری پروسه‌های yt-dlp/ffmpeg با اولویت
+
+هر پروسه خارجی (دانلود، استخراج صدا، اینستاگرام) قبل از اجرا یک slot
+می‌گیره؛ حداکثر PROCESS_WORKERS پروسه همزمان اجرا میشن و بقیه توی صف
+منتظر می‌مونن. درخواست‌های تعاملی (/search، تشخیص آهنگ) قبل از ارسال‌های
+زمان‌بندی شده روزانه slot می‌گیرن.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, List, Optional
+
+from core.config import config
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SCHEDULED = 1
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_SCHEDULED: 'scheduled',
+}
+
+# اولویت درخواست جاری (به task های فرزند هم ارث می‌رسه)
+_current_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    'process_priority', default=PRIORITY_INTERACTIVE
+)
+
+
+@contextmanager
+def process_priority(level: int):
+    """تعیین اولویت پروسه‌هایی که داخل این بلاک (و task های ساخته شده در آن) اجرا میشن"""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class ProcessPool:
+    """محدودکننده تعداد پروسه‌های همزمان با صف اولویت‌دار"""
+
+    def __init__(self, workers: int, saturation: int):
+        self.workers = max(1, workers)
+        self.saturation = max(1, saturation)
+        self._active = 0
+        self._queue: List[tuple] = []  # (priority, seq, future)
+        self._seq = itertools.count()
+
+        self.max_queued = 0
+        self.started = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.wait_seconds = {name: 0.0 for name in PRIORITY_NAMES.values()}
+
+    def queue_depth(self, level: Optional[int] = None) -> int:
+        """تعداد منتظرهای صف (در صورت نیاز فقط یک اولویت)"""
+        return sum(
+            1 for prio, _, fut in self._queue
+            if not fut.done() and (level is None or prio == level)
+        )
+
+    def is_saturated(self) -> bool:
+        """همه worker ها مشغولن و صف از آستانه رد شده"""
+        return self._active >= self.workers and self.queue_depth() >= self.saturation
+
+    @asynccontextmanager
+    async def slot(self):
+        """گرفتن یک slot برای اجرای پروسه"""
+        level = _current_priority.get()
+        enqueued = time.perf_counter()
+
+        if self._active < self.workers and self.queue_depth() == 0:
+            self._active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (level, next(self._seq), fut))
+            self.max_queued = max(self.max_queued, self.queue_depth())
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # slot قبل از لغو به ما رسیده بود - به نفر بعدی بدیم
+                if fut.done() and not fut.cancelled():
+                    self._release()
+                raise
+
+        name = PRIORITY_NAMES.get(level, str(level))
+        self.started[name] = self.started.get(name, 0) + 1
+        self.wait_seconds[name] = self.wait_seconds.get(name, 0.0) + time.perf_counter() - enqueued
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        """تحویل slot به منتظر با بالاترین اولویت (یا آزاد کردنش)"""
+        while self._queue:
+            _, _, fut = heapq.heappop(self._queue)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """عمق صف و میانگین انتظار به تفکیک اولویت"""
+        return {
+            'workers': self.workers,
+            'active': self._active,
+            'queued': {
+                name: self.queue_depth(level) for level, name in PRIORITY_NAMES.items()
+            },
+            'max_queued': self.max_queued,
+            'saturated': self.is_saturated(),
+            'started': dict(self.started),
+            'avg_wait': {
+                name: round(self.wait_seconds[name] / count, 3)
+                for name, count in self.started.items() if count
+            },
+        }
+
+
+# Singleton
+process_pool = ProcessPool(config.PROCESS_WORKERS, config.PROCESS_QUEUE_SATURATION)
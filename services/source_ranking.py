@@ -0,0 +1,110 @@
+"""
+رتبه‌بندی کاندیدهای YouTube قبل از دانلود
+
+نتایج جستجو (فقط metadata) بر اساس نزدیکی مدت زمان به Spotify،
+اشتراک کلمات عنوان/هنرمند و نشانه‌های کانال امتیاز می‌گیرن و فقط
+بهترین کاندید دانلود میشه.
+"""
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.config import config
+
+# فیلدهای لازم از نتایج flat جستجو
+CANDIDATE_FIELDS = (
+    'id', 'title', 'duration', 'channel', 'uploader',
+    'channel_is_verified', 'view_count', 'live_status',
+)
+
+# نسخه‌های غیر اصلی (اگر توی اسم خود آهنگ نباشن)
+NEGATIVE_KEYWORDS = {
+    'live', 'cover', 'remix', 'karaoke', 'instrumental', 'sped', 'slowed',
+    'reverb', 'nightcore', '8d', 'reaction', 'tutorial', 'lesson', 'acoustic',
+    'لایو', 'کاور', 'ریمیکس', 'بیکلام',
+}
+
+STOPWORDS = {'the', 'a', 'an', 'feat', 'ft', 'and', 'of', 'official', 'audio', 'video'}
+
+# وزن هر سیگنال (مجموع حداکثر ~1)
+WEIGHT_DURATION = 0.45
+WEIGHT_TITLE = 0.30
+WEIGHT_ARTIST = 0.15
+WEIGHT_CHANNEL = 0.10
+# بیشتر از (1 - CANDIDATE_MIN_SCORE): حتی کاوری با مدت زمان و عنوان کاملاً
+# یکسان هم از آستانه رد نمیشه
+PENALTY_KEYWORD = 0.6
+
+
+def _tokens(text: Optional[str]) -> set:
+    """کلمات نرمال‌شده (فارسی هم پشتیبانی میشه)"""
+    return set(re.findall(r'\w+', (text or '').lower()))
+
+
+def score_candidate(
+    candidate: Dict[str, Any],
+    track_name: str,
+    artist_name: str,
+    duration_ms: Optional[int] = None
+) -> Optional[float]:
+    """
+    امتیاز یک کاندید؛ None یعنی کاملاً رد شده (لایو، مدت زمان نامربوط)
+    """
+    if candidate.get('live_status') in ('is_live', 'is_upcoming'):
+        return None
+
+    duration = candidate.get('duration')
+    score = 0.0
+
+    # مدت زمان
+    if duration_ms and duration:
+        delta = abs(duration * 1000 - duration_ms) / 1000
+        if delta > config.CANDIDATE_MAX_DURATION_DELTA:
+            return None
+        score += WEIGHT_DURATION * (1 - delta / config.CANDIDATE_MAX_DURATION_DELTA)
+    elif duration and duration <= 60:
+        return None
+
+    title_tokens = _tokens(candidate.get('title'))
+    channel = candidate.get('channel') or candidate.get('uploader') or ''
+    channel_tokens = _tokens(channel)
+    track_tokens = _tokens(track_name) - STOPWORDS
+    artist_tokens = _tokens(artist_name) - STOPWORDS
+
+    # اشتراک کلمات
+    if track_tokens:
+        score += WEIGHT_TITLE * len(track_tokens & title_tokens) / len(track_tokens)
+    if artist_tokens:
+        score += WEIGHT_ARTIST * len(artist_tokens & (title_tokens | channel_tokens)) / len(artist_tokens)
+
+    # نشانه‌های کانال: "Artist - Topic" (صدای رسمی)، VEVO، کانال خود هنرمند
+    if channel.endswith(' - Topic'):
+        score += WEIGHT_CHANNEL
+    elif 'vevo' in channel.lower() or (artist_tokens and artist_tokens <= channel_tokens):
+        score += WEIGHT_CHANNEL * 0.8
+    if candidate.get('channel_is_verified'):
+        score += WEIGHT_CHANNEL * 0.2
+
+    # نسخه‌های غیر اصلی
+    for keyword in (NEGATIVE_KEYWORDS & title_tokens) - track_tokens:
+        score -= PENALTY_KEYWORD
+
+    return score
+
+
+def rank_candidates(
+    candidates: List[Dict[str, Any]],
+    track_name: str,
+    artist_name: str,
+    duration_ms: Optional[int] = None
+) -> List[Tuple[float, Dict[str, Any]]]:
+    """کاندیدهای قابل قبول (امتیاز >= CANDIDATE_MIN_SCORE) از بهترین به بدترین"""
+    ranked = []
+    for candidate in candidates:
+        if not candidate or not candidate.get('id'):
+            continue
+        score = score_candidate(candidate, track_name, artist_name, duration_ms)
+        if score is not None and score >= config.CANDIDATE_MIN_SCORE:
+            ranked.append((score, candidate))
+
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
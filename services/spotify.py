@@ -1,24 +1,246 @@
 """
-<<<<<<< HEAD
-Spotify Service - بهبود یافته برای آهنگ‌های فارسی + جلوگیری از تکرار
-=======
-Spotify Service - با جستجوی بهبود یافته + ژانرهای جدید
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
+Spotify Service - کلاینت async روی aiohttp + آهنگ‌های فارسی + جلوگیری از تکرار
 """
+import asyncio
+import base64
+import hashlib
+import json
 import random
+import re
+import time
 import logging
-from typing import Optional, List, Dict, Any
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Iterable, Tuple
 from core.config import config
+from services.http_client import http_client
 
 logger = logging.getLogger(__name__)
 
 
-class SpotifyService:
-    """کلاس اصلی برای کار با Spotify API"""
+class SpotifyError(Exception):
+    """خطای برگشتی از Spotify Web API"""
+
+    def __init__(self, status: int, message: str = ''):
+        super().__init__(f"Spotify API {status}: {message}")
+        self.status = status
+
+
+def _strip_markets(data):
+    """حذف available_markets (بخش عمده حجم پاسخ و بی‌استفاده برای ما)"""
+    if isinstance(data, dict):
+        return {
+            k: _strip_markets(v) for k, v in data.items()
+            if k != 'available_markets'
+        }
+    if isinstance(data, list):
+        return [_strip_markets(v) for v in data]
+    return data
+
+
+class SpotifyResponseCache:
+    """
+    کش دو لایه پاسخ‌های Spotify: LRU محدود در حافظه + جدول spotify_cache
     
-<<<<<<< HEAD
+    کلید: (path, query نرمال‌شده, type, market, limit) - هر ورودی TTL خودش رو داره
+    و وقتی تعداد از max_entries بیشتر بشه، قدیمی‌ترین دسترسی‌ها (LRU) حذف میشن.
+    hit های لایه حافظه هیچ کار دیتابیسی ندارن؛ hit_count/last_access_at
+    جمع میشن و همراه نوشتن بعدی یک‌جا ثبت میشن. کوئری‌ها کوتاهن و مثل
+    بقیه کد روی همون event loop اجرا میشن (روی SQLite همه session ها یک
+    connection مشترک دارن و commit از thread دیگه وسط تراکنش بقیه می‌افته).
+    """
+
+    # هر چند بار نوشتن یک بار چک اندازه
+    EVICT_EVERY = 50
+
+    def __init__(self, ttl_minutes: int, max_entries: int, memory_entries: int):
+        self.ttl = timedelta(minutes=ttl_minutes)
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        # key -> (JSON پاسخ, زمان انقضا)
+        self._memory: "OrderedDict[str, Tuple[str, datetime]]" = OrderedDict()
+        # دسترسی‌های ثبت نشده: key -> (آخرین دسترسی, تعداد hit)
+        self._accessed: Dict[str, Tuple[datetime, int]] = {}
+
+    @staticmethod
+    def make_key(path: str, params: Dict[str, Any]) -> str:
+        """کلید نرمال‌شده"""
+        normalized = {}
+        for key, value in params.items():
+            if key == 'q':
+                value = re.sub(r'\s+', ' ', str(value)).strip().lower()
+            normalized[key] = value
+        raw = json.dumps([path, sorted(normalized.items())], ensure_ascii=False, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _memory_get(self, key: str, now: datetime) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+
+        payload, expires_at = entry
+        if expires_at <= now:
+            del self._memory[key]
+            return None
+
+        self._memory.move_to_end(key)
+        return payload
+
+    def _memory_set(self, key: str, payload: str, expires_at: datetime):
+        self._memory[key] = (payload, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key: str, now: datetime):
+        _, count = self._accessed.get(key, (now, 0))
+        self._accessed[key] = (now, count + 1)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """خواندن از کش (None اگر نیست یا منقضی شده)"""
+        now = datetime.utcnow()
+
+        payload = self._memory_get(key, now)
+        if payload is not None:
+            self.memory_hits += 1
+        else:
+            loaded = self._load(key, now)
+            if loaded is None:
+                self.misses += 1
+                return None
+            payload, expires_at = loaded
+            self._memory_set(key, payload, expires_at)
+
+        self.hits += 1
+        self._touch(key, now)
+        return json.loads(payload)
+
+    def _load(self, key: str, now: datetime) -> Optional[Tuple[str, datetime]]:
+        """خواندن فقط‌خواندنی از دیتابیس"""
+        from core.database import SessionLocal, SpotifyCache
+
+        db = SessionLocal()
+        try:
+            entry = db.query(
+                SpotifyCache.response, SpotifyCache.expires_at
+            ).filter(SpotifyCache.cache_key == key).first()
+
+            if not entry or entry.expires_at <= now:
+                return None
+            return entry.response, entry.expires_at
+
+        except Exception as e:
+            logger.debug(f"⚠️ خطا در خواندن کش Spotify: {e}")
+            return None
+        finally:
+            db.close()
+
+    async def set(self, key: str, path: str, response: Dict[str, Any], ttl: Optional[timedelta] = None):
+        """ذخیره پاسخ در کش (همراه ثبت دسترسی‌های جمع شده)"""
+        now = datetime.utcnow()
+        expires_at = now + (ttl or self.ttl)
+        payload = json.dumps(response, ensure_ascii=False)
+        self._memory_set(key, payload, expires_at)
+
+        self._writes += 1
+        evict = self._writes % self.EVICT_EVERY == 0
+        accessed, self._accessed = self._accessed, {}
+        self._store(key, path, payload, now, expires_at, accessed, evict)
+
+    def _store(
+        self,
+        key: str,
+        path: str,
+        payload: str,
+        now: datetime,
+        expires_at: datetime,
+        accessed: Dict[str, Tuple[datetime, int]],
+        evict: bool
+    ):
+        """نوشتن در دیتابیس"""
+        from sqlalchemy import func
+        from core.database import SessionLocal, SpotifyCache
+
+        db = SessionLocal()
+        try:
+            db.merge(SpotifyCache(
+                cache_key=key,
+                path=path,
+                response=payload,
+                created_at=now,
+                expires_at=expires_at,
+                last_access_at=now,
+                hit_count=0
+            ))
+
+            for accessed_key, (last_access_at, count) in accessed.items():
+                db.query(SpotifyCache).filter(
+                    SpotifyCache.cache_key == accessed_key
+                ).update({
+                    SpotifyCache.last_access_at: last_access_at,
+                    SpotifyCache.hit_count: func.coalesce(SpotifyCache.hit_count, 0) + count,
+                }, synchronize_session=False)
+            db.commit()
+
+            if evict:
+                self._evict(db)
+
+        except Exception as e:
+            db.rollback()
+            logger.debug(f"⚠️ خطا در ذخیره کش Spotify: {e}")
+        finally:
+            db.close()
+
+    def _evict(self, db):
+        """حذف منقضی‌ها و سپس LRU تا رسیدن به max_entries"""
+        from core.database import SpotifyCache
+
+        removed = db.query(SpotifyCache).filter(
+            SpotifyCache.expires_at <= datetime.utcnow()
+        ).delete(synchronize_session=False)
+
+        overflow = db.query(SpotifyCache).count() - self.max_entries
+        if overflow > 0:
+            oldest = db.query(SpotifyCache.cache_key).order_by(
+                SpotifyCache.last_access_at.asc()
+            ).limit(overflow).subquery()
+            removed += db.query(SpotifyCache).filter(
+                SpotifyCache.cache_key.in_(oldest.select())
+            ).delete(synchronize_session=False)
+
+        db.commit()
+        if removed:
+            self.evictions += removed
+            logger.info(f"🗑️ {removed} ورودی از کش Spotify حذف شد")
+
+    def stats(self) -> Dict[str, Any]:
+        """آمار hit/miss"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'memory_entries': len(self._memory),
+            'pending_access_updates': len(self._accessed),
+        }
+
+
+class SpotifyService:
+    """کلاس اصلی برای کار با Spotify API (کاملاً async)"""
+
+    API_BASE = 'https://api.spotify.com/v1'
+    TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+    # حداکثر درخواست همزمان به Spotify (برای جلوگیری از 429)
+    MAX_CONCURRENT_REQUESTS = 8
+
     # هنرمندان فارسی محبوب - گسترش یافته
     PERSIAN_ARTISTS = {
         'persian_pop': [
@@ -47,7 +269,7 @@ class SpotifyService:
             'Amir Khalvat', 'Mehrad Hidden', 'AFX',
         ]
     }
-    
+
     # کلمات کلیدی برای جستجو
     GENRE_KEYWORDS = {
         'persian_pop': [
@@ -62,12 +284,8 @@ class SpotifyService:
             'persian rap', 'iranian rap', 'farsi rap',
             'persian hip hop', 'iranian hip hop',
         ],
-        
+
         # جهانی
-=======
-    # نقشه ژانرها به کلمات کلیدی جستجو - بهبود یافته
-    GENRE_KEYWORDS = {
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
         'pop': ['pop', 'pop music', 'popular'],
         'rock': ['rock', 'rock music', 'alternative rock'],
         'hiphop': ['hip hop', 'rap', 'hip-hop', 'rapper'],
@@ -78,114 +296,212 @@ class SpotifyService:
         'country': ['country', 'country music', 'nashville'],
         'rnb': ['r&b', 'rnb', 'soul'],
         'reggae': ['reggae', 'ska', 'dancehall'],
-<<<<<<< HEAD
         'latin': ['latin', 'reggaeton', 'salsa'],
         'kpop': ['kpop', 'korean pop', 'k-pop'],
         'indie': ['indie', 'independent'],
         'blues': ['blues'],
         'folk': ['folk', 'acoustic'],
-=======
-        'latin': ['latin', 'reggaeton', 'salsa', 'bachata'],
-        'kpop': ['kpop', 'korean pop', 'k-pop', 'korean music'],
-        'indie': ['indie', 'independent', 'indie rock', 'indie pop'],
-        'blues': ['blues', 'blues music', 'rhythm and blues'],
-        'folk': ['folk', 'folk music', 'acoustic'],
-        # ژانرهای جدید
-        'persian': ['persian music', 'iranian music', 'farsi', 'persian pop'],
-        'arabic': ['arabic music', 'arab', 'middle eastern'],
-        'turkish': ['turkish music', 'turkish pop', 'türkçe']
     }
-    
-    # پلی‌لیست‌های محبوب برای هر ژانر
+
+    # پلی‌لیست‌های محبوب برای هر ژانر (fallback وقتی نتیجه کمه)
     POPULAR_PLAYLISTS = {
         'pop': ['Today\'s Top Hits', 'Pop Rising', 'Pop Mix'],
         'rock': ['Rock Classics', 'Rock Mix', 'Alternative Rock'],
         'hiphop': ['RapCaviar', 'Hip Hop Mix', 'Most Necessary'],
         'electronic': ['mint', 'Dance Rising', 'Electronic Mix'],
         'kpop': ['K-Pop ON!', 'K-Pop Daebak', 'K-Pop Rising'],
-        'persian': ['Persian Pop', 'Iranian Music', 'Farsi Hits'],
-        'arabic': ['Arabic Pop', 'Top Arabic', 'Arabic Hits'],
-        'turkish': ['Turkish Pop', 'Türkçe Pop', 'Turkish Hits']
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
+        'persian_pop': ['Persian Pop', 'Iranian Music', 'Farsi Hits'],
     }
-    
+
     def __init__(self):
         """راه‌اندازی Spotify client"""
-        if not config.SPOTIFY_CLIENT_ID or not config.SPOTIFY_CLIENT_SECRET:
+        self.client_id = config.SPOTIFY_CLIENT_ID
+        self.client_secret = config.SPOTIFY_CLIENT_SECRET
+
+        self._http = http_client.for_service('spotify')
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self._request_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+
+        self.cache = SpotifyResponseCache(
+            ttl_minutes=config.SPOTIFY_CACHE_TTL_MINUTES,
+            max_entries=config.SPOTIFY_CACHE_MAX_ENTRIES,
+            memory_entries=config.SPOTIFY_MEMORY_CACHE_SIZE
+        )
+
+        # pool کاندیدهای هر ژانر: genre -> (زمان ساخت, لیست آهنگ‌های فرمت‌شده)
+        self._genre_pools: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._genre_pool_locks: Dict[str, asyncio.Lock] = {}
+
+        if not self.client_id or not self.client_secret:
             logger.warning("⚠️ Spotify credentials موجود نیست!")
-            self.sp = None
             return
-        
-        try:
-            auth_manager = SpotifyClientCredentials(
-                client_id=config.SPOTIFY_CLIENT_ID,
-                client_secret=config.SPOTIFY_CLIENT_SECRET
-            )
-            self.sp = spotipy.Spotify(auth_manager=auth_manager)
-            logger.info("✅ Spotify Service راه‌اندازی شد")
-        except Exception as e:
-            logger.error(f"❌ خطا در راه‌اندازی Spotify: {e}")
-            self.sp = None
-    
+
+        logger.info("✅ Spotify Service راه‌اندازی شد")
+
     def is_available(self) -> bool:
         """بررسی در دسترس بودن سرویس"""
-        return self.sp is not None
-    
-    def search_tracks_by_genre(
-        self, 
-        genre: str, 
+        return bool(self.client_id and self.client_secret)
+
+    # ==================== HTTP / Token ====================
+
+    async def _get_token(self, force_refresh: bool = False) -> str:
+        """دریافت/تمدید access token با Client Credentials"""
+        async with self._token_lock:
+            # 60 ثانیه حاشیه قبل از انقضا
+            if not force_refresh and self._token and time.time() < self._token_expires_at - 60:
+                return self._token
+
+            credentials = base64.b64encode(
+                f"{self.client_id}:{self.client_secret}".encode()
+            ).decode()
+
+            async with self._http.post(
+                self.TOKEN_URL,
+                data={'grant_type': 'client_credentials'},
+                headers={'Authorization': f'Basic {credentials}'}
+            ) as response:
+                if response.status != 200:
+                    raise SpotifyError(response.status, await response.text())
+                payload = await response.json()
+
+            self._token = payload['access_token']
+            self._token_expires_at = time.time() + int(payload.get('expires_in', 3600))
+            logger.info("🔑 Spotify token تمدید شد")
+            return self._token
+
+    async def _request(
+        self,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        max_retries: int = 2,
+        use_cache: bool = True
+    ) -> Dict[str, Any]:
+        """درخواست GET به Web API با کش پایدار و مدیریت 401 و 429"""
+        if not self.is_available():
+            raise SpotifyError(0, "credentials موجود نیست")
+
+        params = {k: v for k, v in (params or {}).items() if v not in (None, '')}
+
+        cache_key = None
+        if use_cache:
+            cache_key = self.cache.make_key(path, params)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        response = _strip_markets(await self._fetch(path, params, max_retries))
+
+        if cache_key:
+            await self.cache.set(cache_key, path, response)
+
+        return response
+
+    async def _fetch(
+        self,
+        path: str,
+        params: Dict[str, Any],
+        max_retries: int
+    ) -> Dict[str, Any]:
+        """درخواست واقعی به Web API"""
+        url = f"{self.API_BASE}{path}"
+        force_refresh = False
+
+        for attempt in range(max_retries + 1):
+            token = await self._get_token(force_refresh=force_refresh)
+
+            async with self._request_semaphore:
+                async with self._http.get(
+                    url,
+                    params=params,
+                    headers={'Authorization': f'Bearer {token}'}
+                ) as response:
+                    if response.status == 200:
+                        return await response.json()
+
+                    if response.status == 401 and attempt < max_retries:
+                        # token منقضی شده
+                        force_refresh = True
+                        continue
+
+                    if response.status == 429 and attempt < max_retries:
+                        retry_after = int(response.headers.get('Retry-After', '1'))
+                        logger.warning(f"⏳ Spotify rate limit - {retry_after} ثانیه صبر")
+                        await asyncio.sleep(min(retry_after, 10))
+                        continue
+
+                    raise SpotifyError(response.status, await response.text())
+
+        raise SpotifyError(0, "تعداد تلاش‌ها تمام شد")
+
+    # ==================== API Surface ====================
+
+    async def search(
+        self,
+        q: str,
+        type: str = 'track',
+        limit: int = 10,
+        market: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """جستجو (همان خروجی spotipy.search)"""
+        return await self._request('/search', {
+            'q': q,
+            'type': type,
+            'limit': min(limit, 50),
+            'market': market,
+        })
+
+    async def playlist_tracks(
+        self,
+        playlist_id: str,
+        limit: int = 100
+    ) -> Dict[str, Any]:
+        """آهنگ‌های یک playlist"""
+        return await self._request(f'/playlists/{playlist_id}/tracks', {
+            'limit': min(limit, 100),
+        })
+
+    async def _search_items(
+        self,
+        q: str,
+        limit: int,
+        market: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """جستجوی track و برگرداندن فقط لیست items"""
+        results = await self.search(q=q, type='track', limit=limit, market=market)
+        return results.get('tracks', {}).get('items', []) or []
+
+    # ==================== Genre Search ====================
+
+    async def search_tracks_by_genre(
+        self,
+        genre: str,
         limit: int = 100,
         market: str = ''
     ) -> List[Dict[str, Any]]:
-<<<<<<< HEAD
         """جستجوی آهنگ با تعداد بیشتر"""
-=======
-        """جستجوی آهنگ بر اساس ژانر - روش بهبود یافته با fallback"""
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
         if not self.is_available():
             logger.error("❌ Spotify Service در دسترس نیست")
             return []
-        
+
         all_tracks = []
-        
+
         try:
-<<<<<<< HEAD
             # استراتژی ویژه برای ژانرهای فارسی
             if genre.startswith('persian_'):
-                all_tracks = self._search_persian_tracks(genre, limit)
+                all_tracks = await self._search_persian_tracks(genre, limit)
             else:
                 # جستجوی عادی
-                all_tracks = self._search_global_tracks(genre, limit, market)
-=======
-            # روش 1: جستجو با چند keyword
-            keywords = self.GENRE_KEYWORDS.get(genre, [genre])
-            
-            for keyword in keywords[:3]:  # سه کلمه اول
-                try:
-                    results = self.sp.search(
-                        q=keyword,
-                        type='track',
-                        limit=20,
-                        market=market
-                    )
-                    
-                    if results['tracks']['items']:
-                        all_tracks.extend(results['tracks']['items'])
-                        
-                    if len(all_tracks) >= limit:
-                        break
-                        
-                except Exception as e:
-                    logger.warning(f"⚠️ خطا در جستجو با '{keyword}': {e}")
-                    continue
-            
-            # روش 2: جستجو در پلی‌لیست‌های محبوب
+                all_tracks = await self._search_global_tracks(genre, limit, market)
+
+            # اگر نتیجه کم بود، از playlist‌ها کمک بگیر
             if len(all_tracks) < 20:
                 logger.info(f"⚠️ نتیجه کم ({len(all_tracks)}), جستجو در playlist‌ها...")
-                playlist_tracks = self._search_from_playlists(genre, limit - len(all_tracks))
-                all_tracks.extend(playlist_tracks)
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
-            
+                all_tracks.extend(
+                    await self._search_from_playlists(genre, limit - len(all_tracks))
+                )
+
             # حذف تکراری بر اساس track ID
             seen_ids = set()
             unique_tracks = []
@@ -193,243 +509,220 @@ class SpotifyService:
                 if track and track.get('id') and track['id'] not in seen_ids:
                     seen_ids.add(track['id'])
                     unique_tracks.append(track)
-            
+
             logger.info(f"✅ {len(unique_tracks)} آهنگ یونیک از ژانر {genre}")
             return unique_tracks[:limit]
-            
+
         except Exception as e:
             logger.error(f"❌ خطا در جستجو: {e}")
             return []
-    
-<<<<<<< HEAD
-    def _search_persian_tracks(self, genre: str, limit: int) -> List[Dict[str, Any]]:
+
+    async def _search_persian_tracks(self, genre: str, limit: int) -> List[Dict[str, Any]]:
         """جستجوی گسترده برای آهنگ‌های فارسی"""
         all_tracks = []
-        
+
         try:
             artists = self.PERSIAN_ARTISTS.get(genre, [])
-            
-            # روش 1: جستجوی هنرمندان (تعداد بیشتر)
-            for artist in artists:
-                try:
-                    results = self.sp.search(
-                        q=f'artist:"{artist}"',
-                        type='track',
-                        limit=20,  # افزایش به 20
-                        market=''
-                    )
-                    
-                    if results['tracks']['items']:
-                        all_tracks.extend(results['tracks']['items'])
-                        logger.info(f"✅ {len(results['tracks']['items'])} آهنگ از {artist}")
-                    
-                    if len(all_tracks) >= limit:
-                        break
-                        
-                except Exception as e:
-                    logger.debug(f"⚠️ خطا در جستجوی {artist}: {e}")
-                    continue
-            
+
+            # روش 1: جستجوی هنرمندان - دسته‌های همزمان تا رسیدن به limit
+            batch_size = self.MAX_CONCURRENT_REQUESTS
+            for i in range(0, len(artists), batch_size):
+                batch = artists[i:i + batch_size]
+                results = await asyncio.gather(
+                    *(self._search_items(f'artist:"{artist}"', limit=20) for artist in batch),
+                    return_exceptions=True
+                )
+
+                for artist, items in zip(batch, results):
+                    if isinstance(items, Exception):
+                        logger.debug(f"⚠️ خطا در جستجوی {artist}: {items}")
+                        continue
+                    if items:
+                        all_tracks.extend(items)
+                        logger.info(f"✅ {len(items)} آهنگ از {artist}")
+
+                if len(all_tracks) >= limit:
+                    break
+
             # روش 2: جستجو با کلمات کلیدی
             if len(all_tracks) < 50:
                 keywords = self.GENRE_KEYWORDS.get(genre, [])
-                for keyword in keywords:
-                    try:
-                        results = self.sp.search(
-                            q=keyword,
-                            type='track',
-                            limit=30,
-                            market=''
-                        )
-                        
-                        if results['tracks']['items']:
-                            all_tracks.extend(results['tracks']['items'])
-                            
-                    except:
-                        continue
-            
+                results = await asyncio.gather(
+                    *(self._search_items(keyword, limit=30) for keyword in keywords),
+                    return_exceptions=True
+                )
+                for items in results:
+                    if not isinstance(items, Exception) and items:
+                        all_tracks.extend(items)
+
             logger.info(f"✅ مجموع {len(all_tracks)} آهنگ فارسی پیدا شد")
             return all_tracks
-            
+
         except Exception as e:
             logger.error(f"❌ خطا در جستجوی فارسی: {e}")
             return []
-    
-    def _search_global_tracks(
-        self, 
-        genre: str, 
+
+    async def _search_global_tracks(
+        self,
+        genre: str,
         limit: int,
         market: str
     ) -> List[Dict[str, Any]]:
         """جستجوی آهنگ‌های جهانی"""
         all_tracks = []
-        
-        keywords = self.GENRE_KEYWORDS.get(genre, [genre])
-        
-        for keyword in keywords[:3]:
-            try:
-                results = self.sp.search(
-                    q=keyword,
-                    type='track',
-                    limit=50,
-                    market=market or 'US'
-                )
-                
-                if results['tracks']['items']:
-                    all_tracks.extend(results['tracks']['items'])
-                    
-                if len(all_tracks) >= limit:
-                    break
-                    
-            except Exception as e:
-                logger.warning(f"⚠️ خطا در جستجو با '{keyword}': {e}")
+
+        keywords = self.GENRE_KEYWORDS.get(genre, [genre])[:3]
+        results = await asyncio.gather(
+            *(self._search_items(keyword, limit=50, market=market or 'US') for keyword in keywords),
+            return_exceptions=True
+        )
+
+        for keyword, items in zip(keywords, results):
+            if isinstance(items, Exception):
+                logger.warning(f"⚠️ خطا در جستجو با '{keyword}': {items}")
                 continue
-        
+            all_tracks.extend(items)
+
         return all_tracks
-    
-=======
-    def _search_from_playlists(self, genre: str, limit: int = 50) -> List[Dict[str, Any]]:
+
+    async def _search_from_playlists(self, genre: str, limit: int = 50) -> List[Dict[str, Any]]:
         """جستجو در playlist‌های محبوب ژانر"""
         all_tracks = []
+
+        if limit <= 0:
+            return all_tracks
+
+        async def fetch_playlist(playlist_name: str) -> List[Dict[str, Any]]:
+            results = await self.search(q=playlist_name, type='playlist', limit=1)
+            playlists = [p for p in results.get('playlists', {}).get('items', []) if p]
+            if not playlists:
+                return []
+            tracks_results = await self.playlist_tracks(playlists[0]['id'], limit=30)
+            return [
+                item['track'] for item in tracks_results.get('items', [])
+                if item and item.get('track') and item['track'].get('id')
+            ]
+
+        playlist_names = self.POPULAR_PLAYLISTS.get(genre, [])
+        results = await asyncio.gather(
+            *(fetch_playlist(name) for name in playlist_names),
+            return_exceptions=True
+        )
+
+        for playlist_name, items in zip(playlist_names, results):
+            if isinstance(items, Exception):
+                logger.warning(f"⚠️ خطا در playlist '{playlist_name}': {items}")
+                continue
+            all_tracks.extend(items)
+
+        logger.info(f"✅ {len(all_tracks)} آهنگ از playlist‌ها")
+        return all_tracks[:limit]
+
+    # ==================== Genre Candidate Pool ====================
+
+    def _pool_age(self, genre: str) -> Optional[float]:
+        """سن pool ژانر به ثانیه (None اگر وجود نداره)"""
+        entry = self._genre_pools.get(genre)
+        return time.time() - entry[0] if entry else None
+
+    async def refresh_genre_pool(self, genre: str, valid_for: float = 0) -> List[Dict[str, Any]]:
+        """
+        ساخت دوباره pool ژانر اگر تا `valid_for` ثانیه‌ی دیگه منقضی میشه
         
-        try:
-            # اول از لیست playlist‌های از پیش تعریف شده استفاده کن
-            playlist_names = self.POPULAR_PLAYLISTS.get(genre, [])
-            
-            for playlist_name in playlist_names:
-                try:
-                    # جستجوی playlist
-                    results = self.sp.search(
-                        q=playlist_name,
-                        type='playlist',
-                        limit=1
-                    )
-                    
-                    if not results['playlists']['items']:
-                        continue
-                    
-                    playlist = results['playlists']['items'][0]
-                    
-                    # دریافت آهنگ‌های playlist
-                    tracks_results = self.sp.playlist_tracks(
-                        playlist['id'],
-                        limit=30
-                    )
-                    
-                    for item in tracks_results['items']:
-                        if item and item.get('track') and item['track'].get('id'):
-                            all_tracks.append(item['track'])
-                            
-                        if len(all_tracks) >= limit:
-                            break
-                            
-                except Exception as e:
-                    logger.warning(f"⚠️ خطا در playlist '{playlist_name}': {e}")
-                    continue
-                
-                if len(all_tracks) >= limit:
-                    break
-            
-            # اگر هنوز کم داریم، جستجوی عمومی playlist
-            if len(all_tracks) < 10:
-                keywords = self.GENRE_KEYWORDS.get(genre, [genre])
-                for keyword in keywords[:2]:
-                    try:
-                        results = self.sp.search(
-                            q=f'{keyword} playlist',
-                            type='playlist',
-                            limit=3
-                        )
-                        
-                        for playlist in results['playlists']['items']:
-                            if not playlist:
-                                continue
-                            
-                            try:
-                                tracks_results = self.sp.playlist_tracks(
-                                    playlist['id'],
-                                    limit=20
-                                )
-                                
-                                for item in tracks_results['items']:
-                                    if item and item.get('track') and item['track'].get('id'):
-                                        all_tracks.append(item['track'])
-                                        
-                                    if len(all_tracks) >= limit:
-                                        break
-                                        
-                            except:
-                                continue
-                            
-                            if len(all_tracks) >= limit:
-                                break
-                                
-                    except:
-                        continue
-                    
-                    if len(all_tracks) >= limit:
-                        break
-            
-            logger.info(f"✅ {len(all_tracks)} آهنگ از playlist‌ها")
-            return all_tracks[:limit]
-            
-        except Exception as e:
-            logger.error(f"❌ خطا در جستجوی playlist: {e}")
-            return []
-    
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
-    def get_random_track(
+        درخواست‌های همزمان برای یک ژانر فقط یک جستجو انجام میدن.
+        """
+        ttl = config.GENRE_POOL_TTL_MINUTES * 60
+        lock = self._genre_pool_locks.setdefault(genre, asyncio.Lock())
+
+        async with lock:
+            age = self._pool_age(genre)
+            if age is not None and age + valid_for < ttl:
+                return self._genre_pools[genre][1]
+
+            tracks = await self.search_tracks_by_genre(genre, limit=config.GENRE_POOL_SIZE)
+            pool = [self.format_track_info(t) for t in tracks]
+
+            if pool:
+                self._genre_pools[genre] = (time.time(), pool)
+                logger.info(f"🔥 pool ژانر {genre} آماده شد ({len(pool)} آهنگ)")
+            elif age is not None:
+                # جستجو شکست خورد - pool قبلی بهتر از هیچیه
+                logger.warning(f"⚠️ تازه‌سازی pool {genre} ناموفق - استفاده از pool قبلی")
+                return self._genre_pools[genre][1]
+
+            return pool
+
+    async def get_genre_pool(self, genre: str) -> List[Dict[str, Any]]:
+        """pool کاندیدهای ژانر (از حافظه، یا ساخت اگر نیست/منقضی شده)"""
+        return await self.refresh_genre_pool(genre)
+
+    async def prewarm_genre_pools(self, genres: Iterable[str], valid_for: float = 0) -> int:
+        """
+        آماده‌سازی pool چند ژانر قبل از پنجره ارسال
+        
+        Returns:
+            تعداد ژانرهایی که pool دارن
+        """
+        genres = list(set(genres))
+        results = await asyncio.gather(
+            *(self.refresh_genre_pool(genre, valid_for=valid_for) for genre in genres),
+            return_exceptions=True
+        )
+        ready = 0
+        for genre, pool in zip(genres, results):
+            if isinstance(pool, Exception):
+                logger.error(f"❌ خطا در pre-warm ژانر {genre}: {pool}")
+            elif pool:
+                ready += 1
+        return ready
+
+    async def get_random_track(
         self,
         genre: str,
         exclude_ids: List[str] = None
     ) -> Optional[Dict[str, Any]]:
-<<<<<<< HEAD
-        """دریافت یک آهنگ تصادفی با جلوگیری از تکرار قوی‌تر"""
-        # دریافت تعداد زیادی آهنگ
-        tracks = self.search_tracks_by_genre(genre, limit=100)
-        
-        if not tracks:
-            logger.warning(f"⚠️ هیچ آهنگی برای ژانر {genre} پیدا نشد")
-=======
-        """دریافت یک آهنگ تصادفی از ژانر"""
-        tracks = self.search_tracks_by_genre(genre, limit=50)
-        
-        if not tracks:
+        """دریافت یک آهنگ تصادفی (فرمت‌شده) از pool ژانر با جلوگیری از تکرار"""
+        pool = await self.get_genre_pool(genre)
+
+        if not pool:
             logger.warning(f"⚠️ هیچ آهنگی برای ژانر {genre} پیدا نشد")
-            # تلاش دوباره با market دیگر
-            logger.info("🔄 تلاش با market بین‌المللی...")
-            tracks = self.search_tracks_by_genre(genre, limit=50, market='')
-        
-        if not tracks:
-            logger.error(f"❌ همچنان آهنگی پیدا نشد برای {genre}")
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
             return None
-        
+
+        return self.pick_random_track(pool, exclude_ids)
+
+    def pick_random_track(
+        self,
+        all_tracks: List[Dict[str, Any]],
+        exclude_ids=None
+    ) -> Optional[Dict[str, Any]]:
+        """انتخاب تصادفی از یک لیست آهنگ با حذف آهنگ‌های ارسال شده"""
+        if not all_tracks:
+            return None
+
+        tracks = all_tracks
+
         # فیلتر کردن آهنگ‌های تکراری
         if exclude_ids:
-            original_count = len(tracks)
-            tracks = [t for t in tracks if t and t.get('id') not in exclude_ids]
-            logger.info(f"📊 فیلتر شد: {original_count} → {len(tracks)} آهنگ")
-        
+            exclude = exclude_ids if isinstance(exclude_ids, set) else set(exclude_ids)
+            tracks = [t for t in all_tracks if t and t.get('id') not in exclude]
+            logger.debug(f"📊 فیلتر شد: {len(all_tracks)} → {len(tracks)} آهنگ")
+
         if not tracks:
             logger.warning("⚠️ همه آهنگ‌ها قبلاً ارسال شده! از اول شروع می‌کنیم")
             # اگر همه فرستاده شدن، از اول شروع کن
-            tracks = self.search_tracks_by_genre(genre, limit=100)
-        
-        if tracks:
-            return random.choice(tracks)
-        
-        return None
+            tracks = all_tracks
+
+        return random.choice(tracks)
 
     def format_track_info(self, track: Dict[str, Any]) -> Dict[str, Any]:
         """فرمت کردن اطلاعات آهنگ برای نمایش"""
         artists = [a['name'] for a in track.get('artists', [])]
         artist_str = ', '.join(artists) if artists else 'Unknown Artist'
-        
+
         duration_ms = track.get('duration_ms', 0)
-        
+
         album_name = track.get('album', {}).get('name', 'Unknown Album')
-        
+
         return {
             'id': track['id'],
             'name': track.get('name', 'Unknown Track'),
@@ -437,6 +730,7 @@ class SpotifyService:
             'album': album_name,
             'duration': f"{duration_ms // 60000}:{(duration_ms % 60000) // 1000:02d}",
             'duration_ms': duration_ms,
+            'popularity': track.get('popularity'),
             'links': {
                 'spotify': track.get('external_urls', {}).get('spotify', ''),
                 'preview': track.get('preview_url')
@@ -451,64 +745,96 @@ spotify_service = SpotifyService()
 
 # ==================== Helper Functions ====================
 
-def get_random_track_for_user(user_id: int, genre: str) -> Optional[Dict[str, Any]]:
-<<<<<<< HEAD
+async def get_random_track_for_user(user_id: int, genre: str) -> Optional[Dict[str, Any]]:
     """دریافت یک آهنگ تصادفی برای کاربر با جلوگیری قوی از تکرار"""
-=======
-    """
-    دریافت یک آهنگ تصادفی برای کاربر (با چک کردن تاریخچه تکراری)
-    """
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
     from core.database import SessionLocal, SentTrack
-    
+
     db = SessionLocal()
     try:
-<<<<<<< HEAD
         # دریافت 200 آهنگ آخر (بجای 100)
-=======
-        # آهنگ‌های ارسال شده اخیر
->>>>>>> parent of d32bb2d (Update spotify.py for Persian music )
         sent_tracks = db.query(SentTrack).filter(
             SentTrack.user_id == user_id
         ).order_by(SentTrack.sent_at.desc()).limit(200).all()
-        
+
         exclude_ids = [t.track_id for t in sent_tracks]
-        
+
         logger.info(f"🔍 جستجو برای ژانر '{genre}', exclude: {len(exclude_ids)} آهنگ")
-        
+
     finally:
         db.close()
-    
-    track = spotify_service.get_random_track(genre, exclude_ids=exclude_ids)
-    
-    if not track:
+
+    formatted = await spotify_service.get_random_track(genre, exclude_ids=exclude_ids)
+
+    if not formatted:
         logger.error(f"❌ آهنگی برای کاربر {user_id} و ژانر {genre} پیدا نشد")
         return None
-    
-    formatted = spotify_service.format_track_info(track)
+
     logger.info(f"✅ آهنگ انتخاب شد: {formatted['name']} - {formatted['artist_str']}")
-    
+
     return formatted
 
 
-if __name__ == "__main__":
-    print("🧪 در حال تست Spotify Service...")
+def get_recent_sent_track_ids(
+    user_ids: List[int],
+    limit: int = 200,
+    chunk_size: int = 500
+) -> Dict[int, set]:
+    """
+    آهنگ‌های اخیر ارسال شده برای چند کاربر با یک query در هر chunk
     
-    if spotify_service.is_available():
+    معادل get_random_track_for_user ولی برای batch (آخرین `limit` آهنگ هر کاربر)
+    """
+    from sqlalchemy import func
+    from core.database import SessionLocal, SentTrack
+
+    result = {user_id: set() for user_id in user_ids}
+
+    db = SessionLocal()
+    try:
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            row_number = func.row_number().over(
+                partition_by=SentTrack.user_id,
+                order_by=SentTrack.sent_at.desc()
+            ).label('rn')
+            recent = db.query(
+                SentTrack.user_id, SentTrack.track_id, row_number
+            ).filter(SentTrack.user_id.in_(chunk)).subquery()
+
+            rows = db.query(recent.c.user_id, recent.c.track_id).filter(
+                recent.c.rn <= limit
+            )
+            for user_id, track_id in rows:
+                result[user_id].add(track_id)
+    finally:
+        db.close()
+
+    return result
+
+
+if __name__ == "__main__":
+    async def _main():
+        print("🧪 در حال تست Spotify Service...")
+
+        if not spotify_service.is_available():
+            print("❌ Spotify در دسترس نیست - credentials را چک کنید")
+            return
+
         print("✅ Spotify در دسترس است")
-        
+
         # تست ژانرهای مختلف
-        test_genres = ['pop', 'persian', 'kpop']
-        
+        test_genres = ['pop', 'persian_pop', 'kpop']
+
         for genre in test_genres:
             print(f"\n🎵 تست ژانر: {genre}")
-            track = spotify_service.get_random_track(genre)
-            if track:
-                formatted = spotify_service.format_track_info(track)
+            formatted = await spotify_service.get_random_track(genre)
+            if formatted:
                 print(f"  نام: {formatted['name']}")
                 print(f"  هنرمند: {formatted['artist_str']}")
                 print(f"  لینک: {formatted['links']['spotify']}")
             else:
                 print(f"  ⚠️ آهنگی پیدا نشد")
-    else:
-        print("❌ Spotify در دسترس نیست - credentials را چک کنید")
\ No newline at end of file
+
+        await http_client.close()
+
+    asyncio.run(_main())
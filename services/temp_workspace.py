@@ -0,0 +1,99 @@
+"""
+فضای کاری موقت جدا برای هر درخواست
+
+هر درخواست (ویس، ویدیو، لینک اینستاگرام) یک پوشه یکتا زیر temp/ می‌گیره
+که در پایان (موفق، خطا یا لغو) پاک میشه؛ دو درخواست همزمان یک کاربر
+دیگه فایل همدیگه رو بازنویسی نمی‌کنن. janitor دوره‌ای فقط چیزهایی رو
+پاک می‌کنه که بعد از crash باقی موندن.
+"""
+import logging
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Set
+
+from core.config import config
+
+logger = logging.getLogger(__name__)
+
+TEMP_ROOT = Path("temp")
+
+
+class TempWorkspaces:
+    """ساخت/پاک‌سازی پوشه‌های موقت و janitor"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(exist_ok=True)
+        self._active: Set[Path] = set()
+        self._stats = {'created': 0, 'removed': 0, 'janitor_removed': 0, 'janitor_runs': 0}
+
+    @asynccontextmanager
+    async def workspace(self, prefix: str) -> AsyncIterator[Path]:
+        """
+        پوشه یکتای موقت برای یک درخواست
+
+            async with temp_workspaces.workspace('voice') as workdir:
+                path = workdir / 'voice.ogg'
+        """
+        self.root.mkdir(exist_ok=True)
+        path = Path(tempfile.mkdtemp(prefix=f"{prefix}_", dir=self.root))
+        self._active.add(path)
+        self._stats['created'] += 1
+        try:
+            yield path
+        finally:
+            self._active.discard(path)
+            shutil.rmtree(path, ignore_errors=True)
+            self._stats['removed'] += 1
+
+    def sweep(self, max_age_seconds: float) -> int:
+        """
+        پاک کردن باقیمانده‌های قدیمی (پوشه/فایل) که متعلق به درخواست فعالی نیستن
+
+        Returns:
+            تعداد موارد پاک شده
+        """
+        if not self.root.exists():
+            return 0
+
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for entry in self.root.iterdir():
+            if entry in self._active:
+                continue
+            try:
+                if entry.stat().st_mtime > cutoff:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entry.unlink()
+                removed += 1
+            except OSError:
+                pass
+
+        self._stats['janitor_runs'] += 1
+        self._stats['janitor_removed'] += removed
+        if removed:
+            logger.info(f"🗑️ janitor: {removed} فایل/پوشه موقت قدیمی پاک شد")
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, 'active': len(self._active)}
+
+
+# Singleton
+temp_workspaces = TempWorkspaces(TEMP_ROOT)
+
+
+def temp_workspace(prefix: str):
+    """تابع کمکی: temp_workspaces.workspace(prefix)"""
+    return temp_workspaces.workspace(prefix)
+
+
+async def temp_janitor_job(context):
+    """job دوره‌ای پاک‌سازی temp/ (جایگزین اسکن‌های دستی)"""
+    temp_workspaces.sweep(config.TEMP_MAX_AGE_MINUTES * 60)
@@ -0,0 +1,192 @@
+"""
+موتور yt-dlp داخل پروسه‌های ماندگار
+
+به جای اجرای یک پروسه جدید yt-dlp برای هر تلاش دانلود (startup مفسر +
+import همه extractor ها)، چند worker ماندگار (services/ytdlp_worker.py)
+نگه داشته میشه که yt-dlp رو به صورت کتابخانه اجرا می‌کنن. در timeout یا
+لغو، فقط همان worker kill و بعداً دوباره ساخته میشه.
+"""
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.config import config
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = Path(__file__).with_name('ytdlp_worker.py')
+
+
+class YtdlpEngineError(Exception):
+    """خطای خود موتور (نه دانلود) - مسیر subprocess جایگزین میشه"""
+
+
+class BackendTimings:
+    """آمار wall/CPU هر backend دانلود برای مقایسه"""
+
+    def __init__(self):
+        self._totals: Dict[str, Dict[str, float]] = {}
+
+    def record(self, backend: str, wall: float, cpu: Optional[float] = None):
+        entry = self._totals.setdefault(backend, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'cpu_count': 0})
+        entry['count'] += 1
+        entry['wall'] += wall
+        if cpu is not None:
+            entry['cpu'] += cpu
+            entry['cpu_count'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        result = {}
+        for backend, entry in self._totals.items():
+            result[backend] = {
+                'count': entry['count'],
+                'avg_wall': round(entry['wall'] / entry['count'], 3),
+            }
+            if entry['cpu_count']:
+                result[backend]['avg_cpu'] = round(entry['cpu'] / entry['cpu_count'], 3)
+                result[backend]['total_cpu'] = round(entry['cpu'], 3)
+        return result
+
+
+class YtdlpEngine:
+    """استخر worker های ماندگار yt-dlp"""
+
+    STARTUP_TIMEOUT = 30
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._idle: List[asyncio.subprocess.Process] = []
+        self.spawned = 0
+        self.timings = BackendTimings()
+
+        self.enabled = config.YTDLP_ENGINE == 'library'
+        if self.enabled and importlib.util.find_spec('yt_dlp') is None:
+            logger.warning("⚠️ کتابخانه yt_dlp پیدا نشد - دانلود با subprocess انجام میشه")
+            self.enabled = False
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        """ساخت worker جدید و صبر تا گرم شدنش"""
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, str(WORKER_SCRIPT),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            # گروه پروسه جدا: ffmpeg های postprocessor هم با worker kill میشن
+            start_new_session=True
+        )
+        try:
+            line = await asyncio.wait_for(process.stdout.readline(), timeout=self.STARTUP_TIMEOUT)
+            if not json.loads(line or b'{}').get('ready'):
+                raise YtdlpEngineError("worker آماده نشد")
+        except (asyncio.TimeoutError, ValueError, YtdlpEngineError) as e:
+            await self._kill(process)
+            raise YtdlpEngineError(f"راه‌اندازی worker ناموفق: {e}")
+        except asyncio.CancelledError:
+            await self._kill(process)
+            raise
+
+        self.spawned += 1
+        logger.info(f"✅ worker yt-dlp آماده شد (pid={process.pid})")
+        return process
+
+    async def _acquire(self) -> asyncio.subprocess.Process:
+        while self._idle:
+            process = self._idle.pop()
+            if process.returncode is None:
+                return process
+        return await self._spawn()
+
+    def _release(self, process: asyncio.subprocess.Process):
+        if process.returncode is None and len(self._idle) < self.size:
+            self._idle.append(process)
+        else:
+            asyncio.create_task(self._kill(process))
+
+    @staticmethod
+    async def _kill(process: asyncio.subprocess.Process):
+        """kill کل گروه پروسه worker (شامل ffmpeg هایی که شروع کرده)"""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        except OSError:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+    async def run(
+        self,
+        target: str,
+        options: Dict[str, Any],
+        timeout: float,
+        mode: str = 'download'
+    ) -> Tuple[int, str, Optional[Dict[str, Any]]]:
+        """
+        اجرای یک job روی worker آزاد
+
+        mode: download (دانلود) یا search (فقط metadata نتایج جستجو)
+
+        Returns:
+            (returncode, پیام خطا, مشخصات منبع دانلود شده یا {'entries': [...]})
+
+        Raises:
+            asyncio.TimeoutError: دانلود از timeout رد شد (worker kill میشه)
+            YtdlpEngineError: خود worker مشکل داشت
+        """
+        try:
+            process = await self._acquire()
+        except (OSError, YtdlpEngineError) as e:
+            # مثلاً محیط اجازه پروسه ماندگار نمیده
+            logger.warning(f"⚠️ موتور yt-dlp غیرفعال شد: {e}")
+            self.enabled = False
+            raise YtdlpEngineError(str(e))
+
+        started = time.perf_counter()
+        healthy = False
+        try:
+            job = json.dumps({'target': target, 'options': options, 'mode': mode}) + '\n'
+            process.stdin.write(job.encode('utf-8'))
+            await process.stdin.drain()
+
+            line = await asyncio.wait_for(process.stdout.readline(), timeout=timeout)
+            if not line:
+                raise YtdlpEngineError("worker بسته شد")
+            result = json.loads(line)
+            healthy = True
+        except (BrokenPipeError, ConnectionResetError, ValueError) as e:
+            raise YtdlpEngineError(f"ارتباط با worker قطع شد: {e}")
+        finally:
+            if healthy:
+                self._release(process)
+            else:
+                await self._kill(process)
+
+        self.timings.record('library', time.perf_counter() - started, result.get('cpu'))
+        return result.get('returncode', 1), result.get('error') or '', result.get('info')
+
+    async def close(self):
+        """بستن همه worker ها"""
+        idle, self._idle = self._idle, []
+        for process in idle:
+            await self._kill(process)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'idle_workers': len(self._idle),
+            'spawned': self.spawned,
+            'backends': self.timings.stats(),
+        }
+
+
+# Singleton (تعداد worker ها هم‌اندازه صف پروسه‌ها)
+ytdlp_engine = YtdlpEngine(config.PROCESS_WORKERS)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Worker ماندگار yt-dlp - yt-dlp یک بار import میشه و extractor ها گرم می‌مونن
+
+پروتکل: هر خط stdin یک job به شکل JSON
+    {"target": "...", "options": {...}, "mode": "download" | "search"}
+و برای هر job یک خط JSON روی stdout
+    {"returncode": 0, "error": null, "info": {...}, "cpu": 1.23}
+
+این فایل عمداً بدون import از پکیج services اجرا میشه (python ytdlp_worker.py)
+تا startup سبک بمونه.
+"""
+import json
+import resource
+import sys
+import time
+
+# extractor هایی که بات استفاده می‌کنه (موقع startup گرم میشن)
+WARM_EXTRACTORS = ('Youtube', 'YoutubeSearch', 'Soundcloud', 'SoundcloudSearch', 'Instagram')
+
+# فیلدهای منبع انتخاب شده (همان --print مسیر subprocess)
+INFO_FIELDS = ('id', 'webpage_url', 'extractor_key', 'format_id', 'duration')
+
+# فیلدهای نتایج جستجو (همان source_ranking.CANDIDATE_FIELDS)
+CANDIDATE_FIELDS = (
+    'id', 'title', 'duration', 'channel', 'uploader',
+    'channel_is_verified', 'view_count', 'live_status',
+)
+
+
+def _cpu_seconds() -> float:
+    """CPU خود worker + پروسه‌های فرزند (ffmpeg)"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _build_options(options: dict) -> dict:
+    """تبدیل گزینه‌های JSON به گزینه‌های YoutubeDL"""
+    from yt_dlp.utils import download_range_func, match_filter_func
+
+    options = dict(options)
+    if options.get('match_filter'):
+        options['match_filter'] = match_filter_func(options['match_filter'])
+    # [[شروع، پایان], ...] به ثانیه (همان --download-sections)
+    sections = options.pop('download_sections', None)
+    if sections:
+        options['download_ranges'] = download_range_func(None, [tuple(s) for s in sections])
+    return options
+
+
+def _pick_info(info: dict) -> dict:
+    """اولین نتیجه (برای ytsearch/scsearch) با فیلدهای لازم"""
+    if info and info.get('entries') is not None:
+        info = next((entry for entry in info['entries'] if entry), None)
+    if not info:
+        return None
+    return {field: info.get(field) for field in INFO_FIELDS}
+
+
+def _search_entries(info: dict) -> dict:
+    """نتایج جستجو بدون دانلود (metadata)"""
+    entries = (info or {}).get('entries') or []
+    return {'entries': [
+        {field: entry.get(field) for field in CANDIDATE_FIELDS}
+        for entry in entries if entry
+    ]}
+
+
+def _run_job(job: dict) -> dict:
+    import yt_dlp
+
+    started = _cpu_seconds()
+    info = None
+    try:
+        with yt_dlp.YoutubeDL(_build_options(job.get('options', {}))) as ydl:
+            if job.get('mode') == 'search':
+                info = _search_entries(ydl.extract_info(job['target'], download=False))
+            else:
+                info = _pick_info(ydl.extract_info(job['target'], download=True))
+        returncode = 0
+        error = None
+    except Exception as e:
+        returncode = 1
+        error = str(e)[:200]
+
+    return {'returncode': returncode, 'error': error, 'info': info, 'cpu': _cpu_seconds() - started}
+
+
+def main():
+    # stdout فقط برای پروتکل؛ هر خروجی دیگه yt-dlp به stderr میره
+    protocol = sys.stdout
+    sys.stdout = sys.stderr
+
+    import yt_dlp
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        for key in WARM_EXTRACTORS:
+            try:
+                ydl.get_info_extractor(key)
+            except Exception:
+                pass
+
+    protocol.write(json.dumps({'ready': True}) + '\n')
+    protocol.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            result = _run_job(json.loads(line))
+        except Exception as e:
+            result = {'returncode': 1, 'error': str(e)[:200], 'cpu': 0.0}
+        protocol.write(json.dumps(result) + '\n')
+        protocol.flush()
+
+
+if __name__ == '__main__':
+    main()
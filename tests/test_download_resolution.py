@@ -0,0 +1,88 @@
+"""
+تست مسیر دانلود کامل: نگاشت منبع و کلید single-flight (services/downloader.py)
+"""
+import asyncio
+
+import pytest
+
+from services import downloader
+from services.downloader import music_downloader
+
+
+class FakeResolver:
+    """SourceResolver در حافظه"""
+
+    def __init__(self, mapping=None):
+        self.mapping = dict(mapping or {})
+
+    def lookup(self, track_id):
+        return self.mapping.get(track_id)
+
+    def forget(self, track_id):
+        self.mapping.pop(track_id, None)
+
+    def record(self, track_id, source, info, duration_ms, quality):
+        self.mapping[track_id] = {'source': source, 'url': info['webpage_url']}
+
+
+@pytest.fixture
+def fake_download(monkeypatch):
+    """دانلود جستجو محور که همیشه new.m4a از ویدیوی new رو برمی‌گردونه"""
+    async def hedged(track_name, artist_name, quality, duration_ms):
+        music_downloader._resolutions['new.m4a'] = {
+            'id': 'new', 'webpage_url': 'https://www.youtube.com/watch?v=new'
+        }
+        return 'new.m4a', 'youtube'
+
+    monkeypatch.setattr(downloader, '_hedged_download', hedged)
+    monkeypatch.setattr(downloader, '_is_valid_download', lambda path: bool(path))
+    monkeypatch.setattr(downloader.config, 'DOWNLOAD_HEDGE_DELAY', 0)
+    monkeypatch.setattr(music_downloader.index, 'lookup', lambda *args: None)
+    monkeypatch.setattr(music_downloader.index, 'record', lambda path, *args: path)
+
+
+def _download(track_id):
+    return asyncio.run(downloader._download_full_track(
+        'Blinding Lights', 'The Weeknd', track_id, 200000, 'the weeknd:blinding lights'
+    ))
+
+
+def test_stale_mapping_is_replaced(monkeypatch, fake_download):
+    resolver = FakeResolver({'t1': {'source': 'youtube', 'url': 'https://www.youtube.com/watch?v=gone'}})
+    monkeypatch.setattr(music_downloader, 'resolver', resolver)
+
+    async def broken(resolved, quality):
+        return None
+
+    monkeypatch.setattr(music_downloader, 'download_resolved', broken)
+
+    assert _download('t1') == 'new.m4a'
+    assert resolver.mapping['t1']['url'] == 'https://www.youtube.com/watch?v=new'
+
+
+def test_missing_mapping_is_recorded(monkeypatch, fake_download):
+    resolver = FakeResolver()
+    monkeypatch.setattr(music_downloader, 'resolver', resolver)
+
+    assert _download('t2') == 'new.m4a'
+    assert resolver.mapping['t2'] == {'source': 'youtube', 'url': 'https://www.youtube.com/watch?v=new'}
+
+
+def test_single_flight_key_includes_quality(monkeypatch):
+    calls = []
+
+    async def full_track(track_name, artist_name, track_id, duration_ms, lookup_key, quality):
+        calls.append(quality)
+        await asyncio.sleep(0)
+        return f"{quality}.m4a"
+
+    monkeypatch.setattr(downloader, '_download_full_track', full_track)
+
+    async def scenario():
+        return await asyncio.gather(*(
+            downloader.download_track_safe_async('Blinding Lights', 'The Weeknd', track_id='t3', quality=quality)
+            for quality in ('high', 'low', 'low', None)
+        ))
+
+    assert asyncio.run(scenario()) == ['high.m4a', 'low.m4a', 'low.m4a', 'high.m4a']
+    assert sorted(calls, key=str) == ['high', 'low']
@@ -0,0 +1,88 @@
+"""
+تست صف اولویت‌دار پروسه‌ها (services/process_pool.py)
+"""
+import asyncio
+
+from services.process_pool import (
+    ProcessPool, PRIORITY_INTERACTIVE, PRIORITY_SCHEDULED, process_priority
+)
+
+
+async def _hold(pool: ProcessPool, name: str, order: list, release: asyncio.Event):
+    async with pool.slot():
+        order.append(name)
+        await release.wait()
+
+
+def _spawn(pool, name, level, order, release):
+    with process_priority(level):
+        return asyncio.create_task(_hold(pool, name, order, release))
+
+
+def test_interactive_jumps_ahead_of_scheduled():
+    async def scenario():
+        pool = ProcessPool(1, saturation=10)
+        order = []
+        release = asyncio.Event()
+
+        holder = _spawn(pool, 'holder', PRIORITY_SCHEDULED, order, release)
+        await asyncio.sleep(0)
+        scheduled = _spawn(pool, 'scheduled', PRIORITY_SCHEDULED, order, release)
+        await asyncio.sleep(0)
+        interactive = _spawn(pool, 'interactive', PRIORITY_INTERACTIVE, order, release)
+        await asyncio.sleep(0)
+
+        assert pool.queue_depth(PRIORITY_SCHEDULED) == 1
+        assert pool.queue_depth(PRIORITY_INTERACTIVE) == 1
+
+        release.set()
+        await asyncio.gather(holder, scheduled, interactive)
+        return pool, order
+
+    pool, order = asyncio.run(scenario())
+    assert order == ['holder', 'interactive', 'scheduled']
+    assert pool.stats()['active'] == 0
+
+
+def test_fifo_within_same_priority():
+    async def scenario():
+        pool = ProcessPool(1, saturation=10)
+        order = []
+        release = asyncio.Event()
+
+        tasks = []
+        for name in ('holder', 'first', 'second', 'third'):
+            tasks.append(_spawn(pool, name, PRIORITY_SCHEDULED, order, release))
+            await asyncio.sleep(0)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ['holder', 'first', 'second', 'third']
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def scenario():
+        pool = ProcessPool(1, saturation=10)
+        order = []
+        release = asyncio.Event()
+
+        holder = _spawn(pool, 'holder', PRIORITY_INTERACTIVE, order, release)
+        await asyncio.sleep(0)
+        cancelled = _spawn(pool, 'cancelled', PRIORITY_INTERACTIVE, order, release)
+        waiter = _spawn(pool, 'waiter', PRIORITY_SCHEDULED, order, release)
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert pool.queue_depth() == 1
+
+        release.set()
+        await asyncio.gather(holder, waiter)
+        return pool, order
+
+    pool, order = asyncio.run(scenario())
+    assert order == ['holder', 'waiter']
+    assert pool.stats()['active'] == 0
+    assert pool.queue_depth() == 0
@@ -0,0 +1,67 @@
+"""
+تست تطبیق نزدیک اثر انگشت در کش تشخیص (services/music_recognition.py)
+"""
+from datetime import timedelta
+
+import pytest
+
+from services.music_recognition import RecognitionCache, _NOT_CACHED
+
+BITS = 100
+BASE = (1 << 99) | 0xABCDEF << 40
+
+
+def fingerprint(value: int, bits: int = BITS) -> str:
+    return f"fp:{bits}:{value:x}"
+
+
+def flip(value: int, count: int) -> int:
+    """برعکس کردن count بیت پایین"""
+    return value ^ ((1 << count) - 1)
+
+
+@pytest.fixture
+def cache():
+    return RecognitionCache(timedelta(days=1), timedelta(hours=1), tolerance=0.1)
+
+
+def test_distance_at_threshold_matches(cache):
+    known = fingerprint(BASE)
+    cache._remember(known)
+    assert cache._nearest(fingerprint(flip(BASE, 10))) == known
+
+
+def test_distance_above_threshold_does_not_match(cache):
+    cache._remember(fingerprint(BASE))
+    assert cache._nearest(fingerprint(flip(BASE, 11))) is None
+
+
+def test_nearest_picks_closest(cache):
+    close = fingerprint(flip(BASE, 2))
+    cache._remember(fingerprint(flip(BASE, 8)))
+    cache._remember(close)
+    assert cache._nearest(fingerprint(BASE)) == close
+
+
+def test_different_bit_length_never_matches(cache):
+    cache._remember(fingerprint(BASE, bits=120))
+    assert cache._nearest(fingerprint(BASE)) is None
+
+
+def test_non_fingerprint_keys_are_ignored(cache):
+    cache._remember('ig:ABC123')
+    assert cache._nearest('ig:ABC123') is None
+    assert not cache._recent
+
+
+def test_get_returns_near_hit(cache, monkeypatch):
+    known = fingerprint(BASE)
+    stored = {known: {'title': 'Blinding Lights'}}
+    monkeypatch.setattr(cache, '_load', lambda key: stored.get(key, _NOT_CACHED))
+    cache._remember(known)
+
+    assert cache.get(fingerprint(flip(BASE, 5))) == {'title': 'Blinding Lights'}
+    assert cache.get(fingerprint(flip(BASE, 30))) is _NOT_CACHED
+
+    stats = cache._stats['fingerprint']
+    assert (stats['hits'], stats['near_hits'], stats['misses']) == (0, 1, 1)
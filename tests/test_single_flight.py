@@ -0,0 +1,98 @@
+"""
+تست SingleFlight (services/downloader.py)
+"""
+import asyncio
+
+from services.downloader import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def factory():
+            calls.append(1)
+            await release.wait()
+            return 'file.mp3'
+
+        waiters = [asyncio.create_task(flight.run('track', factory)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert flight.stats()['waiters'] == 5
+
+        release.set()
+        results = await asyncio.gather(*waiters)
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert results == ['file.mp3'] * 5
+    assert flight.deduplicated == 4
+    assert flight.stats()['inflight'] == 0
+
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def factory(key):
+            calls.append(key)
+            await asyncio.sleep(0)
+            return key
+
+        results = await asyncio.gather(
+            flight.run('a', lambda: factory('a')),
+            flight.run('b', lambda: factory('b')),
+        )
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert sorted(calls) == ['a', 'b']
+    assert results == ['a', 'b']
+
+
+def test_cancelled_waiter_does_not_cancel_shared_task():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        finished = []
+
+        async def factory():
+            await release.wait()
+            finished.append(True)
+            return 'file.mp3'
+
+        first = asyncio.create_task(flight.run('track', factory))
+        second = asyncio.create_task(flight.run('track', factory))
+        await asyncio.sleep(0)
+
+        first.cancel()
+        await asyncio.sleep(0)
+        assert first.cancelled()
+
+        release.set()
+        return await second, finished
+
+    result, finished = asyncio.run(scenario())
+    assert result == 'file.mp3'
+    assert finished == [True]
+
+
+def test_key_is_released_after_completion():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def factory():
+            calls.append(1)
+            return len(calls)
+
+        first = await flight.run('track', factory)
+        second = await flight.run('track', factory)
+        return first, second, flight.stats()
+
+    first, second, stats = asyncio.run(scenario())
+    assert (first, second) == (1, 2)
+    assert stats['inflight'] == 0 and stats['waiters'] == 0
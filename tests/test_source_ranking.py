@@ -0,0 +1,78 @@
+"""
+تست رتبه‌بندی کاندیدهای YouTube (services/source_ranking.py)
+"""
+import pytest
+
+from core.config import config
+from services.source_ranking import rank_candidates, score_candidate
+
+TRACK = "Blinding Lights"
+ARTIST = "The Weeknd"
+DURATION_MS = 200_000
+
+
+@pytest.fixture(autouse=True)
+def ranking_config(monkeypatch):
+    monkeypatch.setattr(config, 'CANDIDATE_MAX_DURATION_DELTA', 30)
+    monkeypatch.setattr(config, 'CANDIDATE_MIN_SCORE', 0.45)
+
+
+def candidate(video_id, title, duration=200, channel='The Weeknd - Topic', **extra):
+    return {'id': video_id, 'title': title, 'duration': duration, 'channel': channel, **extra}
+
+
+def test_official_audio_ranks_first():
+    ranked = rank_candidates([
+        candidate('lyrics', 'The Weeknd - Blinding Lights (Lyrics)', duration=203, channel='Lyrics Hub'),
+        candidate('official', 'Blinding Lights'),
+    ], TRACK, ARTIST, DURATION_MS)
+
+    assert [c['id'] for _, c in ranked][0] == 'official'
+
+
+@pytest.mark.parametrize('title', [
+    'The Weeknd - Blinding Lights (Cover)',
+    'Blinding Lights REMIX',
+    'Blinding Lights (Live)',
+    'Blinding Lights - sped up',
+])
+def test_non_original_versions_are_rejected(title):
+    ranked = rank_candidates([candidate('x', title, channel='Some Channel')], TRACK, ARTIST, DURATION_MS)
+    assert ranked == []
+
+
+def test_keyword_inside_track_name_is_not_penalized():
+    # "Live" جزو اسم خود آهنگه، نه نشانه نسخه لایو
+    with_keyword = score_candidate(
+        candidate('a', 'Live Forever', channel='Oasis - Topic'), 'Live Forever', 'Oasis', DURATION_MS
+    )
+    assert with_keyword is not None and with_keyword >= config.CANDIDATE_MIN_SCORE
+
+
+def test_penalty_lowers_score():
+    clean = score_candidate(candidate('a', 'The Weeknd - Blinding Lights'), TRACK, ARTIST, DURATION_MS)
+    cover = score_candidate(candidate('b', 'The Weeknd - Blinding Lights cover'), TRACK, ARTIST, DURATION_MS)
+    assert cover < clean
+
+
+def test_duration_outside_tolerance_is_rejected():
+    too_long = candidate('long', 'Blinding Lights', duration=DURATION_MS / 1000 + 31)
+    assert score_candidate(too_long, TRACK, ARTIST, DURATION_MS) is None
+
+
+def test_duration_inside_tolerance_scores_lower_with_distance():
+    exact = score_candidate(candidate('a', 'Blinding Lights'), TRACK, ARTIST, DURATION_MS)
+    near = score_candidate(candidate('b', 'Blinding Lights', duration=225), TRACK, ARTIST, DURATION_MS)
+    assert near is not None
+    assert near < exact
+
+
+def test_live_streams_and_short_clips_are_rejected():
+    assert score_candidate(candidate('a', 'Blinding Lights', live_status='is_live'), TRACK, ARTIST, DURATION_MS) is None
+    # بدون duration_ms اسپاتیفای، کلیپ‌های زیر یک دقیقه رد میشن
+    assert score_candidate(candidate('b', 'Blinding Lights', duration=45), TRACK, ARTIST) is None
+
+
+def test_entries_without_id_are_skipped():
+    ranked = rank_candidates([None, {'title': 'Blinding Lights'}], TRACK, ARTIST, DURATION_MS)
+    assert ranked == []